@@ -0,0 +1,148 @@
+'''
+Composed back buffer of the tile layer, 'margin' pixels larger than the
+viewport on every side.
+
+While panning, the viewport just moves over the buffer. When it runs off
+the edge, the buffer is re-centred by blitting the old content across and
+rendering only the strips that were exposed. The buffer is recomposed from
+scratch only when the zoom or the viewport size changes. Tiles which were
+drawn as placeholders are retried on every paint until their bitmap is
+ready, so arriving tiles are drawn into the buffer one by one. A tile whose
+bitmap changed after it was drawn is redrawn the same way, after
+redrawTile(). invalidate() throws the whole buffer away, e.g. when the map
+source changes.
+
+Positions in the buffer are in world pixels - projection units times the
+projection scale - so that they are whole numbers at any one zoom level.
+'''
+
+import math
+
+import wx
+import tilenames
+
+
+#==============================================================================
+class TileBackBuffer:
+
+    def __init__(self, drawTile, margin = 256):
+        ''' drawTile(dc, x, y, z, left, top) draws one tile and returns False if it only drew a placeholder '''
+        self.drawTile = drawTile
+        self.margin = margin
+        self.bitmap = self.spare = None
+        self.zoom = None
+        self.originX = self.originY = 0
+        self.placeholders = set()
+
+    #--------------------------------------------
+    def invalidate(self):
+        self.zoom = None
+
+    def redrawTile(self, x, y, z):
+        ''' Draw the tile again on the next paint, if it is in the buffer '''
+        if z == self.zoom and self.bitmap is not None and self.tileInBuffer(x, y):
+            self.placeholders.add((x, y))
+
+    #--------------------------------------------
+    def draw(self, dc, projection):
+        ''' Bring the buffer up to date with the projection and draw it onto dc '''
+        viewX = int(math.floor(projection.px1 * projection.scale))
+        viewY = int(math.floor(projection.py1 * projection.scale))
+        width = projection.w + 2 * self.margin
+        height = projection.h + 2 * self.margin
+
+        if self.zoom != projection.zoom or self.bitmap is None or \
+                self.bitmap.GetWidth() != width or self.bitmap.GetHeight() != height:
+            self.compose(projection.zoom, viewX - self.margin, viewY - self.margin, width, height)
+
+        elif not (0 <= viewX - self.originX <= 2 * self.margin and 0 <= viewY - self.originY <= 2 * self.margin):
+            self.shift(viewX - self.margin, viewY - self.margin)
+
+        else:
+            self.retryPlaceholders()
+
+        dc.DrawBitmap(self.bitmap, self.originX - viewX, self.originY - viewY)
+
+    #--------------------------------------------
+    def compose(self, zoom, originX, originY, width, height):
+        if self.bitmap is None or self.bitmap.GetWidth() != width or self.bitmap.GetHeight() != height:
+            self.bitmap = wx.Bitmap(width, height)
+            self.spare = wx.Bitmap(width, height)
+
+        self.zoom = zoom
+        self.originX, self.originY = originX, originY
+        self.placeholders.clear()
+
+        dc = wx.MemoryDC(self.bitmap)
+        self.render(dc, 0, 0, width, height)
+        dc.SelectObject(wx.NullBitmap)
+
+    #--------------------------------------------
+    def shift(self, originX, originY):
+        width, height = self.bitmap.GetWidth(), self.bitmap.GetHeight()
+
+        # Where the old buffer lands in the new one
+        ox, oy = self.originX - originX, self.originY - originY
+
+        if abs(ox) >= width or abs(oy) >= height:
+            self.compose(self.zoom, originX, originY, width, height)
+            return
+
+        self.bitmap, self.spare = self.spare, self.bitmap
+        self.originX, self.originY = originX, originY
+
+        dc = wx.MemoryDC(self.bitmap)
+        dc.DrawBitmap(self.spare, ox, oy)
+
+        # Forget placeholders which have scrolled out, the rest are retried below
+        self.placeholders = {p for p in self.placeholders if self.tileInBuffer(*p)}
+
+        # The strips the old buffer did not cover
+        if ox > 0: self.render(dc, 0, 0, ox, height)
+        elif ox < 0: self.render(dc, width + ox, 0, -ox, height)
+
+        left, right = max(0, ox), min(width, ox + width)
+        if oy > 0: self.render(dc, left, 0, right - left, oy)
+        elif oy < 0: self.render(dc, left, height + oy, right - left, -oy)
+
+        self.retryPlaceholders(dc)
+        dc.SelectObject(wx.NullBitmap)
+
+    #--------------------------------------------
+    def render(self, dc, left, top, width, height):
+        ''' Render the tiles covering a rectangle of the buffer '''
+        if width <= 0 or height <= 0: return
+
+        tileSize = tilenames.tileSizePixels()
+        dc.SetClippingRegion(left, top, width, height)
+
+        for x in range((self.originX + left) // tileSize, (self.originX + left + width - 1) // tileSize + 1):
+            for y in range((self.originY + top) // tileSize, (self.originY + top + height - 1) // tileSize + 1):
+                self.renderTile(dc, x, y)
+
+        dc.DestroyClippingRegion()
+
+    #--------------------------------------------
+    def renderTile(self, dc, x, y):
+        tileSize = tilenames.tileSizePixels()
+        if self.drawTile(dc, x, y, self.zoom, x * tileSize - self.originX, y * tileSize - self.originY):
+            self.placeholders.discard((x, y))
+        else:
+            self.placeholders.add((x, y))
+
+    #--------------------------------------------
+    def retryPlaceholders(self, dc = None):
+        if not self.placeholders: return
+
+        memoryDC = dc or wx.MemoryDC(self.bitmap)
+        for x, y in list(self.placeholders):
+            self.renderTile(memoryDC, x, y)
+
+        if dc is None: memoryDC.SelectObject(wx.NullBitmap)
+
+    #--------------------------------------------
+    def tileInBuffer(self, x, y):
+        tileSize = tilenames.tileSizePixels()
+        left, top = x * tileSize - self.originX, y * tileSize - self.originY
+        return left + tileSize > 0 and top + tileSize > 0 and \
+            left < self.bitmap.GetWidth() and top < self.bitmap.GetHeight()
@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the hot paths of the map - projection, tile lookup, the
+caches and the per-frame tile loop - run headlessly against a synthetic
+tile cache in a temporary directory.
+
+    python benchmark.py [--quick] [--save results.json] [--baseline baseline.json] [--tolerance 0.1]
+
+Each benchmark reports operations per second, and frame benchmarks also the
+50th and 99th percentile frame time. Memory allocated per run (peak and number
+of blocks, from tracemalloc) is measured in a separate run so that it does
+not slow down the timing. Given a baseline from an earlier --save, results
+more than 'tolerance' slower are listed and the exit status is 1.
+
+The tile lookup loop is the part of a paint which does not need wx: for
+each visible tile the key, a bitmap cache lookup and, on a miss, getTile
+and a store read. It stands in for neither decoding nor drawing, stand-in
+tiles, prefetching or revalidation. "cold" starts with an empty bitmap
+cache and a store which has not indexed its tiles yet; "warm" has both
+filled.
+
+If wx is installed and there is a display (e.g. under xvfb-run), the widget
+paint benchmark drives the real paint path - TileBackBuffer and
+WxMapWidget.drawTile, with decoding on the decoder threads, stand-ins,
+prefetching and revalidation - into a memory DC, and the offscreen renderer
+is timed as well. Otherwise those are skipped, with a note.
+
+Results depend on the machine, so no baseline is kept with the code. CI
+saves one from the target branch and compares the change with it, on the
+same runner:
+
+    git checkout main && python benchmark.py --quick --save /tmp/baseline.json
+    git checkout - && python benchmark.py --quick --baseline /tmp/baseline.json
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import tracemalloc
+
+scriptPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptPath)
+
+import numpy
+
+from tilenames import latlon2xy, latlon2xy_many, numTiles
+from projection import Projection
+from tiles import Tiles, TileService, MapSource, LimitedSizeDict
+from tilestore import DirectoryTileStore
+from bitmapcache import BitmapCache
+from track import TrackStore
+from simplify import SimplificationPyramid
+from tileserver import syntheticPNG
+
+CENTRE = (32.10932741542229, 34.89818882620658)
+ZOOM = 15
+VIEWPORTS = ((640, 480), (1920, 1080), (3840, 2160))
+TRACK_LENGTHS = (1000, 100000)
+
+
+#------------------------------------------------------------------------------------------
+
+def buildCache(topLevel, mapSource, zoom = ZOOM, radius = 12):
+    ''' Fill a directory store with tiles around CENTRE. Returns the number written '''
+    store = DirectoryTileStore.forSource(topLevel, mapSource)
+    cx, cy = (int(v) for v in latlon2xy(CENTRE[0], CENTRE[1], zoom))
+    tiles = [syntheticPNG(i) for i in range(16)]
+    count = 0
+
+    for x in range(cx - radius, cx + radius + 1):
+        for y in range(cy - radius, cy + radius + 1):
+            store.write(x % int(numTiles(zoom)), y, zoom, tiles[count % len(tiles)])
+            count += 1
+
+    store.close()
+    return count
+
+
+#==============================================================================
+class Benchmark:
+
+    def __init__(self, quick = False):
+        self.quick = quick
+        self.results = {}
+        self.cacheTopLevel = tempfile.mkdtemp(prefix = 'wxmapwidget-bench-')
+        self.mapSource = MapSource.mapSources["OSM_GPS_MAP_SOURCE_OPENSTREETMAP"]
+        self.tileCount = buildCache(self.cacheTopLevel, self.mapSource)
+        self.tiles = None
+
+    #--------------------------------------------
+    def close(self):
+        self.closeTiles()
+        shutil.rmtree(self.cacheTopLevel, ignore_errors = True)
+
+    #--------------------------------------------
+    def measure(self, name, run, ops = 1, repeat = 5, setup = None):
+        ''' Time run() - which does 'ops' operations - best of 'repeat' runs.
+            setup(), if given, is called before every run and not timed '''
+        if self.quick: repeat = min(repeat, 2)
+        times = []
+
+        for _i in range(repeat):
+            state = setup() if setup else None
+            start = time.perf_counter()
+            run(state) if setup else run()
+            times.append(time.perf_counter() - start)
+
+        state = setup() if setup else None
+        tracemalloc.start()
+        run(state) if setup else run()
+        _current, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+
+        best = min(times)
+        self.results[name] = {'opsPerSecond': ops / best if best else float('inf'), 'seconds': best,
+                              'peakBytes': peak, 'blocks': blocks}
+        self.report(name)
+
+    #--------------------------------------------
+    def measureFrames(self, name, frame, frames, setup = None):
+        ''' Time each call of frame(state, i) separately, for percentiles '''
+        state = setup() if setup else None
+        times = []
+        for i in range(frames):
+            start = time.perf_counter()
+            frame(state, i)
+            times.append(time.perf_counter() - start)
+
+        state = setup() if setup else None
+        tracemalloc.start()
+        for i in range(frames): frame(state, i)
+        _current, peak = tracemalloc.get_traced_memory()
+        blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+        tracemalloc.stop()
+
+        times = numpy.array(times) * 1000
+        self.results[name] = {'opsPerSecond': frames / (times.sum() / 1000), 'p50ms': float(numpy.percentile(times, 50)),
+                              'p99ms': float(numpy.percentile(times, 99)), 'peakBytes': peak, 'blocks': blocks}
+        self.report(name)
+
+    #--------------------------------------------
+    def report(self, name):
+        result = self.results[name]
+        frames = f"  p50 {result['p50ms']:.3f} ms  p99 {result['p99ms']:.3f} ms" if 'p50ms' in result else ''
+        print(f"{name:48s} {result['opsPerSecond']:14,.0f} /s{frames}  peak {result['peakBytes'] / 1024:,.0f} KiB")
+
+    #--------------------------------------------
+    def newTiles(self):
+        ''' Tiles on the benchmark cache. The ones made before are closed - only one is in use at a time '''
+        self.closeTiles()
+        self.tiles = Tiles(downloaders = 0, cacheTopLevel = self.cacheTopLevel, mapSource = self.mapSource)
+        self.tiles.revalidate = False
+        return self.tiles
+
+    def closeTiles(self):
+        if self.tiles is not None:
+            self.tiles.close()
+            self.tiles = None
+
+    #--------------------------------------------
+    def newProjection(self, width, height):
+        projection = Projection()
+        projection.setView(0, 0, width, height)
+        projection.recentre(CENTRE[0], CENTRE[1], ZOOM)
+        return projection
+
+    #==========================================
+    def projection(self):
+        n = 20000 if self.quick else 200000
+        lats = numpy.random.default_rng(1).uniform(-60, 60, n)
+        lons = numpy.random.default_rng(2).uniform(-180, 180, n)
+        latList, lonList = lats.tolist(), lons.tolist()
+
+        def scalar():
+            for lat, lon in zip(latList, lonList): latlon2xy(lat, lon, ZOOM)
+        self.measure('tilenames.latlon2xy', scalar, n)
+        self.measure('tilenames.latlon2xy_many', lambda: latlon2xy_many(lats, lons, ZOOM), n)
+
+        projection = self.newProjection(1920, 1080)
+        def ll2xy():
+            for lat, lon in zip(latList, lonList): projection.ll2xy(lat, lon)
+        self.measure('Projection.ll2xy', ll2xy, n)
+        self.measure('Projection.ll2xy_array', lambda: projection.ll2xy_array(lats, lons), n)
+
+        edges = n // 10
+        def findEdges():
+            for i in range(edges):
+                projection.lat = CENTRE[0] + (i % 100) * 1e-4
+                projection.findEdges()
+        self.measure('Projection.findEdges', findEdges, edges)
+
+    #==========================================
+    def cacheLookups(self):
+        cx, cy = (int(v) for v in latlon2xy(CENTRE[0], CENTRE[1], ZOOM))
+        coordinates = [(cx + dx, cy + dy) for dx in range(-8, 9) for dy in range(-8, 9)] * (5 if self.quick else 50)
+
+        def lookups(tiles):
+            for x, y in coordinates: tiles.searchCache(x, y, ZOOM)
+
+        def warmTiles():
+            tiles = self.newTiles()
+            for x, y in coordinates[:289]: tiles.searchCache(x, y, ZOOM)
+            waitForIndex(tiles.tileStore, ZOOM)
+            return tiles
+
+        self.measure('Tiles.searchCache cold', lookups, len(coordinates), setup = self.newTiles)
+        self.measure('Tiles.searchCache warm', lookups, len(coordinates), setup = warmTiles)
+
+        def getTiles(tiles):
+            for x, y in coordinates: tiles.getTile(x, y, ZOOM)
+        self.measure('Tiles.getTile warm', getTiles, len(coordinates), setup = warmTiles)
+
+        n = 20000 if self.quick else 200000
+        def churn():
+            cache = LimitedSizeDict(size_limit = 256)
+            for i in range(n):
+                cache[i % 1024] = i
+                cache.get((i * 7) % 1024)
+        self.measure('LimitedSizeDict churn', churn, n)
+
+        def bitmapCache():
+            cache = BitmapCache(maxBytes = 256, sizeOf = lambda _bitmap: 1)
+            for i in range(n):
+                key = (i * 7) % 1024
+                if cache.lookup(key)[0] is None: cache.put(key, i)
+        self.measure('BitmapCache lookup/put', bitmapCache, n)
+
+    #==========================================
+    def tileLoop(self):
+        ''' Key, bitmap cache and store lookups for every visible tile - no wx, so no decoding or drawing '''
+        frames = 30 if self.quick else 300
+
+        for width, height in VIEWPORTS:
+            def setup(warm):
+                tiles = self.newTiles()
+                projection = self.newProjection(width, height)
+                cache = BitmapCache(maxBytes = 4096, sizeOf = lambda _bitmap: 1)
+                if warm:
+                    frame((tiles, projection, cache), 0)
+                    waitForIndex(tiles.tileStore, ZOOM)
+                return tiles, projection, cache
+
+            def frame(state, i):
+                tiles, projection, cache = state
+                # Pan a few pixels each frame, like dragging the map
+                projection.nudge(3 if i % 200 < 100 else -3, 1 if i % 50 < 25 else -1)
+                for x in range(int(projection.px1), int(projection.px2) + 1):
+                    for y in range(int(projection.py1), int(projection.py2) + 1):
+                        key = tiles.fileName(x, y, projection.zoom)
+                        bitmap, _provisional = cache.lookup(key)
+                        if bitmap is None and tiles.getTile(x, y, projection.zoom):
+                            cache.put(key, tiles.tileStore.read(x, y, projection.zoom))
+
+            self.measureFrames(f'tile lookup loop cold {width}x{height}', frame, frames, lambda: setup(False))
+            self.measureFrames(f'tile lookup loop warm {width}x{height}', frame, frames, lambda: setup(True))
+
+    #==========================================
+    def widgetPaint(self):
+        ''' The widget's own tile paint - TileBackBuffer and WxMapWidget.drawTile - while panning '''
+        app = startApp('widget paint')
+        if app is None: return
+
+        import wx
+        from wxmapwidget import WxMapWidget
+
+        service = TileService(downloaders = 0)
+        frames = 30 if self.quick else 300
+
+        for width, height in VIEWPORTS[:2]:
+            window = wx.Frame(None, size = (width, height))
+            widget = WxMapWidget(window, CENTRE[0], CENTRE[1], ZOOM, tileService = service,
+                                 cacheTopLevel = self.cacheTopLevel)
+            widget.setMapSource(self.mapSource)
+            target = wx.Bitmap(width, height)
+
+            def setup():
+                widget.cachedTileBitmaps.clear()
+                widget.backBuffer.invalidate()
+                widget.setView(0, 0, width, height)
+                widget.recentre(CENTRE[0], CENTRE[1], ZOOM)
+                return widget
+
+            def frame(widget, i):
+                widget.nudge(3 if i % 200 < 100 else -3, 1 if i % 50 < 25 else -1)
+                dc = wx.MemoryDC(target)
+                widget.backBuffer.draw(dc, widget)
+                dc.SelectObject(wx.NullBitmap)
+                # Install the tiles decoded meanwhile, as the event loop would
+                app.ProcessPendingEvents()
+
+            self.measureFrames(f'widget paint {width}x{height}', frame, frames, setup)
+            window.Destroy()
+
+        service.shutdown()
+
+    #==========================================
+    def tracks(self):
+        for length in TRACK_LENGTHS:
+            rng = numpy.random.default_rng(length)
+            lats = CENTRE[0] + numpy.cumsum(rng.normal(0, 1e-5, length))
+            lons = CENTRE[1] + numpy.cumsum(rng.normal(0, 1e-5, length))
+
+            def append():
+                track = TrackStore()
+                for i, (lat, lon) in enumerate(zip(lats.tolist(), lons.tolist())): track.append(float(i), lat, lon)
+                return track
+            self.measure(f'TrackStore.append {length}', append, length, repeat = 3)
+
+            track = append()
+            projection = self.newProjection(1920, 1080)
+
+            def screen(i):
+                projection.nudge(2, 1)
+                track.screen(projection)
+            self.measureFrames(f'track screen {length}', lambda _state, i: screen(i), 30 if self.quick else 200)
+
+            def simplify(i):
+                SimplificationPyramid(track).indices(ZOOM - i % 6)
+            self.measureFrames(f'track simplify {length}', lambda _state, i: simplify(i), 6 if self.quick else 24)
+
+    #==========================================
+    def offscreen(self):
+        if startApp('offscreen render') is None: return
+
+        from offscreen import OffscreenRenderer
+
+        renderer = OffscreenRenderer(downloaders = 0, mapSource = self.mapSource, download = False,
+                                     cacheTopLevel = self.cacheTopLevel)
+
+        for width, height in VIEWPORTS[:2]:
+            self.measureFrames(f'offscreen render {width}x{height}',
+                               lambda _state, i: renderer.render(CENTRE[0], CENTRE[1] + i * 1e-4, ZOOM, width, height),
+                               10 if self.quick else 50)
+
+        renderer.map.close()
+
+    #--------------------------------------------
+    def runAll(self):
+        for suite in (self.projection, self.cacheLookups, self.tileLoop, self.widgetPaint, self.tracks, self.offscreen):
+            suite()
+
+        return {'python': platform.python_version(), 'platform': platform.platform(), 'time': time.time(),
+                'quick': self.quick, 'results': self.results}
+
+
+#------------------------------------------------------------------------------------------
+
+def startApp(benchmark):
+    ''' The wx.App, or None - after saying why the benchmark is skipped - if wx is not
+        installed or cannot start, e.g. on a CI machine with no display '''
+    try:
+        import wx
+        from offscreen import ensureApp
+    except ImportError:
+        print(f'wx not available - skipping the {benchmark} benchmark')
+        return None
+
+    if sys.platform.startswith('linux') and not (os.environ.get('DISPLAY') or os.environ.get('WAYLAND_DISPLAY')):
+        print(f'No display - skipping the {benchmark} benchmark (run it under xvfb-run to include it)')
+        return None
+
+    try:
+        return ensureApp()
+    except (Exception, SystemExit) as e:
+        print(f'wx could not start ({e}) - skipping the {benchmark} benchmark')
+        return None
+
+#------------------------------------------------------------------------------------------
+
+def waitForIndex(store, z, timeout = 10):
+    deadline = time.monotonic() + timeout
+    store.has(0, 0, z)
+    while z not in store.indexReady and time.monotonic() < deadline:
+        time.sleep(0.001)
+
+#------------------------------------------------------------------------------------------
+
+def compare(results, baseline, tolerance = 0.1):
+    ''' Names of the benchmarks more than 'tolerance' slower than the baseline, with the ratio '''
+    regressions = []
+    for name, result in results['results'].items():
+        before = baseline['results'].get(name)
+        if before is None: continue
+
+        ratio = result['opsPerSecond'] / before['opsPerSecond']
+        change = f"{(ratio - 1) * 100:+.1f}%"
+        if 'p99ms' in result and 'p99ms' in before:
+            change += f"  p99 {before['p99ms']:.3f} -> {result['p99ms']:.3f} ms"
+        print(f"{name:48s} {change}")
+
+        if ratio < 1 - tolerance: regressions.append((name, ratio))
+
+    return regressions
+
+#------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Benchmark the map widget hot paths')
+    parser.add_argument('--quick', action = 'store_true', help = 'fewer iterations, for a quick check')
+    parser.add_argument('--save', help = 'write the results to this JSON file')
+    parser.add_argument('--baseline', help = 'compare with results saved earlier')
+    parser.add_argument('--tolerance', type = float, default = 0.1, help = 'slow-down counted as a regression')
+    args = parser.parse_args()
+
+    if args.baseline and not os.path.exists(args.baseline):
+        # Checked first, rather than after the whole run
+        parser.error(f'no baseline at {args.baseline} - save one from an earlier run with --save')
+
+    benchmark = Benchmark(args.quick)
+    try:
+        results = benchmark.runAll()
+    finally:
+        benchmark.close()
+
+    if args.save:
+        with open(args.save, 'w') as fl:
+            json.dump(results, fl, indent = 2)
+
+    if args.baseline:
+        with open(args.baseline) as fl:
+            baseline = json.load(fl)
+        print()
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'\n{len(regressions)} benchmarks slower than the baseline')
+            sys.exit(1)
@@ -0,0 +1,124 @@
+'''
+LRU cache of decoded tile bitmaps, bounded by the memory the decoded
+bitmaps take up rather than by the number of entries.
+
+One cache is shared by all map widgets, so every operation takes a lock.
+
+Entries may be provisional - stand-ins synthesised from other zoom levels.
+A provisional entry never replaces a real one, and is replaced as soon as
+the real bitmap is put.
+'''
+
+import threading
+from collections import OrderedDict
+
+
+#------------------------------------------------------------------------------------------
+
+def bitmapBytes(bitmap):
+    ''' Decoded size of a wx.Bitmap (or anything with GetWidth/GetHeight), assuming 32 bits per pixel '''
+    return bitmap.GetWidth() * bitmap.GetHeight() * 4
+
+
+#==============================================================================
+class BitmapCache:
+
+    def __init__(self, maxBytes = 64 * 1024 * 1024, sizeOf = bitmapBytes):
+        self.maxBytes = maxBytes
+        self.sizeOf = sizeOf
+        self.lock = threading.RLock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = 0
+
+    #--------------------------------------------
+    def get(self, key, default = None):
+        bitmap, _provisional = self.lookup(key)
+        return default if bitmap is None else bitmap
+
+    #--------------------------------------------
+    def lookup(self, key):
+        ''' Returns (bitmap, provisional), or (None, False) if not cached '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[2]
+
+    #--------------------------------------------
+    def peek(self, key):
+        ''' Like get, but does not count as a use of the entry '''
+        with self.lock:
+            entry = self.entries.get(key)
+            return None if entry is None else entry[0]
+
+    #--------------------------------------------
+    def put(self, key, bitmap, provisional = False):
+        size = self.sizeOf(bitmap)
+
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None:
+                if provisional and not old[2]: return
+                del self.entries[key]
+                self.bytes -= old[1]
+
+            self.entries[key] = (bitmap, size, provisional)
+            self.bytes += size
+            self.evict()
+
+    #--------------------------------------------
+    def discard(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None: self.bytes -= old[1]
+
+    #--------------------------------------------
+    def evict(self):
+        # Always keep the newest entry, even if it alone is over budget
+        while self.bytes > self.maxBytes and len(self.entries) > 1:
+            _key, (_bitmap, size, _provisional) = self.entries.popitem(last = False)
+            self.bytes -= size
+            self.evictions += 1
+
+    #--------------------------------------------
+    def setBudget(self, maxBytes):
+        with self.lock:
+            self.maxBytes = maxBytes
+            self.evict()
+
+    def ensureBudget(self, maxBytes):
+        ''' Grow (never shrink) the budget, e.g. so a new viewport fits '''
+        with self.lock:
+            if maxBytes > self.maxBytes: self.maxBytes = maxBytes
+
+    #--------------------------------------------
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    #--------------------------------------------
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries),
+                    'bytes': self.bytes,
+                    'maxBytes': self.maxBytes,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'hitRate': self.hits / lookups if lookups else None}
+
+    #--------------------------------------------
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
@@ -0,0 +1,312 @@
+'''
+Keeps the tile cache on disk within size limits.
+
+A CacheManager keeps its own SQLite index of every cached tile - source,
+zoom, x, y, size and the time it was last used - next to the cache, so it
+never has to walk the cache tree except once, the first time it sees a map
+source. Stores attached to it report reads, writes and removals; these are
+collected in memory and written to the index in batches by a background
+thread, which then evicts the least recently used tiles of any source over
+its quota, and then across all sources if the global quota is exceeded.
+Eviction goes down to 'lowWater' of the quota so it does not run for every
+new tile.
+
+Tiles on screen (plus the download ring) and recently prefetched tiles are
+never evicted; Tiles reports them through protect().
+
+    manager = CacheManager('~/.cache/osmgpsmap', globalQuota = 2 << 30,
+                           sourceQuotas = {'OSM_GPS_MAP_SOURCE_VIRTUAL_EARTH_SATELLITE': 512 << 20})
+    Tiles.__init__(self, callback, cacheManager = manager)
+'''
+
+import os
+import time
+import sqlite3
+import threading
+import logging
+
+logger = logging.getLogger('wxmapwidget')
+
+
+#==============================================================================
+class CacheManager:
+
+    def __init__(self, cacheTopLevel, globalQuota = None, sourceQuotas = None, lowWater = 0.9,
+                 flushInterval = 2.0, evictBatch = 256):
+        ''' Quotas are in bytes; None means no limit '''
+        self.cacheTopLevel = os.path.expanduser(cacheTopLevel)
+        self.globalQuota = globalQuota
+        self.sourceQuotas = dict(sourceQuotas or {})
+        self.lowWater = lowWater
+        self.flushInterval = flushInterval
+        self.evictBatch = evictBatch
+
+        self.stores = {}
+        self.protected = {}
+        self.lock = threading.Lock()
+
+        # (source, z, x, y) -> (size or None for a read, time), or None for a removal
+        self.pending = {}
+
+        self.hits = {}
+        self.misses = {}
+        self.evicted = {}
+
+        if not os.path.exists(self.cacheTopLevel): os.makedirs(self.cacheTopLevel, exist_ok = True)
+
+        self.dbLock = threading.Lock()
+        self.db = sqlite3.connect(os.path.join(self.cacheTopLevel, 'cacheindex.sqlite'), check_same_thread = False)
+        with self.dbLock, self.db:
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS tiles (source TEXT, z INTEGER, x INTEGER, y INTEGER, '
+                            'size INTEGER, used REAL, PRIMARY KEY (source, z, x, y)) WITHOUT ROWID')
+            # Eviction pages through tiles in this order - 'used' alone is not unique
+            self.db.execute('DROP INDEX IF EXISTS tiles_used')
+            self.db.execute('CREATE INDEX IF NOT EXISTS tiles_lru ON tiles (used, source, z, x, y)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS sources (source TEXT PRIMARY KEY)')
+
+            # source -> [bytes, tiles], kept up to date as the index changes
+            self.totals = {source: [size, count] for source, size, count in
+                           self.db.execute('SELECT source, SUM(size), COUNT(*) FROM tiles GROUP BY source')}
+            self.indexed = {source for (source,) in self.db.execute('SELECT source FROM sources')}
+
+        self.stopEvent = threading.Event()
+        self.thread = threading.Thread(target = self.run, name = 'Tile cache manager', daemon = True)
+        self.thread.start()
+
+    #--------------------------------------------
+    def attach(self, store, source):
+        ''' Manage a tile store, under the name of its map source '''
+        store.cacheManager = self
+        store.cacheName = source
+
+        with self.lock:
+            self.stores[source] = store
+            first = source not in self.indexed
+            self.indexed.add(source)
+
+        if first:
+            threading.Thread(target = self.importStore, args = (store, source),
+                             name = f'Cache index import {source}', daemon = True).start()
+
+    #--------------------------------------------
+    def importStore(self, store, source):
+        ''' Add every tile already in a store to the index. Done once per source '''
+        count = 0
+        rows = []
+
+        try:
+            for x, y, z, size, used in store.tileSizes():
+                rows.append((source, z, x, y, size, used))
+                if len(rows) >= 4096:
+                    count += self.insertRows(rows)
+                    rows = []
+            count += self.insertRows(rows)
+
+            with self.dbLock, self.db:
+                self.db.execute('INSERT OR IGNORE INTO sources VALUES (?)', (source,))
+
+        except Exception as e:
+            logger.exception(e)
+
+        logger.debug(f'Indexed {count} cached tiles of {source}')
+
+    #--------------------------------------------
+    def insertRows(self, rows):
+        added = 0
+        with self.dbLock, self.db:
+            for row in rows:
+                cursor = self.db.execute('INSERT OR IGNORE INTO tiles VALUES (?, ?, ?, ?, ?, ?)', row)
+                if cursor.rowcount:
+                    self.addTotal(row[0], row[4], 1)
+                    added += 1
+        return added
+
+    #--------------------------------------------
+    def addTotal(self, source, size, count):
+        total = self.totals.setdefault(source, [0, 0])
+        total[0] += size
+        total[1] += count
+
+    #--------------------------------------------
+    # Called by the stores, on any thread
+
+    def touched(self, source, x, y, z):
+        key = (source, z, x, y)
+        now = time.time()
+        with self.lock:
+            if key in self.pending:
+                entry = self.pending[key]
+                # A removal stands - the tile is gone, whatever was read before
+                if entry is None: return
+                self.pending[key] = (entry[0], now)
+            else:
+                self.pending[key] = (None, now)
+
+    def written(self, source, x, y, z, size):
+        with self.lock:
+            self.pending[(source, z, x, y)] = (size, time.time())
+
+    def removed(self, source, x, y, z):
+        with self.lock:
+            self.pending[(source, z, x, y)] = None
+
+    def searched(self, source, found):
+        ''' Count a cache lookup, for the hit rate '''
+        counts = self.hits if found else self.misses
+        with self.lock:
+            counts[source] = counts.get(source, 0) + 1
+
+    #--------------------------------------------
+    def protect(self, owner, source, zoom, x1, y1, x2, y2, extra = ()):
+        ''' Tiles x1..x2, y1..y2 at zoom (and the (x, y, z) in extra) must not be evicted.
+            'extra' is kept, not copied, and looked in at eviction time, so it may be
+            a collection the owner keeps up to date. Replaces what this owner protected before '''
+        with self.lock:
+            self.protected[id(owner)] = (source, zoom, x1, y1, x2, y2, extra)
+
+    def release(self, owner):
+        with self.lock:
+            self.protected.pop(id(owner), None)
+
+    def isProtected(self, source, x, y, z):
+        for psource, pzoom, x1, y1, x2, y2, extra in self.protected.values():
+            if psource != source: continue
+            if pzoom == z and x1 <= x <= x2 and y1 <= y <= y2: return True
+            if (x, y, z) in extra: return True
+        return False
+
+    #--------------------------------------------
+    def flush(self):
+        ''' Write the reads, writes and removals collected so far to the index '''
+        with self.lock:
+            batch, self.pending = self.pending, {}
+
+        if not batch: return
+
+        with self.dbLock, self.db:
+            for key, entry in batch.items():
+                source = key[0]
+                if entry is None:
+                    row = self.db.execute('SELECT size FROM tiles WHERE source=? AND z=? AND x=? AND y=?', key).fetchone()
+                    if row:
+                        self.db.execute('DELETE FROM tiles WHERE source=? AND z=? AND x=? AND y=?', key)
+                        self.addTotal(source, -row[0], -1)
+
+                elif entry[0] is None:
+                    self.db.execute('UPDATE tiles SET used=? WHERE source=? AND z=? AND x=? AND y=?', (entry[1],) + key)
+
+                else:
+                    size, used = entry
+                    row = self.db.execute('SELECT size FROM tiles WHERE source=? AND z=? AND x=? AND y=?', key).fetchone()
+                    self.db.execute('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?, ?, ?)', key + (size, used))
+                    if row: self.addTotal(source, size - row[0], 0)
+                    else: self.addTotal(source, size, 1)
+
+    #--------------------------------------------
+    def totalBytes(self, source = None):
+        if source is not None: return self.totals.get(source, [0, 0])[0]
+        return sum(total[0] for total in self.totals.values())
+
+    #--------------------------------------------
+    def evict(self, source = None):
+        ''' Evict least recently used tiles of one source, or of all attached
+            sources, until under the low water mark. Returns the number evicted '''
+        quota = self.globalQuota if source is None else self.sourceQuotas.get(source)
+        if quota is None or self.totalBytes(source) <= quota: return 0
+
+        target = quota * self.lowWater
+        with self.lock:
+            stores = dict(self.stores)
+        if source is not None and source not in stores: return 0
+
+        evicted = 0
+        
+        # (used, source, z, x, y) of the last tile looked at. Many tiles can share a 'used' 
+        # time - all of them, after an MBTiles import - so page on the whole key
+        after = (-1.0, '', 0, 0, 0)
+
+        while self.totalBytes(source) > target:
+            with self.dbLock:
+                if source is None:
+                    placeholders = ','.join('?' * len(stores))
+                    rows = self.db.execute('SELECT source, z, x, y, size, used FROM tiles '
+                                           f'WHERE (used, source, z, x, y) > (?, ?, ?, ?, ?) AND source IN ({placeholders}) '
+                                           'ORDER BY used, source, z, x, y LIMIT ?', (*after, *stores, self.evictBatch)).fetchall()
+                else:
+                    rows = self.db.execute('SELECT source, z, x, y, size, used FROM tiles '
+                                           'WHERE (used, source, z, x, y) > (?, ?, ?, ?, ?) AND source = ? '
+                                           'ORDER BY used, source, z, x, y LIMIT ?', (*after, source, self.evictBatch)).fetchall()
+
+            # Everything left is protected
+            if not rows: break
+            
+            tileSource, z, x, y, _size, used = rows[-1]
+            after = (used, tileSource, z, x, y)
+
+            victims = []
+            needed = self.totalBytes(source) - target
+            with self.lock:
+                for row in rows:
+                    if needed <= 0: break
+                    if not self.isProtected(row[0], row[2], row[3], row[1]):
+                        victims.append(row)
+                        needed -= row[4]
+
+            with self.dbLock, self.db:
+                for tileSource, z, x, y, size, _used in victims:
+                    self.db.execute('DELETE FROM tiles WHERE source=? AND z=? AND x=? AND y=?', (tileSource, z, x, y))
+                    self.addTotal(tileSource, -size, -1)
+
+            for tileSource, z, x, y, size, _used in victims:
+                try:
+                    stores[tileSource].remove(x, y, z)
+                except Exception as e:
+                    logger.exception(e)
+                self.evicted[tileSource] = self.evicted.get(tileSource, 0) + 1
+                evicted += 1
+
+        if evicted: logger.debug(f'Evicted {evicted} tiles from {source or "the cache"}')
+        return evicted
+
+    #--------------------------------------------
+    def run(self):
+        while not self.stopEvent.wait(self.flushInterval):
+            try:
+                self.flush()
+                for source in list(self.sourceQuotas):
+                    self.evict(source)
+                self.evict()
+                # Removals made by eviction
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    #--------------------------------------------
+    def close(self):
+        self.stopEvent.set()
+        self.thread.join()
+        self.flush()
+        with self.dbLock:
+            self.db.close()
+
+    #--------------------------------------------
+    def stats(self):
+        ''' Size and tile count per source and per zoom level, hit rates and eviction counts '''
+        self.flush()
+
+        with self.dbLock:
+            zooms = self.db.execute('SELECT source, z, COUNT(*), SUM(size) FROM tiles GROUP BY source, z').fetchall()
+
+        sources = {}
+        for source, (size, count) in self.totals.items():
+            hits, misses = self.hits.get(source, 0), self.misses.get(source, 0)
+            sources[source] = {'bytes': size, 'tiles': count, 'quota': self.sourceQuotas.get(source), 'zooms': {},
+                               'hits': hits, 'misses': misses, 'hitRate': hits / (hits + misses) if hits + misses else None,
+                               'evicted': self.evicted.get(source, 0)}
+
+        for source, z, count, size in zooms:
+            sources[source]['zooms'][z] = {'tiles': count, 'bytes': size}
+
+        return {'bytes': self.totalBytes(), 'tiles': sum(total[1] for total in self.totals.values()),
+                'quota': self.globalQuota, 'sources': sources}
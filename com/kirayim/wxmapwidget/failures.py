@@ -0,0 +1,185 @@
+'''
+Remembers failed tile downloads so they are not retried on every paint.
+
+Each failed tile goes into a negative cache for a while - 'notFoundTTL' for
+a 404, otherwise 'retryTTL', doubling with each further failure up to
+'maxTTL'. 'maxTTL' only caps the doubling - a 404 is blocked for its own
+'notFoundTTL'. A tile is forgotten once it has been unblocked for as long
+as it was last blocked, so one failing again soon after its retry gets a
+longer TTL. Server errors, throttling and connection failures also count
+against the map source: after 'threshold' of them in a row the source's
+circuit opens and no requests at all are made to it for 'backoff' seconds,
+doubling each time it opens again, up to 'maxBackoff'. When that time is up
+one probe request is let through; if it succeeds the circuit closes. The
+downloaders ask allow() just before each request, so tiles queued before
+the circuit opened are not sent either. A 404
+or an undecodable tile shows the server is answering, so it starts the
+count of failures in a row again (and closes the circuit, if it was the
+probe).
+'''
+
+import time
+import threading
+import logging
+
+logger = logging.getLogger('wxmapwidget')
+
+
+#==============================================================================
+class SourceState:
+    __slots__ = ('failures', 'openUntil', 'backoff', 'probeStarted', 'probeKey')
+
+    def __init__(self):
+        self.failures = 0
+        self.openUntil = None
+        self.backoff = 0.0
+        self.probeStarted = None
+        self.probeKey = None
+
+
+#==============================================================================
+class FailureTracker:
+
+    def __init__(self, retryTTL = 30.0, notFoundTTL = 3600.0, maxTTL = 1800.0,
+                 threshold = 5, backoff = 10.0, maxBackoff = 600.0, probeTimeout = 60.0):
+        self.retryTTL = retryTTL
+        self.notFoundTTL = notFoundTTL
+        self.maxTTL = maxTTL
+        self.threshold = threshold
+        self.initialBackoff = backoff
+        self.maxBackoff = maxBackoff
+        self.probeTimeout = probeTimeout
+
+        self.lock = threading.Lock()
+        self.tiles = {}      # key -> [blocked until, failures, TTL it was blocked for]
+        self.sources = {}    # source -> SourceState
+        self.refused = 0
+
+    #--------------------------------------------
+    @staticmethod
+    def sourceFault(status):
+        ''' True if a failure says something about the server rather than the tile '''
+        return status is None or status == 429 or status >= 500
+
+    #--------------------------------------------
+    def isBlocked(self, key):
+        with self.lock:
+            entry = self.tiles.get(key)
+            if entry is None: return False
+            if entry[0] > time.monotonic(): return True
+
+            # Expired - allow a retry, but remember the failure count for the next TTL
+            return False
+
+    #--------------------------------------------
+    def probing(self, state, now):
+        ''' Call with the lock held '''
+        return state.probeStarted is not None and now - state.probeStarted < self.probeTimeout
+
+    def isOpen(self, source):
+        ''' True while no request may be made to the source - the circuit is open, or
+            its probe is on its way. Unlike allow(), does not start a probe '''
+        now = time.monotonic()
+
+        with self.lock:
+            state = self.sources.get(source)
+            if state is None or state.openUntil is None: return False
+            return now < state.openUntil or self.probing(state, now)
+
+    def allow(self, source, key = None):
+        ''' May a request for the tile 'key' be made to this source now? While the circuit
+            is open, no; once the backoff is over, yes for exactly one probe request '''
+        now = time.monotonic()
+
+        with self.lock:
+            state = self.sources.get(source)
+            if state is None or state.openUntil is None: return True
+
+            if now < state.openUntil or self.probing(state, now):
+                self.refused += 1
+                return False
+
+            state.probeStarted = now
+            state.probeKey = key
+            return True
+
+    #--------------------------------------------
+    def failed(self, key, source, status = None, retryAfter = None):
+        ''' Record a failed download. status - HTTP status, None for a connection
+            error or timeout, 'undecodable' for a tile which could not be decoded '''
+        now = time.monotonic()
+
+        with self.lock:
+            entry = self.tiles.setdefault(key, [0.0, 0, 0.0])
+            entry[1] += 1
+            if status == 404:
+                ttl = self.notFoundTTL
+            else:
+                ttl = min(self.maxTTL, self.retryTTL * 2 ** (entry[1] - 1))
+            entry[0] = now + ttl
+            entry[2] = ttl
+
+            if source is None: return
+
+            if status == 'undecodable' or not self.sourceFault(status):
+                # The server answered, so the failures in a row so far were not the server's fault
+                state = self.sources.get(source)
+                if state is None: return
+                if state.probeStarted is not None:
+                    logger.info(f'Tile source {source} is back')
+                    del self.sources[source]
+                else:
+                    state.failures = 0
+                return
+
+            state = self.sources.setdefault(source, SourceState())
+            state.failures += 1
+            probing = state.probeStarted is not None and state.probeKey == key
+            if probing: state.probeStarted = state.probeKey = None
+
+            if not probing and state.openUntil is not None and (state.openUntil > now or state.probeStarted is not None):
+                # Requests already on their way when the circuit opened, or while its probe is
+                if retryAfter: state.openUntil = max(state.openUntil, now + retryAfter)
+                return
+
+            if probing or state.failures >= self.threshold or retryAfter:
+                state.backoff = min(self.maxBackoff, state.backoff * 2 if state.backoff else self.initialBackoff)
+                state.openUntil = now + max(state.backoff, retryAfter or 0)
+                logger.warning(f'Tile source {source} failing (HTTP {status}) - pausing requests for {state.openUntil - now:.0f}s')
+
+    #--------------------------------------------
+    def succeeded(self, key, source):
+        with self.lock:
+            self.tiles.pop(key, None)
+
+            state = self.sources.get(source)
+            if state is not None:
+                if state.openUntil is not None: logger.info(f'Tile source {source} is back')
+                del self.sources[source]
+
+    #--------------------------------------------
+    def dropped(self, source, key):
+        ''' The request for the tile 'key' was not made after all - if it was the probe, allow another '''
+        with self.lock:
+            state = self.sources.get(source)
+            if state is not None and state.probeStarted is not None and state.probeKey == key:
+                state.probeStarted = state.probeKey = None
+
+    #--------------------------------------------
+    def expire(self):
+        ''' Forget tiles which have been unblocked for as long as they were last blocked '''
+        now = time.monotonic()
+        with self.lock:
+            for key in [key for key, entry in self.tiles.items() if entry[0] + entry[2] < now]:
+                del self.tiles[key]
+
+    #--------------------------------------------
+    def stats(self):
+        now = time.monotonic()
+        with self.lock:
+            blocked = sum(1 for entry in self.tiles.values() if entry[0] > now)
+            sources = {source: {'failures': state.failures,
+                                'open': state.openUntil is not None and state.openUntil > now,
+                                'retryIn': max(0.0, state.openUntil - now) if state.openUntil else 0.0}
+                       for source, state in self.sources.items()}
+            return {'blockedTiles': blocked, 'failedTiles': len(self.tiles), 'refused': self.refused, 'sources': sources}
@@ -0,0 +1,57 @@
+'''
+Cached rendering surface for a SlippyLayer.
+
+The layer is drawn once into a transparent bitmap 'margin' pixels larger
+than the view on each side, with the projection temporarily widened to
+match. After that the bitmap is just composited: moved along with the map
+while panning, and drawn again only when the layer's revision changes
+(SlippyLayer.invalidate), the zoom or view size changes, or the view has
+panned past the margin.
+'''
+
+import math
+
+import wx
+
+
+#==============================================================================
+class LayerSurface:
+
+    def __init__(self, margin = 256):
+        self.margin = margin
+        self.bitmap = None
+        self.zoom = self.revision = None
+        self.originX = self.originY = 0
+        self.renders = 0
+
+    #--------------------------------------------
+    def draw(self, dc, projection, layer):
+        viewX = int(math.floor(projection.px1 * projection.scale))
+        viewY = int(math.floor(projection.py1 * projection.scale))
+        width = projection.w + 2 * self.margin
+        height = projection.h + 2 * self.margin
+
+        if self.bitmap is None or self.bitmap.GetWidth() != width or self.bitmap.GetHeight() != height or \
+                self.zoom != projection.zoom or self.revision != layer.revision or \
+                not (0 <= viewX - self.originX <= 2 * self.margin and 0 <= viewY - self.originY <= 2 * self.margin):
+            self.render(projection, layer, viewX - self.margin, viewY - self.margin, width, height)
+
+        dc.DrawBitmap(self.bitmap, self.originX - viewX, self.originY - viewY, True)
+
+    #--------------------------------------------
+    def render(self, projection, layer, originX, originY, width, height):
+        image = wx.Image(width, height)
+        image.InitAlpha()
+        image.SetAlpha(bytes(width * height))
+        self.bitmap = wx.Bitmap(image)
+
+        memoryDC = wx.MemoryDC(self.bitmap)
+        dc = wx.GCDC(memoryDC)
+        with projection.expandedView(self.margin):
+            layer.do_draw(projection, dc)
+        del dc
+        memoryDC.SelectObject(wx.NullBitmap)
+
+        self.zoom, self.revision = projection.zoom, layer.revision
+        self.originX, self.originY = originX, originY
+        self.renders += 1
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+'''
+End-to-end load test of the download pipeline against the local TileServer.
+
+A scripted session of pans and zooms is played through a Projection and
+Tiles (and optionally the Prefetcher), the way the widget would: at each
+frame the viewport is reported to Tiles and every visible tile is asked for
+with getTile. For every step the test records how long it took until every
+visible tile was in the cache ("time to full viewport"). At the end it
+reports request counts, tiles downloaded which were never on screen
+("wasted"), duplicate downloads and the pipeline's own stats.
+
+    python loadtest.py [--session mixed] [--latency 0.05] [--bandwidth 200000] [--errors 0.02]
+                       [--downloaders 4] [--per-host 2] [--prefetch] [--json results.json]
+
+Sessions are lists of steps:
+    ('goto', lat, lon, zoom)   - jump there
+    ('pan', dx, dy, seconds)   - drag by dx, dy pixels over that many seconds
+    ('zoom', delta)            - zoom in (+) or out (-) about the centre
+    ('wait', seconds)          - stay put
+'''
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+
+scriptPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptPath)
+
+from projection import Projection
+from tiles import Tiles
+from prefetch import Prefetcher
+from tileserver import TileServer
+from tilenames import numTiles
+
+SESSIONS = {
+    'pan':   [('goto', 32.1093, 34.8982, 15), ('pan', 600, 0, 1.0), ('pan', 0, 400, 0.5),
+              ('pan', -900, -200, 1.5), ('pan', 300, 300, 0.5)],
+    'zoom':  [('goto', 32.1093, 34.8982, 12), ('zoom', 1), ('zoom', 1), ('zoom', 1), ('zoom', -2), ('zoom', 3)],
+    'mixed': [('goto', 32.1093, 34.8982, 14), ('pan', 500, 100, 1.0), ('zoom', 1), ('pan', -300, 250, 0.5),
+              ('zoom', -2), ('wait', 0.5), ('pan', 800, 0, 2.0), ('zoom', 2), ('pan', 0, -600, 1.0)],
+}
+
+
+#==============================================================================
+class LoadTest:
+
+    def __init__(self, server, width = 1280, height = 800, fps = 30, downloaders = 4, maxPerHost = 2,
+                 prefetch = False, settle = 10.0):
+        ''' settle - most seconds to wait for the viewport to fill after each step '''
+        self.server = server
+        self.fps = fps
+        self.settle = settle
+        self.cacheTopLevel = tempfile.mkdtemp(prefix = 'wxmapwidget-load-')
+
+        self.tiles = Tiles(downloaders = downloaders, maxPerHost = maxPerHost, cacheTopLevel = self.cacheTopLevel,
+                           mapSource = server.mapSource())
+        self.prefetcher = Prefetcher(self.tiles) if prefetch else None
+
+        self.projection = Projection()
+        self.projection.setView(0, 0, width, height)
+        self.everVisible = set()
+
+    #--------------------------------------------
+    def close(self):
+        self.tiles.close()
+        shutil.rmtree(self.cacheTopLevel, ignore_errors = True)
+
+    #--------------------------------------------
+    def visibleTiles(self):
+        p = self.projection
+        limit = int(numTiles(p.zoom))
+        return [(x % limit, y, p.zoom) for x in range(int(p.px1), int(p.px2) + 1)
+                for y in range(int(p.py1), int(p.py2) + 1) if 0 <= y < limit]
+
+    #--------------------------------------------
+    def frame(self):
+        ''' What one paint does. Returns the number of visible tiles not in the cache yet '''
+        p = self.projection
+        self.tiles.setViewport(p.zoom, p.px1, p.py1, p.px2, p.py2)
+        if self.prefetcher: self.prefetcher.update(p, (p.w / 2, p.h / 2))
+
+        missing = 0
+        for x, y, z in self.visibleTiles():
+            self.everVisible.add((x, y, z))
+            if not self.tiles.getTile(x, y, z): missing += 1
+        return missing
+
+    #--------------------------------------------
+    def waitForViewport(self, started):
+        ''' Keep painting until the viewport is full. Seconds it took, or None if it did not fill '''
+        deadline = time.monotonic() + self.settle
+        while time.monotonic() < deadline:
+            if self.frame() == 0: return time.monotonic() - started
+            time.sleep(1 / self.fps)
+        return None
+
+    #--------------------------------------------
+    def step(self, step):
+        kind, *args = step
+        p = self.projection
+        started = time.monotonic()
+
+        if kind == 'goto':
+            p.recentre(*args)
+        elif kind == 'zoom':
+            p.setZoom(args[0], isAdjustment = True)
+        elif kind == 'wait':
+            end = started + args[0]
+            while time.monotonic() < end:
+                self.frame()
+                time.sleep(1 / self.fps)
+            started = time.monotonic()
+        elif kind == 'pan':
+            dx, dy, seconds = args
+            frames = max(1, int(seconds * self.fps))
+            for i in range(frames):
+                stepX = dx * (i + 1) // frames - dx * i // frames
+                stepY = dy * (i + 1) // frames - dy * i // frames
+                p.nudge(stepX, stepY)
+                if self.prefetcher: self.prefetcher.panned(stepX, stepY)
+                self.frame()
+                time.sleep(1 / self.fps)
+            # Time to full viewport counts from the end of the drag
+            started = time.monotonic()
+        else:
+            raise ValueError(f'Unknown session step {step}')
+
+        return {'step': list(step), 'zoom': p.zoom, 'timeToFull': self.waitForViewport(started)}
+
+    #--------------------------------------------
+    def run(self, session):
+        self.server.reset()
+        started = time.monotonic()
+        steps = [self.step(step) for step in session]
+        self.tiles.queue.join()
+
+        served = set(self.server.tilesServed)
+        fills = [s['timeToFull'] for s in steps if s['timeToFull'] is not None]
+        server = self.server.stats()
+
+        return {'seconds': time.monotonic() - started,
+                'steps': steps,
+                'incompleteSteps': len(steps) - len(fills),
+                'meanTimeToFull': sum(fills) / len(fills) if fills else None,
+                'maxTimeToFull': max(fills) if fills else None,
+                'requests': server['requests'],
+                'downloaded': len(served),
+                'wasted': len(served - self.everVisible),
+                'duplicates': server['duplicates'],
+                'server': server,
+                'prefetch': self.prefetcher.stats() if self.prefetcher else None,
+                'pipeline': self.tiles.stats()}
+
+
+#------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Drive the tile download pipeline against a local test server')
+    parser.add_argument('--session', default = 'mixed', choices = sorted(SESSIONS))
+    parser.add_argument('--latency', type = float, default = 0.05, help = 'seconds per response')
+    parser.add_argument('--jitter', type = float, default = 0.02)
+    parser.add_argument('--bandwidth', type = float, default = None, help = 'bytes per second per response')
+    parser.add_argument('--errors', type = float, default = 0.0, help = 'fraction of requests failing with 503')
+    parser.add_argument('--max-connections', type = int, default = None)
+    parser.add_argument('--downloaders', type = int, default = 4)
+    parser.add_argument('--per-host', type = int, default = 2)
+    parser.add_argument('--prefetch', action = 'store_true')
+    parser.add_argument('--size', default = '1280x800')
+    parser.add_argument('--json', help = 'write the full results to this file')
+    args = parser.parse_args()
+
+    width, height = (int(v) for v in args.size.split('x'))
+    with TileServer(latency = args.latency, jitter = args.jitter, bandwidth = args.bandwidth,
+                    errorRate = args.errors, maxConnections = args.max_connections) as server:
+        test = LoadTest(server, width, height, downloaders = args.downloaders, maxPerHost = args.per_host,
+                        prefetch = args.prefetch)
+        try:
+            results = test.run(SESSIONS[args.session])
+        finally:
+            test.close()
+
+    for step in results['steps']:
+        fill = '-' if step['timeToFull'] is None else f"{step['timeToFull']:.2f} s"
+        print(f"{str(step['step']):40s} zoom {step['zoom']:2d}  full viewport after {fill}")
+
+    print(f"\n{results['requests']} requests, {results['downloaded']} tiles downloaded, {results['wasted']} never shown, "
+          f"{results['duplicates']} downloaded twice, {results['incompleteSteps']} steps never filled")
+    if results['meanTimeToFull'] is not None:
+        print(f"time to full viewport: mean {results['meanTimeToFull']:.2f} s, worst {results['maxTimeToFull']:.2f} s")
+
+    if args.json:
+        with open(args.json, 'w') as fl:
+            json.dump(results, fl, indent = 2, default = str)
@@ -0,0 +1,166 @@
+'''
+Cheap run-time measurements - counters, histograms and gauges - for finding
+out why a map is slow: network, decode, disk or drawing.
+
+Histograms have fixed, roughly logarithmic buckets (1, 2, 5, 10, 20, 50 ...)
+so recording a value is a short bisect plus a few additions under a lock,
+cheap enough to leave on. Percentiles are read from the buckets, so they
+are only as exact as the bucket edges.
+
+    metrics = Metrics()
+    with metrics.timing('paint.tiles'):
+        ...
+    metrics.observe('download.bytes.OSM', len(data))
+    metrics.count('cache.hit')
+    metrics.gauge('queue.depth', queue.qsize)
+    metrics.snapshot()   # a dict, e.g. for logging or JSON
+
+Hooks added with addHook(hook) are called as hook(name, value) for every
+timing and observation, e.g. to feed an external monitoring system.
+'''
+
+import time
+import bisect
+import threading
+import contextlib
+import logging
+
+logger = logging.getLogger('wxmapwidget')
+
+
+#------------------------------------------------------------------------------------------
+
+def bucketEdges(lowest, highest):
+    edges = []
+    decade = lowest
+    while decade <= highest:
+        edges.extend((decade, decade * 2, decade * 5))
+        decade *= 10
+    return edges
+
+
+#==============================================================================
+class Histogram:
+    # Milliseconds from 0.01 to 50 s, or bytes from 1 to 50 MB
+    timeEdges = bucketEdges(0.01, 10000)
+    sizeEdges = bucketEdges(1, 10000000)
+
+    def __init__(self, edges = timeEdges):
+        self.edges = edges
+        self.buckets = [0] * (len(edges) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    #--------------------------------------------
+    def add(self, value):
+        self.buckets[bisect.bisect_left(self.edges, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    #--------------------------------------------
+    def percentile(self, fraction):
+        ''' Upper edge of the bucket holding this fraction of the values '''
+        if not self.count: return None
+        wanted = fraction * self.count
+        seen = 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= wanted:
+                return min(self.edges[i], self.max) if i < len(self.edges) else self.max
+        return self.max
+
+    #--------------------------------------------
+    def summary(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else None,
+                'min': self.min, 'max': self.max, 'total': self.total,
+                'p50': self.percentile(0.5), 'p90': self.percentile(0.9), 'p99': self.percentile(0.99)}
+
+
+#==============================================================================
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.gauges = {}
+        self.hooks = []
+        self.started = time.monotonic()
+
+    #--------------------------------------------
+    def count(self, name, n = 1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    #--------------------------------------------
+    def observe(self, name, value, edges = Histogram.timeEdges):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None: histogram = self.histograms[name] = Histogram(edges)
+            histogram.add(value)
+
+        for hook in self.hooks:
+            try:
+                hook(name, value)
+            except Exception as e:
+                logger.exception(e)
+
+    def observeSize(self, name, value):
+        self.observe(name, value, Histogram.sizeEdges)
+
+    #--------------------------------------------
+    @contextlib.contextmanager
+    def timing(self, name):
+        ''' Record how long the with block took, in milliseconds '''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, (time.perf_counter() - start) * 1000)
+
+    #--------------------------------------------
+    def gauge(self, name, read):
+        ''' read() is called for the value of 'name' whenever a snapshot is taken '''
+        self.gauges[name] = read
+
+    def addHook(self, hook):
+        self.hooks.append(hook)
+
+    def removeHook(self, hook):
+        if hook in self.hooks: self.hooks.remove(hook)
+
+    #--------------------------------------------
+    def ratio(self, hits, misses):
+        ''' hits / (hits + misses) from two counters, or None '''
+        with self.lock:
+            h, m = self.counters.get(hits, 0), self.counters.get(misses, 0)
+        return h / (h + m) if h + m else None
+
+    #--------------------------------------------
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.started = time.monotonic()
+
+    #--------------------------------------------
+    def snapshot(self):
+        with self.lock:
+            snapshot = {'seconds': time.monotonic() - self.started,
+                        'counters': dict(self.counters),
+                        'histograms': {name: histogram.summary() for name, histogram in self.histograms.items()}}
+
+        gauges = {}
+        for name, read in list(self.gauges.items()):
+            try:
+                gauges[name] = read()
+            except Exception as e:
+                gauges[name] = None
+                logger.debug(f'Gauge {name} failed: {e}')
+        snapshot['gauges'] = gauges
+
+        return snapshot
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+'''
+Headless map rendering - the tile grid and any SlippyLayers composited into
+a wx.Bitmap, a raw RGBA buffer or an image file, without a window.
+
+    renderer = OffscreenRenderer()
+    bitmap = renderer.render(lat, lon, zoom, 640, 480, layers = [droneSymbol])
+
+Tiles missing from the cache are downloaded first (up to 'timeout' seconds)
+unless download = False. A wx.App must exist; ensureApp() makes one. Note
+that on Linux wx still needs an X display even though no window is shown -
+run under Xvfb on build machines.
+
+renderMany() renders a list of jobs on a pool of processes, each with its
+own wx.App and renderer:
+
+    python offscreen.py <lat> <lon> <zoom> <width> <height> <output.png>
+'''
+
+import io
+import sys
+import os
+import threading
+import time
+import multiprocessing
+
+scriptPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptPath)
+
+from projection import Projection
+from tiles import Tiles, LimitedSizeDict
+from tilestore import DirectoryTileStore
+
+import wx
+import numpy
+import tilenames
+
+
+#------------------------------------------------------------------------------------------
+
+def ensureApp():
+    app = wx.App.Get()
+    if app is None:
+        app = wx.App(False)
+    wx.InitAllImageHandlers()
+    return app
+
+
+#==============================================================================
+#
+# Stands in for WxMapWidget as the 'gpsmap' argument of SlippyLayer.do_draw
+#
+class OffscreenMap(Projection, Tiles):
+
+    def __init__(self, downloaders = 4, storeType = DirectoryTileStore, cacheTopLevel = None,
+                 mapSource = "OSM_GPS_MAP_SOURCE_OPENSTREETMAP"):
+        Projection.__init__(self)
+        Tiles.__init__(self, self.tileArrived, downloaders = downloaders, storeType = storeType,
+                       cacheTopLevel = cacheTopLevel, mapSource = mapSource)
+        self.arrived = threading.Condition()
+        self.mousePosition = wx.Point(0, 0)
+
+    #--------------------------------------------
+    def setup(self, lat, lon, zoom, width, height):
+        self.setView(0, 0, width, height)
+        self.recentre(lat, lon, zoom)
+        self.setViewport(self.zoom, self.px1, self.py1, self.px2, self.py2)
+        self.mousePosition = wx.Point(width // 2, height // 2)
+
+    #--------------------------------------------
+    def GetSize(self):
+        return wx.Size(self.w, self.h)
+
+    def scheduleRefresh(self, rect = None):
+        pass
+
+    #--------------------------------------------
+    def tileArrived(self, _key, _x, _y, _z, _data = None):
+        with self.arrived:
+            self.arrived.notify_all()
+
+    #--------------------------------------------
+    def visibleTiles(self):
+        limit = int(tilenames.numTiles(self.zoom))
+        for x in range(int(numpy.floor(self.px1)), int(numpy.ceil(self.px2))):
+            for y in range(int(numpy.floor(self.py1)), int(numpy.ceil(self.py2))):
+                if 0 <= y < limit:
+                    yield x % limit, y, x
+
+    #--------------------------------------------
+    def waitForTiles(self, timeout):
+        ''' Queue downloads of missing visible tiles and wait for them. Returns the number still missing '''
+        deadline = time.monotonic() + timeout
+        missing = [(x, y) for x, y, _sx in self.visibleTiles() if not self.tileStore.has(x, y, self.zoom)]
+        for x, y in missing: self.queueDownloadTile(x, y, self.zoom)
+
+        with self.arrived:
+            while missing:
+                missing = [(x, y) for x, y in missing if not self.tileStore.has(x, y, self.zoom)]
+                remaining = deadline - time.monotonic()
+                if not missing or remaining <= 0: break
+                self.arrived.wait(min(remaining, 0.5))
+
+        return len(missing)
+
+
+#==============================================================================
+class OffscreenRenderer:
+    background = wx.Colour(224, 224, 224)
+
+    def __init__(self, downloaders = 4, storeType = DirectoryTileStore, mapSource = None,
+                 download = True, timeout = 30, cachedTiles = 64, cacheTopLevel = None):
+        ensureApp()
+        self.map = OffscreenMap(downloaders, storeType, cacheTopLevel, mapSource or "OSM_GPS_MAP_SOURCE_OPENSTREETMAP")
+        self.download = download
+        self.timeout = timeout
+        self.images = LimitedSizeDict(size_limit = cachedTiles)
+
+    #--------------------------------------------
+    def tileImage(self, x, y, z):
+        key = self.map.fileName(x, y, z)
+        image = self.images.get(key)
+        if image is not None: return image
+
+        data = self.map.tileStore.read(x, y, z)
+        if data is None: return None
+
+        image = wx.Image(io.BytesIO(data), wx.BITMAP_TYPE_ANY)
+        if not image.IsOk(): return None
+
+        self.images[key] = image
+        return image
+
+    #--------------------------------------------
+    def render(self, lat, lon, zoom, width, height, layers = ()):
+        ''' The map centred on lat, lon at zoom, width x height pixels, as a wx.Bitmap '''
+        gpsmap = self.map
+        gpsmap.setup(lat, lon, zoom, width, height)
+        if self.download: gpsmap.waitForTiles(self.timeout)
+
+        bitmap = wx.Bitmap(width, height)
+        dc = wx.MemoryDC(bitmap)
+        dc.SetBackground(wx.Brush(self.background))
+        dc.Clear()
+
+        for x, y, screenX in gpsmap.visibleTiles():
+            image = self.tileImage(x, y, gpsmap.zoom)
+            if image is not None:
+                left, top = gpsmap.pxpy2xyi(screenX, y)
+                dc.DrawBitmap(wx.Bitmap(image), left, top, True)
+
+        for layer in layers:
+            layer.do_draw(gpsmap, dc)
+
+        dc.SelectObject(wx.NullBitmap)
+        return bitmap
+
+    #--------------------------------------------
+    def renderRGBA(self, lat, lon, zoom, width, height, layers = ()):
+        ''' As render, but returns a height x width x 4 uint8 numpy array '''
+        image = self.render(lat, lon, zoom, width, height, layers).ConvertToImage()
+        rgba = numpy.empty((height, width, 4), dtype = numpy.uint8)
+        rgba[:, :, :3] = numpy.frombuffer(bytes(image.GetData()), dtype = numpy.uint8).reshape(height, width, 3)
+        rgba[:, :, 3] = 255
+        return rgba
+
+    #--------------------------------------------
+    def renderToFile(self, path, lat, lon, zoom, width, height, layers = ()):
+        bitmap = self.render(lat, lon, zoom, width, height, layers)
+        imageType = wx.BITMAP_TYPE_JPEG if path.lower().endswith(('.jpg', '.jpeg')) else wx.BITMAP_TYPE_PNG
+        bitmap.SaveFile(path, imageType)
+        return path
+
+
+#------------------------------------------------------------------------------------------
+# Process pool rendering. Each worker process keeps one renderer.
+
+_renderer = None
+
+def _initWorker(rendererArgs):
+    global _renderer
+    _renderer = OffscreenRenderer(**rendererArgs)
+
+def _renderJob(job):
+    job = dict(job)
+    return _renderer.renderToFile(job.pop('path'), **job)
+
+def renderMany(jobs, processes = None, **rendererArgs):
+    ''' Render jobs - dicts of path, lat, lon, zoom, width, height and optionally
+        layers (which must be picklable) - to image files in parallel. Returns the paths '''
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(processes, initializer = _initWorker, initargs = (rendererArgs,)) as pool:
+        return pool.map(_renderJob, jobs)
+
+
+#------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    if len(sys.argv) != 7:
+        print(__doc__)
+        sys.exit(1)
+
+    lat, lon, zoom, width, height, path = sys.argv[1:]
+    OffscreenRenderer().renderToFile(path, float(lat), float(lon), int(zoom), int(width), int(height))
@@ -0,0 +1,147 @@
+'''
+Predictive prefetch of tiles which are likely to be wanted soon:
+
+  - a ring of tiles around the viewport
+  - further tiles in the direction the map is being dragged, extrapolated
+    from the recent pan velocity
+  - the zoomed-out view, and the zoomed-in tiles under the cursor
+
+Prefetch jobs go into the download queue below anything on screen, and no
+new ones are issued while the queue still has on-screen work waiting. The
+prefetcher counts how many of the tiles it asked for were later displayed.
+'''
+
+import math
+import time
+import threading
+from collections import deque
+
+from tiles import LimitedSizeDict, TileQueue
+
+
+#==============================================================================
+class Prefetcher:
+    RING, MOTION, ZOOM_OUT, ZOOM_IN = range(4)
+
+    def __init__(self, tiles, ring = 2, lookahead = 0.5, cursorRadius = 1, maxBusy = None, maxQueued = 128):
+        ''' ring - tiles around the viewport, lookahead - seconds of pan to extrapolate,
+            cursorRadius - tiles around the cursor to fetch at the next zoom level in,
+            maxBusy - on-screen jobs in the queue above which prefetch holds off,
+            maxQueued - most prefetch jobs to have queued at a time '''
+        self.tiles = tiles
+        self.ring = ring
+        self.lookahead = lookahead
+        self.cursorRadius = cursorRadius
+        self.maxBusy = maxBusy if maxBusy is not None else len(getattr(tiles, 'tileDownloaders', ())) or 4
+        self.maxQueued = maxQueued
+        self.enabled = True
+
+        self.lock = threading.Lock()
+        self.motion = deque(maxlen = 16)
+        self.issued = LimitedSizeDict(size_limit = 4096)
+        self.queued = self.hits = self.skipped = 0
+
+    #--------------------------------------------
+    def panned(self, dx, dy):
+        ''' Record a pan of dx, dy pixels (as passed to Projection.nudge) '''
+        self.motion.append((time.monotonic(), dx, dy))
+
+    #--------------------------------------------
+    def velocity(self, window = 0.3):
+        ''' Recent pan velocity in pixels per second - the direction the map content moves '''
+        now = time.monotonic()
+        recent = [(t, dx, dy) for t, dx, dy in self.motion if now - t <= window]
+        if len(recent) < 2: return 0.0, 0.0
+
+        elapsed = max(now - recent[0][0], 1e-3)
+        return sum(dx for _t, dx, _dy in recent) / elapsed, sum(dy for _t, _dx, dy in recent) / elapsed
+
+    #--------------------------------------------
+    def wanted(self, projection, cursor = None):
+        ''' Tiles worth prefetching for the current projection state, as (x, y, z, order) '''
+        zoom, scale = projection.zoom, projection.scale
+        wanted = []
+
+        x1, x2 = int(math.floor(projection.px1)), int(math.ceil(projection.px2))
+        y1, y2 = int(math.floor(projection.py1)), int(math.ceil(projection.py2))
+
+        # Ring around the viewport
+        r = self.ring
+        for x in range(x1 - r, x2 + r):
+            for y in range(y1 - r, y2 + r):
+                if not (x1 <= x < x2 and y1 <= y < y2):
+                    wanted.append((x, y, zoom, Prefetcher.RING))
+
+        # Where the drag is heading. Dragging moves the content, so the view moves the other way
+        vx, vy = self.velocity()
+        shiftX, shiftY = -vx * self.lookahead / scale, -vy * self.lookahead / scale
+        if abs(shiftX) >= 0.5 or abs(shiftY) >= 0.5:
+            ax1, ax2 = int(math.floor(projection.px1 + shiftX)), int(math.ceil(projection.px2 + shiftX))
+            ay1, ay2 = int(math.floor(projection.py1 + shiftY)), int(math.ceil(projection.py2 + shiftY))
+            for x in range(ax1, ax2):
+                for y in range(ay1, ay2):
+                    if not (x1 - r <= x < x2 + r and y1 - r <= y < y2 + r):
+                        wanted.append((x, y, zoom, Prefetcher.MOTION))
+
+        # One zoom level out - a quarter of the tiles of the current view
+        if zoom > 1:
+            for x in range(x1 // 2, (x2 + 1) // 2):
+                for y in range(y1 // 2, (y2 + 1) // 2):
+                    wanted.append((x, y, zoom - 1, Prefetcher.ZOOM_OUT))
+
+        # One zoom level in, around the cursor
+        if cursor is not None and zoom < projection.zoomLimit:
+            cx = int(2 * (projection.px1 + cursor[0] / scale))
+            cy = int(2 * (projection.py1 + cursor[1] / scale))
+            c = self.cursorRadius
+            for x in range(cx - c, cx + c + 1):
+                for y in range(cy - c, cy + c + 1):
+                    wanted.append((x, y, zoom + 1, Prefetcher.ZOOM_IN))
+
+        # Wrap round in longitude, nothing beyond the poles
+        return [(x % (1 << z), y, z, order) for x, y, z, order in wanted if 0 <= y < (1 << z)]
+
+    #--------------------------------------------
+    def update(self, projection, cursor = None):
+        ''' Re-plan prefetching after the viewport or cursor moved '''
+        if not self.enabled or not projection.isValid() or projection.needsEdgeFind: return
+
+        keys = {}
+        for x, y, z, order in self.wanted(projection, cursor):
+            keys.setdefault(self.tiles.fileName(x, y, z), (x, y, z, order))
+
+        # Forget queued prefetches which are no longer on the plan
+        self.tiles.retainPrefetch(keys)
+
+        counts = self.tiles.queue.counts()
+        if counts[TileQueue.VISIBLE] + counts[TileQueue.RING] >= self.maxBusy:
+            # Network is busy with what is on screen - try again next time
+            self.skipped += 1
+            return
+
+        room = self.maxQueued - counts[TileQueue.PREFETCH]
+        for key, (x, y, z, order) in sorted(keys.items(), key = lambda item: item[1][3]):
+            if room <= 0: break
+            if self.tiles.prefetchTile(x, y, z, order):
+                room -= 1
+                with self.lock:
+                    self.queued += 1
+                    self.issued[key] = True
+
+    #--------------------------------------------
+    def displayed(self, key):
+        ''' Call when a tile is drawn, to count prefetch hits '''
+        if key not in self.issued: return
+
+        with self.lock:
+            if self.issued.pop(key, None):
+                self.hits += 1
+
+    #--------------------------------------------
+    def stats(self):
+        with self.lock:
+            return {'queued': self.queued,
+                    'hits': self.hits,
+                    'hitRate': self.hits / self.queued if self.queued else None,
+                    'outstanding': len(self.issued),
+                    'skippedBusy': self.skipped}
@@ -21,9 +21,11 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #-----------------------------------------------------------------------------
 
-from tilenames import latlon2xy, tileSizePixels, xy2latlon
+from tilenames import latlon2xy, tileSizePixels, xy2latlon, latlon2xy_many, xy2latlon_many
 
 import math
+import contextlib
+import numpy
 
 
 class Projection:
@@ -125,6 +127,31 @@ class Projection:
         # Mark the meta-info as valid
         self.needsEdgeFind = False
   
+    #-----------------------------------------------------------------
+    @contextlib.contextmanager
+    def expandedView(self, margin):
+        """Temporarily widen the view by margin pixels on every side, e.g. to
+        draw into an off-screen surface larger than the display"""
+        names = ('w', 'h', 'px1', 'px2', 'py1', 'py2', 'pdx', 'pdy', 'N', 'S', 'E', 'W')
+        saved = [getattr(self, name) for name in names]
+        
+        self.w += 2 * margin
+        self.h += 2 * margin
+        self.px1 -= margin / self.scale
+        self.px2 += margin / self.scale
+        self.py1 -= margin / self.scale
+        self.py2 += margin / self.scale
+        self.pdx = self.px2 - self.px1
+        self.pdy = self.py2 - self.py1
+        self.N,self.W = xy2latlon(self.px1, self.py1, self.zoom)
+        self.S,self.E = xy2latlon(self.px2, self.py2, self.zoom)
+        
+        try:
+            yield self
+        finally:
+            for name, value in zip(names, saved):
+                setattr(self, name, value)
+  
     #-----------------------------------------------------------------
     def pxpy2xy(self,px,py):
         """Convert projection units to display units"""
@@ -167,6 +194,22 @@ class Projection:
         y = (py - self.py1) * self.scale
         return (int(x), int(y))
 
+    #-----------------------------------------------------------------
+    def ll2xy_array(self, lats, lons):
+        """Convert arrays of geographic units to display units, as float64 arrays"""
+        x, y = latlon2xy_many(lats, lons, self.zoom)
+        x -= self.px1
+        x *= self.scale
+        y -= self.py1
+        y *= self.scale
+        return(x, y)
+
+    # -----------------------------------------------------------------
+    def ll2xyi_array(self, lats, lons):
+        """Convert arrays of geographic units to display units, as int32 arrays"""
+        x, y = self.ll2xy_array(lats, lons)
+        return (x.astype(numpy.int32), y.astype(numpy.int32))
+
     #-----------------------------------------------------------------
     def xy2ll(self,x,y):
         """Convert display units to geographic units"""
@@ -175,6 +218,13 @@ class Projection:
         lat,lon = xy2latlon(px, py, self.zoom)
         return(lat,lon)
   
+    #-----------------------------------------------------------------
+    def xy2ll_array(self, xs, ys):
+        """Convert arrays of display units to geographic units"""
+        px = self.px1 + numpy.asarray(xs, dtype = numpy.float64) / self.scale
+        py = self.py1 + numpy.asarray(ys, dtype = numpy.float64) / self.scale
+        return xy2latlon_many(px, py, self.zoom)
+  
     #-----------------------------------------------------------------
     def onscreen(self,x,y):
         """Test if a position (in display units) is visible"""
@@ -0,0 +1,76 @@
+'''
+Coalesces repaint requests into at most one paint per frame.
+
+invalidate() may be called from any thread, any number of times. The dirty
+rectangles are merged and handed to the window in a single Refresh or
+RefreshRect on the UI thread, no sooner than one frame interval after the
+previous one.
+'''
+
+import threading
+import time
+
+import wx
+
+
+#==============================================================================
+class RenderScheduler:
+
+    def __init__(self, window, fps = 30):
+        self.window = window
+        self.setFPS(fps)
+        self.lock = threading.Lock()
+        self.dirty = None
+        self.full = False
+        self.scheduled = False
+        self.lastFrame = 0.0
+        self.frames = self.requests = 0
+
+    #--------------------------------------------
+    def setFPS(self, fps):
+        self.interval = 1.0 / fps
+
+    #--------------------------------------------
+    def invalidate(self, rect = None):
+        ''' Mark a rectangle (or, if None, the whole window) for repainting '''
+        with self.lock:
+            self.requests += 1
+
+            if rect is None:
+                self.full = True
+            elif not self.full:
+                self.dirty = wx.Rect(rect) if self.dirty is None else self.dirty.Union(rect)
+
+            if self.scheduled: return
+            self.scheduled = True
+
+        if wx.IsMainThread():
+            self.schedule()
+        else:
+            wx.CallAfter(self.schedule)
+
+    #--------------------------------------------
+    def schedule(self):
+        delay = self.lastFrame + self.interval - time.monotonic()
+
+        if delay <= 0:
+            self.flush()
+        else:
+            wx.CallLater(max(1, int(delay * 1000)), self.flush)
+
+    #--------------------------------------------
+    def flush(self):
+        with self.lock:
+            full, dirty = self.full, self.dirty
+            self.full, self.dirty = False, None
+            self.scheduled = False
+
+        if not self.window: return   # Window destroyed meanwhile
+
+        self.lastFrame = time.monotonic()
+        self.frames += 1
+
+        if full:
+            self.window.Refresh()
+        elif dirty is not None:
+            self.window.RefreshRect(dirty)
@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+'''
+Bulk download ("seeding") of every tile in a region over a range of zoom
+levels, for use where there is no connectivity.
+
+Tiles are enumerated in a fixed order and handed out in numbered batches.
+When every tile of a batch is done its number goes into a SQLite journal,
+so an interrupted seed can be started again with the same arguments and
+carries on where it stopped, skipping the finished batches without looking
+at the cache. Tiles already in the cache are not downloaded again.
+
+    python seeder.py --bbox S W N E --zooms 10-16 [--source OSM_GPS_MAP_SOURCE_OPENSTREETMAP]
+    python seeder.py --polygon area.txt --zooms 12-17 --journal area.seed --rate 20
+
+A polygon file has one "lat,lon" vertex per line.
+'''
+
+import os
+import sys
+import json
+import time
+import queue
+import sqlite3
+import argparse
+import threading
+import logging
+
+scriptPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptPath)
+
+from tiles import MapSource, HostPool, responseMetadata
+from tilestore import DirectoryTileStore, MBTilesTileStore
+from tilenames import latlon2xy, numTiles
+
+logger = logging.getLogger('wxmapwidget')
+
+
+#------------------------------------------------------------------------------------------
+
+def pointInPolygon(x, y, polygon):
+    inside = False
+    j = len(polygon) - 1
+    for i in range(len(polygon)):
+        xi, yi = polygon[i]
+        xj, yj = polygon[j]
+        if (yi > y) != (yj > y) and x < (xj - xi) * (y - yi) / (yj - yi) + xi:
+            inside = not inside
+        j = i
+    return inside
+
+#------------------------------------------------------------------------------------------
+
+def segmentHitsRect(x1, y1, x2, y2, left, top, right, bottom):
+    ''' Liang-Barsky clip of a segment against a rectangle '''
+    dx, dy = x2 - x1, y2 - y1
+    t0, t1 = 0.0, 1.0
+    for p, q in ((-dx, x1 - left), (dx, right - x1), (-dy, y1 - top), (dy, bottom - y1)):
+        if p == 0:
+            if q < 0: return False
+        else:
+            t = q / p
+            if p < 0: t0 = max(t0, t)
+            else: t1 = min(t1, t)
+            if t0 > t1: return False
+    return True
+
+#------------------------------------------------------------------------------------------
+
+def enumerateTiles(zooms, bbox = None, polygon = None):
+    ''' Yield (x, y, z) for every tile touching a bounding box (S, W, N, E) or
+        a polygon of (lat, lon) vertices, zoom by zoom, in a fixed order '''
+    if polygon is not None:
+        lats, lons = [p[0] for p in polygon], [p[1] for p in polygon]
+        bbox = (min(lats), min(lons), max(lats), max(lons))
+
+    s, w, n, e = bbox
+
+    for z in zooms:
+        limit = int(numTiles(z)) - 1
+        x1, y1 = (max(0, min(limit, int(v))) for v in latlon2xy(n, w, z))
+        x2, y2 = (max(0, min(limit, int(v))) for v in latlon2xy(s, e, z))
+
+        if polygon is None:
+            for x in range(x1, x2 + 1):
+                for y in range(y1, y2 + 1):
+                    yield x, y, z
+            continue
+
+        # Work in tile units at this zoom
+        shape = [latlon2xy(lat, lon, z) for lat, lon in polygon]
+        edges = list(zip(shape, shape[1:] + shape[:1]))
+
+        for x in range(x1, x2 + 1):
+            for y in range(y1, y2 + 1):
+                if pointInPolygon(x + 0.5, y + 0.5, shape) or \
+                        any(segmentHitsRect(a[0], a[1], b[0], b[1], x, y, x + 1, y + 1) for a, b in edges):
+                    yield x, y, z
+
+
+#==============================================================================
+class RateLimiter:
+    ''' Token bucket - at most 'rate' calls to wait() per second, on average '''
+
+    def __init__(self, rate, burst = None):
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.rate: return
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+
+#==============================================================================
+class SeedJournal:
+    ''' Which batches of a seed are finished. Refuses to resume a different seed '''
+
+    def __init__(self, path, params):
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS batches (number INTEGER PRIMARY KEY, tiles INTEGER, bytes INTEGER)')
+
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'params'").fetchone()
+        if row is None:
+            with self.db:
+                self.db.execute("INSERT INTO meta VALUES ('params', ?)", (json.dumps(params, sort_keys = True),))
+        elif json.loads(row[0]) != json.loads(json.dumps(params, sort_keys = True)):
+            raise ValueError(f'Journal {path} belongs to a different seed')
+
+        self.finished = {number for (number,) in self.db.execute('SELECT number FROM batches')}
+        self.previousTiles, self.previousBytes = self.db.execute(
+            'SELECT COALESCE(SUM(tiles), 0), COALESCE(SUM(bytes), 0) FROM batches').fetchone()
+
+    def finish(self, number, tiles, size):
+        self.finished.add(number)
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO batches VALUES (?, ?, ?)', (number, tiles, size))
+
+    def close(self):
+        self.db.close()
+
+
+#==============================================================================
+class Seeder:
+
+    def __init__(self, mapSource = "OSM_GPS_MAP_SOURCE_OPENSTREETMAP", storeType = DirectoryTileStore,
+                 cacheTopLevel = '~/.cache/osmgpsmap', workers = 4, maxPerHost = 2, rate = 10, batchSize = 256):
+        if isinstance(mapSource, str): mapSource = MapSource.mapSources[mapSource]
+        self.mapSource = mapSource
+        self.store = storeType.forSource(os.path.expanduser(cacheTopLevel), mapSource)
+        self.workers = workers
+        self.hostPool = HostPool(maxPerHost)
+        self.rateLimiter = RateLimiter(rate)
+        self.batchSize = batchSize
+        self.stopping = threading.Event()
+
+    #--------------------------------------------
+    def fetch(self, x, y, z):
+        ''' Returns (bytes downloaded, 'downloaded' | 'cached' | 'failed') '''
+        if self.store.has(x, y, z): return 0, 'cached'
+
+        self.rateLimiter.wait()
+        response = self.hostPool.get(self.mapSource.url(x, y, z))
+        if not response.ok:
+            logger.error(f'Failed to download tile {z}/{x}/{y} HTTP response code {response.status_code}')
+            return 0, 'failed'
+
+        self.store.write(x, y, z, response.content)
+        self.store.setMeta(x, y, z, *responseMetadata(response))
+        return len(response.content), 'downloaded'
+
+    #--------------------------------------------
+    def work(self, jobs, results):
+        while True:
+            job = jobs.get()
+            if job is None: return
+
+            number, (x, y, z) = job
+            try:
+                size, outcome = self.fetch(x, y, z)
+            except Exception as e:
+                logger.exception(e)
+                size, outcome = 0, 'failed'
+            results.put((number, size, outcome))
+
+    #--------------------------------------------
+    def stop(self):
+        self.stopping.set()
+
+    #--------------------------------------------
+    def seed(self, zooms, bbox = None, polygon = None, journalPath = None, progress = None, progressInterval = 1.0):
+        ''' Download every tile of the region at the given zoom levels. progress, if given, is
+            called with a stats dict every progressInterval seconds and at the end '''
+        zooms = list(zooms)
+        params = {'source': self.mapSource.name, 'zooms': zooms, 'bbox': bbox, 'polygon': polygon,
+                  'batchSize': self.batchSize}
+        journal = SeedJournal(journalPath, params) if journalPath else None
+        finished = journal.finished if journal else set()
+
+        total = sum(1 for _tile in enumerateTiles(zooms, bbox, polygon))
+        stats = {'total': total, 'done': journal.previousTiles if journal else 0, 'downloaded': 0, 'cached': 0,
+                 'failed': 0, 'bytes': journal.previousBytes if journal else 0,
+                 'tilesPerSecond': 0.0, 'bytesPerSecond': 0.0, 'eta': None}
+
+        jobs = queue.Queue(maxsize = self.workers * 4)
+        results = queue.Queue()
+        threads = [threading.Thread(target = self.work, args = (jobs, results), name = f'Seed thread {i}',
+                                    daemon = True)
+                   for i in range(self.workers)]
+        for thread in threads:
+            thread.start()
+
+        # batch number -> [tiles left, tiles, bytes, any failed, still being queued]
+        outstanding = {}
+        started = lastReport = time.monotonic()
+        doneThisRun = bytesThisRun = 0
+
+        def collect(block):
+            nonlocal doneThisRun, bytesThisRun, lastReport
+            while True:
+                try:
+                    number, size, outcome = results.get(timeout = 0.1) if block else results.get_nowait()
+                except queue.Empty:
+                    break
+                block = False
+
+                stats[outcome] += 1
+                stats['done'] += 1
+                stats['bytes'] += size
+                doneThisRun += 1
+                bytesThisRun += size
+
+                batch = outstanding[number]
+                batch[0] -= 1
+                batch[2] += size
+                if outcome == 'failed': batch[3] = True
+                settle(number)
+
+            now = time.monotonic()
+            if progress and now - lastReport >= progressInterval:
+                lastReport = now
+                report(now)
+
+        def settle(number):
+            ''' Finish a batch once all of its tiles have been queued and done '''
+            batch = outstanding.get(number)
+            if batch is None or batch[0] or batch[4]: return
+            del outstanding[number]
+            # A batch with failures is left unfinished, so a resumed seed retries it
+            if journal and not batch[3]: journal.finish(number, batch[1], batch[2])
+
+        def queued(number):
+            batch = outstanding.get(number)
+            if batch is not None:
+                batch[4] = False
+                settle(number)
+
+        def report(now):
+            elapsed = max(now - started, 1e-6)
+            stats['tilesPerSecond'] = doneThisRun / elapsed
+            stats['bytesPerSecond'] = bytesThisRun / elapsed
+            left = total - stats['done']
+            stats['eta'] = left / stats['tilesPerSecond'] if stats['tilesPerSecond'] else None
+            if progress: progress(dict(stats))
+
+        try:
+            number, inBatch = 0, 0
+            for tile in enumerateTiles(zooms, bbox, polygon):
+                if self.stopping.is_set(): break
+
+                if inBatch == self.batchSize:
+                    queued(number)
+                    number, inBatch = number + 1, 0
+                inBatch += 1
+                if number in finished: continue
+
+                outstanding.setdefault(number, [0, 0, 0, False, True])
+                outstanding[number][0] += 1
+                outstanding[number][1] += 1
+
+                while True:
+                    try:
+                        jobs.put((number, tile), timeout = 0.1)
+                        break
+                    except queue.Full:
+                        collect(False)
+
+                collect(False)
+
+            # The last batch - unless stopped part way through it
+            if not self.stopping.is_set(): queued(number)
+
+            while outstanding and not self.stopping.is_set():
+                collect(True)
+
+        finally:
+            for _thread in threads: jobs.put(None)
+            self.store.flush()
+            report(time.monotonic())
+            if journal: journal.close()
+
+        return stats
+
+
+#------------------------------------------------------------------------------------------
+
+def parseZooms(text):
+    if '-' in text:
+        first, last = text.split('-')
+        return range(int(first), int(last) + 1)
+    return [int(z) for z in text.split(',')]
+
+#------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = 'Download all the tiles of a region for offline use')
+    region = parser.add_mutually_exclusive_group(required = True)
+    region.add_argument('--bbox', nargs = 4, type = float, metavar = ('S', 'W', 'N', 'E'))
+    region.add_argument('--polygon', help = 'file of lat,lon vertices, one per line')
+    parser.add_argument('--zooms', required = True, help = 'e.g. 10-16 or 12,14')
+    parser.add_argument('--source', default = 'OSM_GPS_MAP_SOURCE_OPENSTREETMAP', choices = sorted(MapSource.mapSources))
+    parser.add_argument('--mbtiles', action = 'store_true', help = 'store tiles in an MBTiles file')
+    parser.add_argument('--cache', default = '~/.cache/osmgpsmap')
+    parser.add_argument('--journal', help = 'journal file, for resuming (default: <cache>/<source>.seed)')
+    parser.add_argument('--workers', type = int, default = 4)
+    parser.add_argument('--rate', type = float, default = 10, help = 'most requests per second (0 for no limit)')
+    args = parser.parse_args()
+
+    polygon = None
+    if args.polygon:
+        with open(args.polygon) as fl:
+            polygon = [tuple(float(v) for v in line.split(',')) for line in fl if line.strip()]
+
+    seeder = Seeder(args.source, MBTilesTileStore if args.mbtiles else DirectoryTileStore, args.cache,
+                    workers = args.workers, rate = args.rate)
+    journal = args.journal or os.path.join(os.path.expanduser(args.cache), args.source + '.seed')
+
+    def show(stats):
+        eta = '-' if stats['eta'] is None else time.strftime('%H:%M:%S', time.gmtime(stats['eta']))
+        print(f"\r{stats['done']}/{stats['total']} tiles  {stats['tilesPerSecond']:.1f} tiles/s  "
+              f"{stats['bytes'] / 1e6:.1f} MB  ETA {eta}  failed {stats['failed']}", end = '', flush = True)
+
+    try:
+        seeder.seed(parseZooms(args.zooms), bbox = args.bbox, polygon = polygon, journalPath = journal, progress = show)
+    except KeyboardInterrupt:
+        seeder.stop()
+    print()
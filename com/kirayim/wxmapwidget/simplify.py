@@ -0,0 +1,107 @@
+'''
+Level-of-detail simplification for tracks.
+
+A SimplificationPyramid keeps, for each zoom level that has been drawn, the
+indices of the track points that survive Douglas-Peucker simplification
+with a tolerance in screen pixels. At low zoom a long flight collapses to
+a few hundred vertices. New points are simplified incrementally: only the
+tail since the last point which is certain to be kept is looked at again.
+'''
+
+import math
+
+import numpy
+
+
+#------------------------------------------------------------------------------------------
+
+def douglasPeucker(x, y, tolerance):
+    ''' Indices of the points of the polyline x, y to keep, so that no point
+        dropped is further than tolerance from the simplified line '''
+    n = len(x)
+    if n < 3: return numpy.arange(n)
+
+    keep = numpy.zeros(n, dtype = bool)
+    keep[0] = keep[n - 1] = True
+    stack = [(0, n - 1)]
+
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2: continue
+
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        segX, segY = x[a + 1:b] - x[a], y[a + 1:b] - y[a]
+        length = math.hypot(dx, dy)
+
+        if length == 0:
+            distance = numpy.hypot(segX, segY)
+        else:
+            distance = numpy.abs(segX * dy - segY * dx) / length
+
+        i = int(numpy.argmax(distance))
+        if distance[i] > tolerance:
+            k = a + 1 + i
+            keep[k] = True
+            stack.append((a, k))
+            stack.append((k, b))
+
+    return numpy.flatnonzero(keep)
+
+
+#==============================================================================
+class SimplificationPyramid:
+
+    def __init__(self, track, tolerance = 0.75, maxTail = 4096):
+        ''' track - a TrackStore, tolerance - in screen pixels,
+            maxTail - most points to re-simplify before committing the tail anyway '''
+        self.track = track
+        self.tolerance = tolerance
+        self.maxTail = maxTail
+        self.levels = {}
+        self.edits = track.edits
+
+    #--------------------------------------------
+    def indices(self, zoom):
+        ''' Indices into the track of the points to draw at this zoom level '''
+        if self.edits != self.track.edits:
+            # Points were inserted out of order or dropped - start again
+            self.levels.clear()
+            self.edits = self.track.edits
+
+        count = len(self.track)
+        if count == 0: return numpy.zeros(0, dtype = numpy.int64)
+        
+        level = self.levels.get(zoom)
+        if level is None:
+            level = self.levels[zoom] = {'committed': numpy.zeros(1, dtype = numpy.int64),
+                                         'tail': numpy.zeros(0, dtype = numpy.int64), 'upTo': 1}
+
+        if level['upTo'] < count:
+            committed = level['committed']
+            start = int(committed[-1])
+            wx, wy = self.track.world(zoom, start, count)
+            kept = douglasPeucker(wx, wy, self.tolerance) + start
+
+            # Everything kept but the last point is final - the last point may
+            # turn out to be on a straight line with points still to come
+            if count - start > self.maxTail:
+                level['committed'] = numpy.concatenate((committed, kept[1:]))
+                level['tail'] = numpy.zeros(0, dtype = numpy.int64)
+            else:
+                level['committed'] = numpy.concatenate((committed, kept[1:-1]))
+                level['tail'] = kept[-1:]
+            level['upTo'] = count
+
+        return numpy.concatenate((level['committed'], level['tail']))
+
+    #--------------------------------------------
+    def reduction(self, zoom):
+        ''' Fraction of the track's points which are drawn at this zoom level '''
+        count = len(self.track)
+        return len(self.indices(zoom)) / count if count else 1.0
+
+    #--------------------------------------------
+    def stats(self):
+        count = len(self.track)
+        return {zoom: {'points': count, 'drawn': len(self.indices(zoom)),
+                       'reduction': self.reduction(zoom)} for zoom in list(self.levels)}
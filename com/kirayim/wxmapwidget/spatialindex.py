@@ -0,0 +1,92 @@
+'''
+Spatial index over lat/lon bounding boxes, keyed on the slippy-map tile
+grid at one zoom level.
+
+Each feature is filed under every grid cell its bounding box touches.
+Features that would cover more than 'maxCells' cells are kept on a
+separate list which every query returns, and a query covering more cells
+than there are features just checks every feature's bounding box.
+'''
+
+from tilenames import tileXY, numTiles
+
+# Web mercator stops here
+MAX_LATITUDE = 85.0511
+
+
+#==============================================================================
+class TileGridIndex:
+
+    def __init__(self, zoom = 12, maxCells = 64):
+        self.zoom = zoom
+        self.maxCells = maxCells
+        self.cells = {}
+        self.large = set()
+        self.bounds = {}
+
+    #--------------------------------------------
+    def __len__(self):
+        return len(self.bounds)
+
+    #--------------------------------------------
+    def cellRange(self, s, w, n, e):
+        ''' Tile ranges x1..x2, y1..y2 (inclusive) covering a bounding box '''
+        limit = int(numTiles(self.zoom)) - 1
+        n, s = min(n, MAX_LATITUDE), max(s, -MAX_LATITUDE)
+        x1, y1 = tileXY(n, w, self.zoom)
+        x2, y2 = tileXY(s, e, self.zoom)
+        clamp = lambda v: max(0, min(limit, v))
+        return clamp(x1), clamp(x2), clamp(y1), clamp(y2)
+
+    #--------------------------------------------
+    def insert(self, key, s, w, n, e):
+        if key in self.bounds: self.remove(key)
+        self.bounds[key] = (s, w, n, e)
+
+        x1, x2, y1, y2 = self.cellRange(s, w, n, e)
+        if (x2 - x1 + 1) * (y2 - y1 + 1) > self.maxCells:
+            self.large.add(key)
+            return
+
+        for x in range(x1, x2 + 1):
+            for y in range(y1, y2 + 1):
+                self.cells.setdefault(x << 32 | y, set()).add(key)
+
+    #--------------------------------------------
+    def remove(self, key):
+        bounds = self.bounds.pop(key, None)
+        if bounds is None: return
+
+        if key in self.large:
+            self.large.discard(key)
+            return
+
+        x1, x2, y1, y2 = self.cellRange(*bounds)
+        for x in range(x1, x2 + 1):
+            for y in range(y1, y2 + 1):
+                cell = self.cells.get(x << 32 | y)
+                if cell is not None:
+                    cell.discard(key)
+                    if not cell: del self.cells[x << 32 | y]
+
+    #--------------------------------------------
+    def query(self, s, w, n, e):
+        ''' Keys of the features whose bounding boxes intersect this one '''
+        x1, x2, y1, y2 = self.cellRange(s, w, n, e)
+
+        if (x2 - x1 + 1) * (y2 - y1 + 1) > len(self.bounds):
+            candidates = self.bounds.keys()
+        else:
+            candidates = set(self.large)
+            for x in range(x1, x2 + 1):
+                for y in range(y1, y2 + 1):
+                    cell = self.cells.get(x << 32 | y)
+                    if cell: candidates.update(cell)
+
+        found = []
+        for key in candidates:
+            fs, fw, fn, fe = self.bounds[key]
+            if fs <= n and fn >= s and fw <= e and fe >= w:
+                found.append(key)
+
+        return found
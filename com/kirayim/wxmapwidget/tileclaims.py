@@ -0,0 +1,95 @@
+'''
+Claims on tiles being downloaded, shared between processes through lock
+files, so several programs sharing a cache directory download each tile
+only once.
+
+A process claims a tile before downloading it by creating a file named
+after the tile key in the claims directory - an exclusive create, which
+only one process can win. The claim is released (the file removed) once
+the tile is on disk, or the download failed. Other processes wanting the
+tile wait for it to appear instead of downloading it themselves.
+
+A claim older than 'timeout' seconds is taken to belong to a process which
+died, and is broken.
+'''
+
+import os
+import time
+import socket
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger('wxmapwidget')
+
+
+#==============================================================================
+class TileClaims:
+
+    def __init__(self, claimsDir, timeout = 60.0):
+        self.claimsDir = claimsDir
+        self.timeout = timeout
+        self.lock = threading.Lock()
+        self.held = set()
+        os.makedirs(claimsDir, exist_ok = True)
+
+    #--------------------------------------------
+    def path(self, key):
+        return os.path.join(self.claimsDir, hashlib.md5(key.encode()).hexdigest() + '.claim')
+
+    #--------------------------------------------
+    def claim(self, key):
+        ''' True if this process now holds the claim on the tile, False if another process does '''
+        path = self.path(key)
+
+        for attempt in range(2):
+            try:
+                handle = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if attempt or not self.isStale(path): return False
+                logger.warning(f'Breaking stale claim on {key}')
+                self.unlink(path)
+                continue
+
+            with os.fdopen(handle, 'w') as fl:
+                fl.write(f'{socket.gethostname()} {os.getpid()} {key}\n')
+
+            with self.lock:
+                self.held.add(key)
+            return True
+
+        return False
+
+    #--------------------------------------------
+    def isStale(self, path):
+        try:
+            return time.time() - os.stat(path).st_mtime > self.timeout
+        except FileNotFoundError:
+            return True
+
+    def isClaimed(self, key):
+        ''' Does any process hold a live claim on the tile '''
+        return not self.isStale(self.path(key))
+
+    #--------------------------------------------
+    def release(self, key):
+        with self.lock:
+            if key not in self.held: return
+            self.held.discard(key)
+
+        self.unlink(self.path(key))
+
+    def releaseAll(self):
+        with self.lock:
+            held, self.held = self.held, set()
+
+        for key in held:
+            self.unlink(self.path(key))
+
+    #--------------------------------------------
+    @staticmethod
+    def unlink(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
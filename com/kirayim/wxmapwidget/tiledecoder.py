@@ -0,0 +1,93 @@
+'''
+Decode tile images on worker threads, so the paint handler never has to
+decode a PNG or JPEG itself.
+
+The decode function is supplied by the caller (for the widget it builds a
+wx.Image, which unlike wx.Bitmap may be created off the UI thread). The
+callback is called on the worker thread with the result; it is up to the
+caller to marshal it onto the UI thread.
+
+A decoder may be shared by several maps, each passing its own callback to
+request(). A tile is decoded once, and every callback which asked for it
+while it was waiting gets the result.
+'''
+
+import queue
+import threading
+import logging
+
+logger = logging.getLogger('wxmapwidget')
+
+
+#==============================================================================
+class TileDecoder:
+
+    def __init__(self, decode, callback, workers = 2):
+        self.decode = decode
+        self.callback = callback
+
+        # Last in, first out - the most recent requests are for what is on screen now
+        self.queue = queue.LifoQueue()
+
+        # Key -> callbacks waiting for it
+        self.pending = {}
+        self.lock = threading.Lock()
+
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target = self.run, name = f'Tile decode thread {i}', daemon = True)
+            worker.start()
+            self.workers.append(worker)
+
+    #--------------------------------------------
+    def request(self, key, store, x, y, z, data = None, callback = None):
+        ''' Queue a tile for decoding, from 'data' if given, otherwise read from the store.
+            'callback' replaces the decoder's own for this request. Returns False if the
+            tile is already waiting to be decoded '''
+        callback = callback or self.callback
+
+        with self.lock:
+            callbacks = self.pending.get(key)
+            if callbacks is not None:
+                if callback not in callbacks: callbacks.append(callback)
+                return False
+            self.pending[key] = [callback]
+
+        self.queue.put((key, store, x, y, z, data))
+        return True
+
+    #--------------------------------------------
+    def isPending(self, key):
+        with self.lock:
+            return key in self.pending
+
+    #--------------------------------------------
+    def close(self):
+        ''' Stop the worker threads. Tiles still queued are not decoded '''
+        for _worker in self.workers:
+            self.queue.put(None)
+
+    #--------------------------------------------
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None: break
+            key, store, x, y, z, data = item
+            image = None
+
+            try:
+                if data is None: data = store.read(x, y, z)
+                if data is not None: image = self.decode(data)
+            except Exception as e:
+                logger.exception(e)
+
+            with self.lock:
+                callbacks = self.pending.pop(key, ())
+
+            for callback in callbacks:
+                try:
+                    callback(key, image, x, y, z)
+                except Exception as e:
+                    logger.exception(e)
+
+            self.queue.task_done()
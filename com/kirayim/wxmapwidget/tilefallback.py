@@ -0,0 +1,74 @@
+'''
+Stand-in tiles synthesised from other zoom levels while the real tile is
+being fetched or decoded - a crop of the nearest decoded ancestor, scaled
+up, or failing that the decoded children at the next zoom level, scaled
+down. Ancestors which are stored but not yet decoded are asked for, so
+they can be used on a later frame.
+'''
+
+import wx
+import tilenames
+
+
+#==============================================================================
+class TileFallback:
+
+    def __init__(self, cache, keyOf, requestDecode, maxLevels = 4):
+        ''' keyOf(x, y, z) gives the bitmap cache key of a tile, requestDecode(x, y, z)
+            asks for a stored tile to be decoded and returns False if it is not stored '''
+        self.cache = cache
+        self.keyOf = keyOf
+        self.requestDecode = requestDecode
+        self.maxLevels = maxLevels
+
+    #--------------------------------------------
+    def synthesise(self, x, y, z):
+        ''' A stand-in bitmap for tile x, y, z or None if nothing suitable is in memory '''
+        return self.fromAncestor(x, y, z) or self.fromChildren(x, y, z)
+
+    #--------------------------------------------
+    def fromAncestor(self, x, y, z):
+        tileSize = tilenames.tileSizePixels()
+
+        for levels in range(1, min(self.maxLevels, z) + 1):
+            ax, ay, az = x >> levels, y >> levels, z - levels
+            ancestor = self.cache.peek(self.keyOf(ax, ay, az))
+
+            if ancestor is None:
+                # Will be ready for a later frame; keep looking further up meanwhile
+                self.requestDecode(ax, ay, az)
+                continue
+
+            part = tileSize >> levels
+            if part < 1: return None
+
+            mask = (1 << levels) - 1
+            rect = wx.Rect((x & mask) * part, (y & mask) * part, part, part)
+            image = ancestor.GetSubBitmap(rect).ConvertToImage()
+            return image.Scale(tileSize, tileSize, wx.IMAGE_QUALITY_BILINEAR).ConvertToBitmap()
+
+        return None
+
+    #--------------------------------------------
+    def fromChildren(self, x, y, z):
+        tileSize = tilenames.tileSizePixels()
+        half = tileSize // 2
+
+        children = [(dx, dy, self.cache.peek(self.keyOf(2 * x + dx, 2 * y + dy, z + 1)))
+                    for dx in (0, 1) for dy in (0, 1)]
+        if all(child is None for _dx, _dy, child in children): return None
+
+        bitmap = wx.Bitmap(tileSize, tileSize)
+        dc = wx.MemoryDC(bitmap)
+        dc.SetBrush(wx.GREEN_BRUSH)
+        dc.SetPen(wx.TRANSPARENT_PEN)
+
+        for dx, dy, child in children:
+            if child is None:
+                dc.DrawRectangle(dx * half, dy * half, half, half)
+            else:
+                image = child.ConvertToImage().Scale(half, half, wx.IMAGE_QUALITY_BOX_AVERAGE)
+                dc.DrawBitmap(image.ConvertToBitmap(), dx * half, dy * half)
+
+        dc.SelectObject(wx.NullBitmap)
+        return bitmap
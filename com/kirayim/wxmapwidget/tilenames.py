@@ -10,6 +10,8 @@
 #-------------------------------------------------------
 from math import *
 
+import numpy
+
 def numTiles(z):
     return(pow(2, z))
 
@@ -30,6 +32,36 @@ def tileXY(lat, lon, z):
     x, y = latlon2xy(lat, lon, z)
     return(int(x), int(y))
 
+#-------------------------------------------------------
+# Array versions of the above, for many points at once.
+# Take numpy arrays (or anything numpy.asarray accepts),
+# return contiguous float64 (or int64 for tile numbers)
+#-------------------------------------------------------
+def latlon2relativeXY_many(lats, lons):
+    lats = numpy.radians(numpy.asarray(lats, dtype = numpy.float64))
+    lons = numpy.asarray(lons, dtype = numpy.float64)
+    x = (lons + 180) / 360
+    y = (1 - numpy.log(numpy.tan(lats) + 1 / numpy.cos(lats)) / pi) / 2
+    return(x, y)
+
+def latlon2xy_many(lats, lons, z):
+    n = numTiles(z)
+    x, y = latlon2relativeXY_many(lats, lons)
+    x *= n
+    y *= n
+    return(x, y)
+
+def tileXY_many(lats, lons, z):
+    x, y = latlon2xy_many(lats, lons, z)
+    return(numpy.floor(x).astype(numpy.int64), numpy.floor(y).astype(numpy.int64))
+
+def xy2latlon_many(xs, ys, z):
+    n = numTiles(z)
+    relY = numpy.asarray(ys, dtype = numpy.float64) / n
+    lat = numpy.degrees(numpy.arctan(numpy.sinh(pi * (1 - 2 * relY))))
+    lon = -180.0 + 360.0 * numpy.asarray(xs, dtype = numpy.float64) / n
+    return(lat, lon)
+
 def xy2latlon(x, y, z):
     n = numTiles(z)
     relY = y / n
@@ -5,16 +5,27 @@ Created on Feb 11, 2013
 '''
 
 import os
+import atexit
 import hashlib
-import random
-import queue
+import heapq
+import itertools
+import math
+import time
+from email.utils import parsedate_to_datetime
 import threading
 from collections import OrderedDict
+from urllib.parse import urlsplit
 import logging
 
 import requests
 
-logger = logging.getLogger('capi_tester')
+from tilestore import DirectoryTileStore, WriteBehindTileStore
+from tiledecoder import TileDecoder
+from tileclaims import TileClaims
+from failures import FailureTracker
+from metrics import Metrics
+
+logger = logging.getLogger('wxmapwidget')
 
 #=====================================================================
 #
@@ -28,8 +39,8 @@ class LimitedSizeDict(OrderedDict):
         self._check_size_limit()
 
     def __setitem__(self, key, value):
-        if key in self: del self[key]
         OrderedDict.__setitem__(self, key, value)
+        self.move_to_end(key)
         self._check_size_limit()
 
 
@@ -45,15 +56,23 @@ class LimitedSizeDict(OrderedDict):
 class MapSource:
     mapSources = {}
     
-    ''' Define map sources using the same names as osmgpsmap for cache sharing. '''
-    def __init__(self, name, friendlyName, URLTemplate, imageFormat = 'png'):
+    ''' Define map sources using the same names as osmgpsmap for cache sharing. 
+        Templates containing %(random)d are spread round-robin over 'mirrors' hosts'''
+    def __init__(self, name, friendlyName, URLTemplate, imageFormat = 'png', mirrors = 4):
         self.name = name
         self.friendlyName = friendlyName
         self.URLTemplate = URLTemplate
         self.imageFormat = imageFormat
+        self.mirrors = mirrors
+        self.mirrorCycle = itertools.count()
         MapSource.mapSources.setdefault(self.name, self)
         self.hash = hashlib.md5(URLTemplate.encode()).hexdigest()
         
+    #---------------------------------
+    def url(self, x, y, z):
+        r = next(self.mirrorCycle) % self.mirrors
+        return self.URLTemplate % {'random' : r, 'x' : x, 'y' : y, 'zoom' : z}
+
 
 MapSource("OSM_GPS_MAP_SOURCE_NULL",                        "None",                 "none://"),
 MapSource("OSM_GPS_MAP_SOURCE_OPENSTREETMAP",              "OpenStreetMap I",   "http://tile.openstreetmap.org/%(zoom)d/%(x)d/%(y)d.png"),
@@ -75,84 +94,829 @@ MapSource("OSM_GPS_MAP_SOURCE_VIRTUAL_EARTH_HYBRID",      "Virtual Earth Hybrid"
 
 
 #==============================================================================
-class TileDownloader(threading.Thread):
+#
+# Keep-alive HTTP sessions (one per download thread, since requests.Session
+# is not thread safe) plus a limit on concurrent requests to any single host.
+#
+class HostPool:
     user_agent = {'user-agent': 'klvPlayer v1.11.1 contact shalomc@airoboticsdrones.com'}
     
-    def __init__(self, queue, callback = None):
-        threading.Thread.__init__(self, name = 'Tile download thread')
+    def __init__(self, maxPerHost = 2, timeout = 30):
+        self.maxPerHost = maxPerHost
+        self.timeout = timeout
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.hostLimits = {}
+        
+    #--------------------------------------------        
+    def session(self):
+        session = getattr(self.local, 'session', None)
+        
+        if session is None:
+            session = requests.Session()
+            session.headers.update(HostPool.user_agent)
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize = self.maxPerHost)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.local.session = session
+            
+        return session
+    
+    #--------------------------------------------        
+    def hostLimit(self, url):
+        host = urlsplit(url).netloc
+        
+        with self.lock:
+            limit = self.hostLimits.get(host)
+            if limit is None:
+                limit = self.hostLimits[host] = threading.BoundedSemaphore(self.maxPerHost)
+                
+        return limit
+    
+    #--------------------------------------------        
+    def get(self, url, **kwargs):
+        with self.hostLimit(url):
+            return self.session().get(url, timeout = self.timeout, **kwargs)
+        
+        
+#------------------------------------------------------------------------------------------
+
+def httpTime(value):
+    ''' Seconds since the epoch from an HTTP date header, or None '''
+    try:
+        return parsedate_to_datetime(value).timestamp() if value else None
+    except (TypeError, ValueError):
+        return None
+
+#------------------------------------------------------------------------------------------
+
+def responseMetadata(response, defaultMaxAge = 7 * 24 * 3600):
+    ''' (etag, last modified, expires) for a tile response, following Cache-Control,
+        then Expires, then 10% of the time since Last-Modified (RFC 7234), then defaultMaxAge '''
+    headers = response.headers
+    now = time.time()
+    etag = headers.get('ETag')
+    lastModified = headers.get('Last-Modified')
+
+    directives = {}
+    for part in headers.get('Cache-Control', '').lower().split(','):
+        name, _sep, value = part.strip().partition('=')
+        if name: directives[name] = value.strip('"')
+
+    if 'no-cache' in directives or 'no-store' in directives:
+        expires = now
+    elif directives.get('max-age', '').isdigit():
+        expires = now + int(directives['max-age'])
+    elif httpTime(headers.get('Expires')) is not None:
+        # Relative to the server's clock
+        date = httpTime(headers.get('Date')) or now
+        expires = now + httpTime(headers.get('Expires')) - date
+    elif httpTime(lastModified) is not None:
+        expires = now + min(defaultMaxAge, max(0, now - httpTime(lastModified)) / 10)
+    else:
+        expires = now + defaultMaxAge
+
+    return etag, lastModified, expires
+
+
+#==============================================================================
+class TileJob:
+    __slots__ = ('url', 'store', 'key', 'x', 'y', 'z', 'override', 'prefetch', 'order', 'revalidate', 'source')
+    
+    def __init__(self, url, store, key, x, y, z, override = False, prefetch = False, order = 0, revalidate = False,
+                 source = None):
+        self.url = url
+        self.store = store
+        self.key = key
+        self.x, self.y, self.z = x, y, z
+        self.override = override
+        self.prefetch = prefetch
+        self.order = order
+        self.revalidate = revalidate
+        self.source = source
+        
+        
+#==============================================================================
+#
+# Download queue ordered by the current viewport rather than arrival order.
+# Tiles on screen come first, nearest the centre first, then tiles in the
+# prefetch ring around the screen, then explicit prefetch jobs in their own
+# 'order'. Revalidation of stale tiles on screen or in the ring goes ahead of
+# the prefetch jobs. Whenever the viewport moves, queued jobs are re-ranked
+# and the ones that are no longer wanted are handed to 'onDrop'.
+# Drop-in for queue.Queue as far as TileDownloader is concerned.
+#
+# A queue shared by several maps keeps a viewport for each 'owner', and a
+# job ranks by whichever viewport wants it most. A viewport naming its map
+# source does not want jobs for any other source - they are left over from
+# before the map switched source.
+#
+# close() drops everything queued, and get() then returns None to tell the
+# download threads to stop.
+#
+class TileQueue:
+    VISIBLE, RING, PREFETCH = 0, 1, 2
+    
+    def __init__(self, onDrop = None):
+        self.onDrop = onDrop
+        self.heap = []
+        self.sequence = itertools.count()
+        self.viewports = {}
+        self.unfinished = 0
+        self.closed = False
+        self.condition = threading.Condition()
+        
+    #--------------------------------------------        
+    def rank(self, job):
+        ''' Sort key for a job, or None if it is no longer wanted '''
+        if not self.viewports:
+            if job.revalidate: return (TileQueue.PREFETCH, -1)
+            return (TileQueue.PREFETCH, job.order) if job.prefetch else (TileQueue.VISIBLE, 0)
+        
+        ranks = [rank for rank in (self.rankIn(job, viewport) for viewport in self.viewports.values()) 
+                 if rank is not None]
+        return min(ranks) if ranks else None
+    
+    #--------------------------------------------        
+    def rankIn(self, job, viewport):
+        zoom, px1, py1, px2, py2, ring, source = viewport
+        
+        if source is not None and job.source is not None and job.source != source:
+            return None
+        
+        if job.z == zoom:
+            cx, cy = (job.x + 0.5), (job.y + 0.5)
+            distance = (cx - (px1 + px2) / 2) ** 2 + (cy - (py1 + py2) / 2) ** 2
+            
+            if job.revalidate:
+                if px1 - 1 - ring < job.x < px2 + ring and py1 - 1 - ring < job.y < py2 + ring:
+                    return (TileQueue.PREFETCH, -1)
+                return None
+            
+            if px1 - 1 < job.x < px2 and py1 - 1 < job.y < py2:
+                return (TileQueue.VISIBLE, distance)
+            
+            if px1 - 1 - ring < job.x < px2 + ring and py1 - 1 - ring < job.y < py2 + ring:
+                return (TileQueue.RING, distance)
+        
+        if job.prefetch:
+            return (TileQueue.PREFETCH, job.order)
+        
+        return None
+    
+    #--------------------------------------------        
+    def setViewport(self, zoom, px1, py1, px2, py2, ring = 1, owner = None, source = None):
+        ''' Re-rank everything queued against a new viewport (in tile units) '''
+        with self.condition:
+            self.viewports[owner] = (zoom, px1, py1, px2, py2, ring, source)
+            dropped = self.rerank()
+            
+        self.drop(dropped)
+            
+    def removeViewport(self, owner = None):
+        with self.condition:
+            dropped = self.rerank() if self.viewports.pop(owner, None) is not None else []
+            
+        self.drop(dropped)
+                
+    #--------------------------------------------        
+    def rerank(self):
+        ''' Call with the condition held. Returns the jobs no longer wanted '''
+        kept, dropped = [], []
+        for _rank, seq, job in self.heap:
+            rank = self.rank(job)
+            if rank is None:
+                dropped.append(job)
+            else:
+                kept.append((rank, seq, job))
+                
+        heapq.heapify(kept)
+        self.heap = kept
+        self.forget(len(dropped))
+        return dropped
+            
+    #--------------------------------------------        
+    def retainPrefetch(self, keys):
+        ''' Drop queued prefetch jobs whose key is not in 'keys', unless they are now on screen '''
+        with self.condition:
+            kept, dropped = [], []
+            for rank, seq, job in self.heap:
+                if rank[0] == TileQueue.PREFETCH and not job.revalidate and job.key not in keys:
+                    dropped.append(job)
+                else:
+                    kept.append((rank, seq, job))
+                    
+            if dropped:
+                heapq.heapify(kept)
+                self.heap = kept
+                self.forget(len(dropped))
+                
+        self.drop(dropped)
+        
+    #--------------------------------------------        
+    def counts(self):
+        ''' Number of queued jobs in each tier '''
+        counts = [0, 0, 0]
+        with self.condition:
+            for rank, _seq, _job in self.heap:
+                counts[rank[0]] += 1
+        return counts
+        
+    #--------------------------------------------        
+    def forget(self, n):
+        ''' n queued jobs were taken out without being done - call with the condition held '''
+        if n:
+            self.unfinished -= n
+            self.condition.notify_all()
+        
+    #--------------------------------------------        
+    def drop(self, jobs):
+        for job in jobs:
+            logger.debug(f'Dropping stale tile request {job.url}')
+            if self.onDrop: self.onDrop(job)
+        
+    #--------------------------------------------        
+    def put(self, job):
+        with self.condition:
+            rank = self.rank(job) if not self.closed else None
+            if rank is not None:
+                heapq.heappush(self.heap, (rank, next(self.sequence), job))
+                self.unfinished += 1
+                self.condition.notify()
+                return
+            
+        self.drop([job])
+        
+    #--------------------------------------------        
+    def get(self):
+        with self.condition:
+            while not self.heap and not self.closed:
+                self.condition.wait()
+            return heapq.heappop(self.heap)[2] if self.heap else None
+        
+    #--------------------------------------------        
+    def close(self):
+        with self.condition:
+            self.closed = True
+            dropped = [job for _rank, _seq, job in self.heap]
+            self.heap = []
+            self.forget(len(dropped))
+            self.condition.notify_all()
+            
+        self.drop(dropped)
+        
+    #--------------------------------------------        
+    def task_done(self):
+        with self.condition:
+            self.unfinished -= 1
+            self.condition.notify_all()
+            
+    #--------------------------------------------        
+    def join(self):
+        with self.condition:
+            while self.unfinished > 0:
+                self.condition.wait()
+                
+    #--------------------------------------------        
+    def qsize(self):
+        with self.condition:
+            return len(self.heap)
+        
+        
+#==============================================================================
+class TileDownloader(threading.Thread):
+    user_agent = HostPool.user_agent
+    
+    def __init__(self, queue, callback = None, hostPool = None, name = 'Tile download thread', unchanged = None,
+                 failed = None, failures = None, metrics = None, claims = None, claimed = None):
+        ''' callback gets (key, x, y, z, data) of each tile written - data is the
+            downloaded image, or None if the tile was already stored; unchanged gets
+            (key, x, y, z) for a tile which revalidated as unchanged (HTTP 304); failed gets the
+            job of a download which failed, or was not made because the tile or its source
+            is failing. Failures are recorded in 'failures', and download times and sizes
+            per map source in 'metrics'.
+            With 'claims' (TileClaims) a tile is only downloaded once this process 
+            has claimed it; jobs for tiles claimed by another process go to 'claimed'.
+            The claim on a tile written is left for the caller to release '''
+        threading.Thread.__init__(self, name = name, daemon = True)
         self.queue = queue
-        self.setDaemon(True)
         self.callback = callback
+        self.unchanged = unchanged
+        self.failed = failed
+        self.claims = claims
+        self.claimed = claimed
+        self.failures = failures if failures is not None else FailureTracker()
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.hostPool = hostPool if hostPool is not None else HostPool()
         self.start()
         
     #--------------------------------------------        
     def run(self):
         while True:
             job = self.queue.get()
-            logger.debug(f'Queue size {self.queue.qsize()}: get tile {job[0]}')
+            if job is None: break
+            logger.debug(f'Queue size {self.queue.qsize()}: get tile {job.url}')
             
             try:
-                if os.path.exists(job[1]) and not job[6]:
-                    logger.debug(f'File already exists - not fetching {job[1]}')
-                    self.queue.task_done()
-                    continue
+                self.fetch(job)
+            except Exception as e:
+                logger.error(f'Failed to download tile {job.url}: {e}')
+                self.fail(job, None)
+            
+            self.queue.task_done()
+            
+    #--------------------------------------------        
+    def fail(self, job, status, retryAfter = None):
+        if self.claims is not None: self.claims.release(job.key)
+        self.metrics.count(f'download.failed.{job.source}')
+        self.failures.failed(job.key, job.source, status, retryAfter)
+        if self.failed: self.failed(job)
+            
+    #--------------------------------------------        
+    def fetch(self, job):
+        headers = {}
+        
+        if job.revalidate:
+            meta = job.store.meta(job.x, job.y, job.z)
+            if meta is not None:
+                etag, lastModified, _expires = meta
+                if etag: headers['If-None-Match'] = etag
+                if lastModified: headers['If-Modified-Since'] = lastModified
                 
-                dirname = os.path.dirname(job[1])
-                if not os.path.exists(dirname): 
-                    os.makedirs(dirname)
+        elif not job.override and job.store.has(job.x, job.y, job.z):
+            # Perhaps stored for another map since the job was queued
+            logger.debug(f'Tile already stored - not fetching {job.key}')
+            if self.callback: self.callback(job.key, job.x, job.y, job.z, None)
+            return
+        
+        # The tile or its source may have started failing since the job was queued
+        if self.failures.isBlocked(job.key) or not self.failures.allow(job.source, job.key):
+            logger.debug(f'Tile source failing - not fetching {job.key}')
+            self.metrics.count(f'download.refused.{job.source}')
+            if self.failed: self.failed(job)
+            return
+        
+        if self.claims is not None and not self.claims.claim(job.key):
+            logger.debug(f'Tile being downloaded by another process {job.key}')
+            self.failures.dropped(job.source, job.key)
+            if self.claimed: self.claimed(job)
+            return
+        
+        start = time.perf_counter()
+        response = self.hostPool.get(job.url, headers = headers)
+        self.metrics.observe(f'download.ms.{job.source}', (time.perf_counter() - start) * 1000)
+        
+        if response.status_code == 304 and headers:
+            # Keep the old validators if the server did not send them again
+            etag, lastModified, expires = responseMetadata(response)
+            job.store.setMeta(job.x, job.y, job.z, etag or headers.get('If-None-Match'), 
+                              lastModified or headers.get('If-Modified-Since'), expires)
+            logger.debug(f"Tile unchanged {job.key}")
+            if self.claims is not None: self.claims.release(job.key)
+            self.metrics.count(f'download.unchanged.{job.source}')
+            self.failures.succeeded(job.key, job.source)
+            if self.unchanged: self.unchanged(job.key, job.x, job.y, job.z)
+        
+        elif response.ok:
+            data = response.content
+            
+            # Only queued here - the store writes it out on its own thread
+            with self.metrics.timing('store.write'):
+                job.store.write(job.x, job.y, job.z, data)
+                job.store.setMeta(job.x, job.y, job.z, *responseMetadata(response))
+            self.metrics.observeSize(f'download.bytes.{job.source}', len(data))
+            self.failures.succeeded(job.key, job.source)
                 
-                response = requests.get(job[0], headers=TileDownloader.user_agent)
+            logger.debug(f"Retrieved tile {job.key}")
+            if self.callback: 
+                self.callback(job.key, job.x, job.y, job.z, data)
                 
-                if response.ok:
-                    with open(job[1], "wb") as fl:
-                        fl.write(response.content)
-                        
-                    filename = job[1]
-                    logger.debug(f"Retrieved tile {filename}")
-                    if self.callback: 
-                        self.callback(filename)
-                        
-                else:
-                    logger.error(f"Failed to download tile HTTP response code {response.status_code}")
+        else:
+            logger.error(f"Failed to download tile HTTP response code {response.status_code}")
+            retryAfter = response.headers.get('Retry-After', '')
+            self.fail(job, response.status_code, float(retryAfter) if retryAfter.isdigit() else None)
+        
+
+
+#==============================================================================
+#
+# The download pipeline - queue, download threads, host limits, failure
+# tracking and tile decoding - shared by any number of maps (Tiles). Each
+# tile is queued, downloaded and decoded once however many maps want it: a
+# map asking for a tile subscribes to it, and every subscriber is told when
+# it arrives. Tile stores are shared too, one per store type, cache
+# directory and map source, and closed when the last map using one lets go.
+#
+# A map is subscribed to a tile at most once, however often it asks. When
+# its viewport moves it is unsubscribed from the pending tiles it no longer
+# shows or prefetches.
+#
+# Each pending job holds on to its store like a map does, so a store is only
+# closed once the maps have let go of it and its downloads have drained.
+# shutdown() stops the service's threads; a map with a service of its own
+# shuts it down when it is closed.
+#
+# TileService.shared() is the one service for the whole process. With
+# claims = True, processes sharing a cache directory also download each tile
+# only once - see TileClaims.
+#
+class TileService:
+    sharedService = None
+    sharedLock = threading.Lock()
+    
+    def __init__(self, downloaders = 4, maxPerHost = 2, claims = False, claimsDir = None, claimPoll = 0.5):
+        self.lock = threading.Lock()
+        self.clients = set()
+        
+        # Tile key -> the job queued for it, until it is finished
+        self.pendingFiles = {}
+        
+        # Tile key -> maps subscribed to it, and map -> keys it is subscribed to
+        self.subscribers = {}
+        self.following = {}
+        
+        # Map -> its viewport, and the keys of the tiles its prefetcher wants
+        self.viewports = {}
+        self.prefetchKeys = {}
+        
+        # (store type, cache directory, map source name) -> [store, number of maps and pending jobs using it]
+        self.stores = {}
+        self.decoders = {}
+        
+        self.queue = TileQueue(self.on_tile_dropped)
+        self.hostPool = HostPool(maxPerHost)
+        self.failures = FailureTracker()
+        self.metrics = Metrics()
+        self.metrics.gauge('queue.depth', self.queue.qsize)
+        self.metrics.gauge('queue.tiers', self.queue.counts)
+        self.metrics.gauge('pending', lambda: len(self.pendingFiles))
+        
+        # Jobs for tiles another process is downloading, by key
+        self.claims = None
+        self.waiting = {}
+        self.stopped = threading.Event()
+        if claims:
+            self.claims = TileClaims(claimsDir or os.path.join(os.path.expanduser('~/.cache/osmgpsmap'), 'claims'))
+            self.claimPoll = claimPoll
+            atexit.register(self.claims.releaseAll)
+            watcher = threading.Thread(target = self.watchClaims, name = 'Tile claim watcher', daemon = True)
+            watcher.start()
+        
+        self.tileDownloaders = [TileDownloader(self.queue, self.on_tile_retrieved, self.hostPool, 
+                                               name = f'Tile download thread {i}', unchanged = self.on_tile_unchanged,
+                                               failed = self.on_tile_failed, failures = self.failures,
+                                               metrics = self.metrics, claims = self.claims, 
+                                               claimed = self.on_tile_claimed) 
+                                for i in range(downloaders)]
+        
+    #---------------------------------
+    @classmethod
+    def shared(cls, **kwargs):
+        ''' The service for the whole process, created with these arguments the first time '''
+        with cls.sharedLock:
+            if cls.sharedService is None: cls.sharedService = cls(**kwargs)
+            return cls.sharedService
+        
+    #---------------------------------
+    def openStore(self, storeType, cacheTopLevel, mapSource):
+        key = (storeType, os.path.abspath(cacheTopLevel), mapSource.name)
+        
+        with self.lock:
+            entry = self.stores.get(key)
+            if entry is None:
+                store = storeType.forSource(cacheTopLevel, mapSource)
+                if self.claims is not None and isinstance(store, WriteBehindTileStore): 
+                    store.onWritten = store.onWriteFailed = self.on_tiles_written
+                entry = self.stores[key] = [store, 0]
                 
-            except Exception as e:
-                logger.exception(e)
-                print(e)
+            entry[1] += 1
+            return entry[0]
+        
+    def closeStore(self, store):
+        ''' Let go of a store. It is closed when no map and no pending job uses it '''
+        with self.lock:
+            for key, entry in self.stores.items():
+                if entry[0] is store: break
+            else:
+                return
             
-            self.queue.task_done()
+            entry[1] -= 1
+            if entry[1] > 0: return
+            del self.stores[key]
             
+        store.close()
+        
+    def holdStore(self, store):
+        ''' Call with the lock held '''
+        for entry in self.stores.values():
+            if entry[0] is store: 
+                entry[1] += 1
+                return
         
+    #---------------------------------
+    def decoder(self, decode):
+        ''' The TileDecoder shared by every map decoding with this function. 
+            Decode times go to the 'decode' metric '''
+        with self.lock:
+            decoder = self.decoders.get(decode)
+            if decoder is None:
+                def timedDecode(data):
+                    with self.metrics.timing('decode'):
+                        return decode(data)
+                    
+                decoder = self.decoders[decode] = TileDecoder(timedDecode, None)
+                
+            return decoder
+        
+    #---------------------------------
+    def follow(self, client, key):
+        ''' If the tile is already on its way, subscribe the map to it and return True '''
+        with self.lock:
+            if key not in self.pendingFiles: return False
+            self.subscribe(client, key)
+            return True
+        
+    def request(self, client, job):
+        ''' Subscribe the map to the tile and queue its download, unless it is 
+            already queued. Returns True if it was queued '''
+        with self.lock:
+            self.subscribe(client, job.key)
+            if job.key in self.pendingFiles: return False
+            self.pendingFiles[job.key] = job
+            self.holdStore(job.store)
+            
+        self.queue.put(job)
+        return True
+    
+    def subscribe(self, client, key):
+        ''' Call with the lock held '''
+        self.subscribers.setdefault(key, set()).add(client)
+        self.following.setdefault(client, set()).add(key)
+        
+    def unsubscribe(self, client, key):
+        ''' Call with the lock held. The tile stays queued for any other map subscribed to it '''
+        subscribers = self.subscribers.get(key)
+        if subscribers is not None: subscribers.discard(client)
+        following = self.following.get(client)
+        if following is not None: following.discard(key)
+        
+    #---------------------------------
+    def wants(self, client, key):
+        ''' Call with the lock held. Is the pending tile still on the map's screen,
+            in its prefetch ring or among the tiles its prefetcher wants '''
+        job = self.pendingFiles.get(key)
+        viewport = self.viewports.get(client)
+        if job is None or viewport is None: return job is not None
+        
+        rank = self.queue.rankIn(job, viewport)
+        if rank is None: return False
+        
+        if rank[0] == TileQueue.PREFETCH and not job.revalidate:
+            keys = self.prefetchKeys.get(client)
+            return keys is None or key in keys
+        
+        return True
+    
+    def pruneSubscriptions(self, client):
+        ''' Call with the lock held. Unsubscribe the map from the tiles it no longer wants '''
+        for key in [key for key in self.following.get(client, ()) if not self.wants(client, key)]:
+            self.unsubscribe(client, key)
+        
+    #---------------------------------
+    def setViewport(self, client, zoom, px1, py1, px2, py2, ring, source = None):
+        ''' 'source' is the name of the map source the map shows '''
+        self.queue.setViewport(zoom, px1, py1, px2, py2, ring, owner = client, source = source)
+        
+        with self.lock:
+            self.viewports[client] = (zoom, px1, py1, px2, py2, ring, source)
+            self.pruneSubscriptions(client)
+            
+        self.failures.expire()
+        
+    def retainPrefetch(self, client, keys):
+        ''' Drop queued prefetches which neither this map nor any other wants any more '''
+        with self.lock:
+            self.prefetchKeys[client] = set(keys)
+            self.pruneSubscriptions(client)
+            wanted = set().union(*self.prefetchKeys.values())
+            
+        self.queue.retainPrefetch(wanted)
+        
+    #---------------------------------
+    def attach(self, client):
+        with self.lock:
+            self.clients.add(client)
+        
+    def detach(self, client):
+        ''' Forget a map's viewport, prefetching and subscriptions. Once no map
+            is left, tile claims held for other processes are given up too '''
+        with self.lock:
+            self.clients.discard(client)
+            self.viewports.pop(client, None)
+            self.prefetchKeys.pop(client, None)
+            for key in self.following.pop(client, ()):
+                self.subscribers.get(key, set()).discard(client)
+            lastClient = not self.clients
+                
+        self.queue.removeViewport(client)
+        if lastClient and self.claims is not None: self.claims.releaseAll()
+        
+    #---------------------------------
+    def finished(self, key):
+        ''' The tile is no longer pending. Returns its job and the maps subscribed to it.
+            Call done() with the job once finished with its store '''
+        with self.lock:
+            job = self.pendingFiles.pop(key, None)
+            clients = self.subscribers.pop(key, set())
+            for client in clients:
+                self.following.get(client, set()).discard(key)
+            return job, list(clients)
+        
+    def done(self, job):
+        if job is not None: self.closeStore(job.store)
+        
+    #---------------------------------
+    def on_tile_retrieved(self, key, x, y, z, data = None):
+        job, clients = self.finished(key)
+        for client in clients:
+            try:
+                client.on_tile_retrieved(key, x, y, z, data)
+            except Exception as e:
+                logger.exception(e)
+        self.done(job)
 
+    def on_tile_unchanged(self, key, x, y, z):
+        job, clients = self.finished(key)
+        for client in clients:
+            client.on_tile_unchanged(key, x, y, z)
+        self.done(job)
 
+    def on_tile_failed(self, job):
+        ''' The tile may be asked for again once its retry time is up '''
+        self.done(self.finished(job.key)[0])
+
+    def on_tile_dropped(self, job):
+        self.failures.dropped(job.source, job.key)
+        self.done(self.finished(job.key)[0])
+        
+    #---------------------------------
+    def on_tile_claimed(self, job):
+        ''' Another process is downloading the tile - wait for it to appear '''
+        self.metrics.count('download.claimedElsewhere')
+        with self.lock:
+            self.waiting[job.key] = job
+            
+    def on_tiles_written(self, store, tiles):
+        for x, y, z in tiles:
+            self.claims.release(store.key(x, y, z))
+            
+    #---------------------------------
+    def watchClaims(self):
+        while not self.stopped.wait(self.claimPoll):
+            with self.lock:
+                waiting = list(self.waiting.values())
+                
+            for job in waiting:
+                try:
+                    claimed = self.claims.isClaimed(job.key)
+                    
+                    # A stale tile being revalidated is on disk all along
+                    arrived = job.store.exists(job.x, job.y, job.z) and not (claimed and job.revalidate)
+                    if not arrived and claimed: continue
+                    
+                    with self.lock:
+                        self.waiting.pop(job.key, None)
+                        
+                    if arrived:
+                        job.store.indexAdd(job.x, job.y, job.z)
+                        self.on_tile_retrieved(job.key, job.x, job.y, job.z)
+                    else:
+                        # The other process gave up on it
+                        self.queue.put(job)
+                except Exception as e:
+                    logger.exception(e)
+                    
+    #---------------------------------
+    def shutdown(self):
+        ''' Stop the download, decode and claim watcher threads. Queued downloads are
+            dropped; downloads in flight finish, and then let go of their stores '''
+        with TileService.sharedLock:
+            if TileService.sharedService is self: TileService.sharedService = None
+            
+        self.stopped.set()
+        self.queue.close()
+        
+        with self.lock:
+            decoders, self.decoders = list(self.decoders.values()), {}
+            
+        for decoder in decoders:
+            decoder.close()
+            
+        if self.claims is not None: self.claims.releaseAll()
+        
+    #---------------------------------
+    def stats(self):
+        with self.lock:
+            return {'pending': len(self.pendingFiles), 
+                    'subscribed': sum(1 for subscribers in self.subscribers.values() if subscribers),
+                    'stores': len(self.stores),
+                    'waitingForOtherProcesses': len(self.waiting)}
+        
+        
 #==============================================================================
 class Tiles:
     
-    def __init__(self, callback = None):
+    def __init__(self, callback = None, downloaders = 4, maxPerHost = 2, prefetchRing = 1, 
+                 storeType = DirectoryTileStore, cacheManager = None, service = None, cacheTopLevel = None,
+                 mapSource = "OSM_GPS_MAP_SOURCE_OPENSTREETMAP"):
+        ''' Maps given the same 'service' (e.g. TileService.shared()) share their downloads,
+            decoding and tile stores. Otherwise the map gets a TileService of its own, with
+            'downloaders' threads and at most 'maxPerHost' requests to any one host.
+            Tiles are cached under 'cacheTopLevel', by default ~/.cache/osmgpsmap '''
+        self.ownsService = service is None
+        self.tileService = service if service is not None else TileService(downloaders, maxPerHost)
+        self.queue = self.tileService.queue
+        self.failures = self.tileService.failures
+        # This map's own measurements - paint times and cache lookups. Downloads, decoding
+        # and the queue are measured by the service, for every map sharing it
+        self.metrics = Metrics()
+        self.tileDownloaders = self.tileService.tileDownloaders
+        self.tileService.attach(self)
+        
         self.cacheDir = None
+        self.tileStore = None
+        self.storeType = storeType
+        self.cacheManager = cacheManager
+        self.prefetched = LimitedSizeDict(size_limit = 512)
+        self.viewport = None
+        
+        # Tile key -> time it is next due for revalidation: when it expires, according to
+        # the store's metadata, but never sooner than minRevalidate seconds after the last
+        # check - tiles served with no-cache or max-age=0 would otherwise be checked every paint
+        self.revalidate = True
+        self.minRevalidate = 300.0
+        self.expiryTimes = LimitedSizeDict(size_limit = 4096)
         self.callback = callback
-        self.cacheTopLevel = os.path.expanduser('~/.cache/osmgpsmap')
+        self.setlock = threading.Lock()
+        self.prefetchRing = prefetchRing
+        self.cacheTopLevel = os.path.expanduser(cacheTopLevel or '~/.cache/osmgpsmap')
 
         if not os.path.exists(self.cacheTopLevel): os.makedirs(self.cacheTopLevel)
-        self.setMapSource("OSM_GPS_MAP_SOURCE_OPENSTREETMAP")
-        
-        self.pendingFiles = set()
-        self.setlock = threading.Lock()
-        self.queue = queue.Queue()
-        self.tileDownloader = TileDownloader(self.queue, self.on_tile_retrieved)
-        
-        
+        self.setMapSource(mapSource)
         
     #---------------------------------
-    def on_tile_retrieved(self, filename):
-        if self.callback: self.callback(filename)
+    def close(self):
+        ''' Done with this map - let go of its store and its share of the download service.
+            A service of the map's own is shut down '''
+        self.tileService.detach(self)
+        if self.cacheManager is not None: self.cacheManager.release(self)
+        if self.tileStore is not None: 
+            self.tileService.closeStore(self.tileStore)
+            self.tileStore = None
+        if self.ownsService: self.tileService.shutdown()
         
-        with self.setlock:
-            if filename in self.pendingFiles:
-                self.pendingFiles.remove(filename)
+    #---------------------------------
+    def on_tile_retrieved(self, filename, x, y, z, data = None):
+        ''' Called on a download thread, for a tile this map asked for. The callback gets 
+            the tile key, x, y, zoom and the downloaded image (None if it was already stored) '''
+        if self.callback: self.callback(filename, x, y, z, data)
+        self.loadExpiry(x, y, z, filename, checked = True)
+
+    #---------------------------------
+    def on_tile_unchanged(self, filename, x, y, z):
+        ''' Called on a download thread when a stale tile revalidated as unchanged '''
+        self.loadExpiry(x, y, z, filename, checked = True)
+
+    #---------------------------------
+    def setViewport(self, zoom, px1, py1, px2, py2):
+        ''' Tell the download queue what is on screen now, in tile units '''
+        self.viewport = (zoom, px1, py1, px2, py2)
+        self.tileService.setViewport(self, zoom, px1, py1, px2, py2, self.prefetchRing, self.mapSource.name)
+
+        if self.cacheManager is not None:
+            ring = self.prefetchRing
+            self.cacheManager.protect(self, self.mapSource.name, zoom, 
+                                      int(math.floor(px1)) - ring, int(math.floor(py1)) - ring,
+                                      int(math.ceil(px2)) + ring, int(math.ceil(py2)) + ring, 
+                                      self.prefetched)
+
+    #---------------------------------
+    def inRing(self, x, y, z):
+        ''' Is the tile on screen or in the download ring - would the queue keep its download '''
+        if self.viewport is None: return True
+        zoom, px1, py1, px2, py2 = self.viewport
+        ring = self.prefetchRing
+        return z == zoom and px1 - 1 - ring < x < px2 + ring and py1 - 1 - ring < y < py2 + ring
+
+    #---------------------------------
+    def retainPrefetch(self, keys):
+        ''' Drop this map's queued prefetches whose key is not in 'keys' '''
+        self.tileService.retainPrefetch(self, keys)
 
     #---------------------------------
     def fileName(self, x,y,z):
-        return os.path.join(self.cacheDir, str(z), str(x), str(y) + "." + self.mapSource.imageFormat)
+        ''' Key of the tile in the current store. For the directory store this is the file path '''
+        return self.tileStore.key(x, y, z)
 
 
     #---------------------------------
@@ -160,40 +924,119 @@ class Tiles:
         if isinstance(mapSource, str): mapSource = MapSource.mapSources[mapSource]
         self.mapSource = mapSource
         
-        self.cacheDir = os.path.join(self.cacheTopLevel, self.mapSource.hash)
-        if not os.path.exists(self.cacheDir): os.makedirs(self.cacheDir)
+        if self.tileStore is not None: self.tileService.closeStore(self.tileStore)
+        self.tileStore = self.tileService.openStore(self.storeType, self.cacheTopLevel, mapSource)
+        self.cacheDir = getattr(self.tileStore, 'cacheDir', None)
+        if self.cacheManager is not None: self.cacheManager.attach(self.tileStore, mapSource.name)
+        
+        # Drop queued downloads for the old source
+        if self.viewport is not None: self.setViewport(*self.viewport)
 
 
     #---------------------------------
-    def queueDownloadTile(self, x, y, z, override = False):
+    def queueDownloadTile(self, x, y, z, override = False, prefetch = False, order = 0, revalidate = False):
+        ''' Returns True if the download was queued. If the tile is already on its way, 
+            perhaps for another map, this map is told when it arrives all the same '''
         filename = self.fileName(x, y, z)
         
-        with self.setlock:
-            if filename in self.pendingFiles:
-                #print "File %s already in queue" % filename
-                return
-            else:
-                self.pendingFiles.add(filename)
+        if self.tileService.follow(self, filename):
+            #print "File %s already in queue" % filename
+            return False
+            
+        # Failed recently, or the server is down
+        if self.failures.isBlocked(filename) or self.failures.isOpen(self.mapSource.name):
+            return False
         
-        r = random.randint(0, 4)
-        url = self.mapSource.URLTemplate % {'random' : r, 'x' : x, 'y' : y, 'zoom' : z}
-        self.queue.put((url, filename, x, y, z, override))
-        #print 'Queing tile - queue size', self.queue.qsize()
+        url = self.mapSource.url(x, y, z)
+        return self.tileService.request(self, TileJob(url, self.tileStore, filename, x, y, z, override, prefetch, 
+                                                      order, revalidate, self.mapSource.name))
+
+    #---------------------------------
+    def prefetchTile(self, x, y, z, order = 0):
+        ''' Queue a tile below the priority of anything on screen, unless it is already stored.
+            Returns True if it was queued '''
+        if self.tileStore.has(x, y, z): return False
+        self.prefetched[(x, y, z)] = True
+        return self.queueDownloadTile(x, y, z, prefetch = True, order = order)
 
     #---------------------------------
     def searchCache(self, x, y, z):
-        fileName = self.fileName(x,y,z)
-        return fileName if os.path.exists(fileName) else None
+        found = self.tileStore.has(x, y, z)
+        self.metrics.count('cache.hit' if found else 'cache.miss')
+        if self.cacheManager is not None: self.cacheManager.searched(self.mapSource.name, found)
+        return self.fileName(x,y,z) if found else None
+        
+    #---------------------------------
+    def loadExpiry(self, x, y, z, key = None, checked = False):
+        ''' Read the tile's expiry time from the store's metadata into memory, for isStale.
+            A database lookup - call it on a download or decode thread, not when painting.
+            Tiles with no metadata never expire. 'checked' means the tile was just downloaded
+            or revalidated, so it is not due again for at least minRevalidate seconds. 
+            Otherwise a time already known is never brought forward '''
+        store = self.tileStore
+        if store is None or (key is not None and key != store.key(x, y, z)): return None
+        
+        key = store.key(x, y, z)
+        meta = store.meta(x, y, z)
+        expires = meta[2] if meta is not None and meta[2] is not None else math.inf
+        
+        with self.setlock:
+            if checked:
+                expires = max(expires, time.time() + self.minRevalidate)
+            else:
+                expires = max(expires, self.expiryTimes.get(key, -math.inf))
+            self.expiryTimes[key] = expires
+        return expires
+        
+    #---------------------------------
+    def isStale(self, x, y, z):
+        ''' True if the cached tile is due for revalidation. Only looks in memory:
+            expiry times are loaded when tiles are downloaded or decoded (loadExpiry) '''
+        with self.setlock:
+            expires = self.expiryTimes.get(self.fileName(x, y, z))
+            
+        return expires is not None and expires < time.time()
+        
+    #---------------------------------
+    def revalidateIfStale(self, x, y, z):
+        ''' Queue a revalidation of the cached tile if it is due. It is not due again for
+            minRevalidate seconds, however the revalidation ends. Returns True if it was queued '''
+        if not self.revalidate: return False
+        
+        key = self.fileName(x, y, z)
+        now = time.time()
+        with self.setlock:
+            expires = self.expiryTimes.get(key)
+            if expires is None or expires >= now: return False
+            self.expiryTimes[key] = now + self.minRevalidate
+            
+        return self.queueDownloadTile(x, y, z, revalidate = True)
         
     #---------------------------------
     def getTile(self, x, y, z):
+        ''' Key of the cached tile, or None after queueing a download. A stale
+            tile is still returned, and revalidated in the background '''
         tile = self.searchCache(x, y, z)
         
         if tile:
+            self.revalidateIfStale(x, y, z)
             return tile
         
         self.queueDownloadTile(x,y,z)
         return None 
 
+    #---------------------------------
+    def stats(self):
+        ''' Snapshot of this map's measurements and those of its service, as a dict '''
+        stats = self.tileService.metrics.snapshot()
+        own = self.metrics.snapshot()
+        for part in ('counters', 'histograms', 'gauges'):
+            stats[part].update(own[part])
+        stats['seconds'] = own['seconds']
+        stats['diskHitRate'] = self.metrics.ratio('cache.hit', 'cache.miss')
+        stats['failures'] = self.failures.stats()
+        stats['service'] = self.tileService.stats()
+        return stats
+
 
 
@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+'''
+A stand-in tile server on localhost, for trying out the download pipeline
+without loading a real tile server (or needing a network at all).
+
+It answers tile URLs made from a MapSource-style template - by default
+/%(zoom)d/%(x)d/%(y)d.png - with a generated PNG. Only the path and query of
+the template are used, so the templates of the real sources can be given as
+they are; they must have %(x)d, %(y)d and %(zoom)d placeholders (quadkey
+templates such as Virtual Earth's are not supported). Anything else gets a
+404. The server can be made slow, narrow, unreliable and strict:
+
+    latency, jitter   - seconds before each response starts (latency +- jitter)
+    bandwidth         - bytes per second for each response body
+    errorRate         - fraction of requests answered with errorStatus (503)
+    notFoundRate      - fraction of requests answered with 404
+    maxConnections    - open connections allowed; more are refused with 503
+    maxRequestsPerConnection - keep-alive requests before the server closes the connection
+
+Responses carry an ETag and Cache-Control max-age, and If-None-Match gets a
+304. stats() counts requests, responses by status, bytes and tiles served.
+
+    with TileServer(latency = 0.05, errorRate = 0.01) as server:
+        tiles.setMapSource(server.mapSource())
+
+    with TileServer(template = MapSource.mapSources['OSM_GPS_MAP_SOURCE_GOOGLE_STREET'].URLTemplate) as server:
+        tiles.setMapSource(server.mapSource())
+
+    python tileserver.py [port]
+'''
+
+import os
+import re
+import sys
+import time
+import zlib
+import struct
+import random
+import threading
+import collections
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit
+
+scriptPath = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, scriptPath)
+
+from tiles import MapSource
+
+logger = logging.getLogger('wxmapwidget')
+
+DEFAULT_TEMPLATE = '/%(zoom)d/%(x)d/%(y)d.png'
+PLACEHOLDER = re.compile(r'%\((\w+)\)d')
+
+
+#------------------------------------------------------------------------------------------
+
+def templatePath(template):
+    ''' The path and query of a MapSource URL template, without scheme and host '''
+    parts = urlsplit(template)
+    return parts.path + ('?' + parts.query if parts.query else '')
+
+#------------------------------------------------------------------------------------------
+
+def tileRoute(template):
+    ''' A regular expression matching the path and query of the URLs made from a
+        MapSource URL template, with a named group for each placeholder '''
+    path = templatePath(template)
+    pattern, seen, last = '', set(), 0
+
+    for match in PLACEHOLDER.finditer(path):
+        name = match.group(1)
+        pattern += re.escape(path[last:match.start()])
+        # A placeholder used twice must match the same number twice
+        pattern += f'(?P={name})' if name in seen else f'(?P<{name}>\\d+)'
+        seen.add(name)
+        last = match.end()
+
+    pattern += re.escape(path[last:])
+
+    if not {'x', 'y', 'zoom'} <= seen:
+        raise ValueError(f'Tile URL template needs %(x)d, %(y)d and %(zoom)d: {template}')
+    return re.compile(pattern)
+
+
+#------------------------------------------------------------------------------------------
+
+def syntheticPNG(seed, size = 256):
+    ''' A valid, non-trivial RGB PNG - about the size of a real map tile '''
+    rng = random.Random(seed)
+    raw = bytearray()
+    for y in range(size):
+        raw.append(0)    # Filter type 'none'
+        shade = (y + seed * 16) & 0xff
+        for x in range(size):
+            raw += bytes((shade, (x + seed) & 0xff, rng.randrange(256) if x % 16 == 0 else 200))
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    header = struct.pack('>IIBBBBB', size, size, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header) + chunk(b'IDAT', zlib.compress(raw, 6)) + chunk(b'IEND', b'')
+
+
+#==============================================================================
+class TileRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    #--------------------------------------------
+    def handle(self):
+        tileServer = self.server.tileServer
+        if not tileServer.connectionOpened():
+            try:
+                self.rfile.readline()
+                self.send_response(503)
+                self.send_header('Content-Length', '0')
+                self.send_header('Connection', 'close')
+                self.end_headers()
+            except OSError:
+                pass
+            tileServer.count(503)
+            return
+
+        self.requestsOnConnection = 0
+        try:
+            BaseHTTPRequestHandler.handle(self)
+        except OSError:
+            pass  # Client went away
+        finally:
+            tileServer.connectionClosed()
+
+    #--------------------------------------------
+    def do_GET(self):
+        tileServer = self.server.tileServer
+        self.requestsOnConnection += 1
+        tileServer.requested()
+
+        delay = tileServer.latency + random.uniform(-tileServer.jitter, tileServer.jitter)
+        if delay > 0: time.sleep(delay)
+
+        match = tileServer.route.fullmatch(self.path)
+        roll = random.random()
+
+        if match is None or roll < tileServer.notFoundRate:
+            self.reply(404, b'Not found', 'text/plain')
+            return
+
+        if roll < tileServer.notFoundRate + tileServer.errorRate:
+            self.reply(tileServer.errorStatus, b'Unavailable', 'text/plain')
+            return
+
+        z, x, y = int(match['zoom']), int(match['x']), int(match['y'])
+        etag = f'"{z}-{x}-{y}-{tileServer.version}"'
+
+        if self.headers.get('If-None-Match') == etag:
+            self.reply(304, b'', None, etag)
+            return
+
+        self.reply(200, tileServer.tileImage(x, y, z), 'image/png', etag)
+        tileServer.served(x, y, z)
+
+    #--------------------------------------------
+    def reply(self, status, body, contentType, etag = None):
+        tileServer = self.server.tileServer
+        limit = tileServer.maxRequestsPerConnection
+        closing = limit is not None and self.requestsOnConnection >= limit
+
+        self.send_response(status)
+        if contentType: self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', f'max-age={tileServer.maxAge}')
+        if closing:
+            self.send_header('Connection', 'close')
+            self.close_connection = True
+        self.end_headers()
+
+        if tileServer.bandwidth:
+            chunkSize = max(1024, int(tileServer.bandwidth / 50))
+            for start in range(0, len(body), chunkSize):
+                chunk = body[start:start + chunkSize]
+                self.wfile.write(chunk)
+                time.sleep(len(chunk) / tileServer.bandwidth)
+        else:
+            self.wfile.write(body)
+
+        tileServer.count(status, len(body))
+
+    #--------------------------------------------
+    def log_message(self, format, *args):
+        logger.debug('Tile server: ' + format % args)
+
+
+#==============================================================================
+class TileServer:
+
+    def __init__(self, port = 0, host = '127.0.0.1', latency = 0.0, jitter = 0.0, bandwidth = None,
+                 errorRate = 0.0, errorStatus = 503, notFoundRate = 0.0, maxConnections = None,
+                 maxRequestsPerConnection = None, maxAge = 86400, variants = 8, template = DEFAULT_TEMPLATE):
+        ''' 'template' is the MapSource URL template to serve tiles at - only its path and query are used '''
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.bandwidth = bandwidth
+        self.errorRate = errorRate
+        self.errorStatus = errorStatus
+        self.notFoundRate = notFoundRate
+        self.maxConnections = maxConnections
+        self.maxRequestsPerConnection = maxRequestsPerConnection
+        self.maxAge = maxAge
+        self.variants = variants
+        self.path = templatePath(template)
+        self.route = tileRoute(template)
+
+        # Change to make every tile's ETag different, as if the map was re-rendered
+        self.version = 1
+
+        self.images = {}
+        self.lock = threading.Lock()
+        self.httpServer = None
+        self.reset()
+
+    #--------------------------------------------
+    def reset(self):
+        ''' Zero the statistics '''
+        with self.lock:
+            self.requests = 0
+            self.statuses = collections.Counter()
+            self.bytesSent = 0
+            self.tilesServed = collections.Counter()
+            self.connections = 0
+            self.peakConnections = 0
+            self.refusedConnections = 0
+
+    #--------------------------------------------
+    def start(self):
+        self.httpServer = ThreadingHTTPServer((self.host, self.port), TileRequestHandler)
+        self.httpServer.daemon_threads = True
+        self.httpServer.tileServer = self
+        self.port = self.httpServer.server_address[1]
+
+        thread = threading.Thread(target = self.httpServer.serve_forever, name = f'Tile server {self.port}',
+                                  daemon = True)
+        thread.start()
+        return self
+
+    def stop(self):
+        if self.httpServer is not None:
+            self.httpServer.shutdown()
+            self.httpServer.server_close()
+            self.httpServer = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *_exc):
+        self.stop()
+
+    #--------------------------------------------
+    @property
+    def urlTemplate(self):
+        return f'http://{self.host}:{self.port}{self.path}'
+
+    def mapSource(self):
+        ''' A MapSource for this server '''
+        name = f'LOCAL_TILE_SERVER_{self.port}'
+        source = MapSource.mapSources.get(name)
+        if source is None or source.URLTemplate != self.urlTemplate:
+            source = MapSource(name, 'Local test server', self.urlTemplate)
+        return source
+
+    #--------------------------------------------
+    def tileImage(self, x, y, z):
+        variant = (x * 31 + y * 17 + z) % self.variants
+        image = self.images.get(variant)
+        if image is None:
+            image = self.images[variant] = syntheticPNG(variant)
+        return image
+
+    #--------------------------------------------
+    # Bookkeeping, called by the request handlers
+
+    def connectionOpened(self):
+        with self.lock:
+            if self.maxConnections is not None and self.connections >= self.maxConnections:
+                self.refusedConnections += 1
+                return False
+            self.connections += 1
+            self.peakConnections = max(self.peakConnections, self.connections)
+            return True
+
+    def connectionClosed(self):
+        with self.lock:
+            self.connections -= 1
+
+    def requested(self):
+        with self.lock:
+            self.requests += 1
+
+    def count(self, status, size = 0):
+        with self.lock:
+            self.statuses[status] += 1
+            self.bytesSent += size
+
+    def served(self, x, y, z):
+        with self.lock:
+            self.tilesServed[(x, y, z)] += 1
+
+    #--------------------------------------------
+    def stats(self):
+        with self.lock:
+            return {'requests': self.requests, 'statuses': dict(self.statuses), 'bytes': self.bytesSent,
+                    'tiles': len(self.tilesServed), 'duplicates': sum(self.tilesServed.values()) - len(self.tilesServed),
+                    'peakConnections': self.peakConnections, 'refusedConnections': self.refusedConnections}
+
+
+#------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    server = TileServer(port = int(sys.argv[1]) if len(sys.argv) > 1 else 8080).start()
+    print(f'Serving tiles at {server.urlTemplate} - Ctrl-C to stop')
+    try:
+        while True: time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
@@ -0,0 +1,652 @@
+'''
+Tile store backends - where downloaded tiles are kept.
+
+DirectoryTileStore keeps the osmgpsmap layout (one file per tile) so the
+cache can be shared with osmgpsmap. MBTilesTileStore keeps a whole map
+source in a single SQLite file, which is much faster to search and to
+copy between machines.
+
+Both write behind: write() only queues the tile, and a background thread
+writes queued tiles out in batches, so download threads never wait for the
+disk. Queued tiles are read straight from memory until they are written.
+Freshness metadata is queued the same way and committed with the tiles.
+
+Import an osmgpsmap cache directory into an MBTiles file (and back) with
+
+    python tilestore.py import <cache dir> <file.mbtiles> [png|jpg]
+    python tilestore.py export <file.mbtiles> <cache dir> [png|jpg]
+'''
+
+import os
+import sys
+import sqlite3
+import tempfile
+import threading
+import logging
+
+logger = logging.getLogger('wxmapwidget')
+
+
+#==============================================================================
+#
+# HTTP freshness information for each tile - ETag, Last-Modified and the time
+# the tile expires (seconds since the epoch) - in a SQLite table. Each thread
+# gets its own connection.
+#
+class TileMetadata:
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+
+        db = self.connection()
+        with db:
+            db.execute('CREATE TABLE IF NOT EXISTS tile_meta (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, '
+                       'etag TEXT, last_modified TEXT, expires REAL, '
+                       'PRIMARY KEY (zoom_level, tile_column, tile_row)) WITHOUT ROWID')
+
+    #--------------------------------------------
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+
+        if db is None:
+            db = sqlite3.connect(self.path, timeout = 30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+
+        return db
+
+    #--------------------------------------------
+    def get(self, x, y, z):
+        ''' (etag, last modified, expires) or None '''
+        return self.connection().execute('SELECT etag, last_modified, expires FROM tile_meta '
+                                         'WHERE zoom_level=? AND tile_column=? AND tile_row=?', (z, x, y)).fetchone()
+
+    def put(self, x, y, z, etag, lastModified, expires):
+        db = self.connection()
+        with db:
+            db.execute('INSERT OR REPLACE INTO tile_meta VALUES (?, ?, ?, ?, ?, ?)', (z, x, y, etag, lastModified, expires))
+
+    def update(self, changes):
+        ''' Apply {(x, y, z): (etag, last modified, expires), or None to remove} in one transaction '''
+        db = self.connection()
+        with db:
+            db.executemany('DELETE FROM tile_meta WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                           [(z, x, y) for (x, y, z), row in changes.items() if row is None])
+            db.executemany('INSERT OR REPLACE INTO tile_meta VALUES (?, ?, ?, ?, ?, ?)',
+                           [(z, x, y) + tuple(row) for (x, y, z), row in changes.items() if row is not None])
+
+    def remove(self, x, y, z):
+        db = self.connection()
+        with db:
+            db.execute('DELETE FROM tile_meta WHERE zoom_level=? AND tile_column=? AND tile_row=?', (z, x, y))
+
+
+#==============================================================================
+class TileStore:
+    ''' Interface for tile storage. Tiles are addressed by slippy-map x, y, zoom.
+    
+        has() answers from an in-memory presence index - per zoom level, a set of
+        tiles packed as (x << 32 | y). Each zoom level is scanned once, in the
+        background, the first time it is asked about. Until the scan is done
+        has() falls back to exists(). Writes and removals through the store
+        keep the index up to date.
+
+        A store attached to a CacheManager tells it about reads, writes and
+        removals through noteRead, noteWrite and noteRemove.
+
+        Stores with a TileMetadata in 'metadata' keep ETag, Last-Modified and
+        expiry time for each tile, for revalidation. '''
+
+    def __init__(self):
+        self.indexLock = threading.Lock()
+        self.index = {}
+        self.indexReady = set()
+        self.indexRemoved = {}
+        self.cacheManager = None
+        self.cacheName = None
+        self.metadata = None
+
+    #--------------------------------------------
+    @classmethod
+    def forSource(cls, cacheTopLevel, mapSource):
+        ''' Create the store for a map source under the top level cache directory '''
+        raise NotImplementedError
+
+    #--------------------------------------------
+    def key(self, x, y, z):
+        ''' A string which identifies this tile in this store, unique across stores '''
+        raise NotImplementedError
+
+    def exists(self, x, y, z):
+        ''' Ask the backing storage itself, bypassing the index '''
+        raise NotImplementedError
+
+    def scanZoom(self, z):
+        ''' Iterate over (x, y) of every stored tile at one zoom level '''
+        raise NotImplementedError
+
+    def read(self, x, y, z):
+        ''' The encoded image, or None if the tile is not stored '''
+        raise NotImplementedError
+
+    def write(self, x, y, z, data):
+        raise NotImplementedError
+
+    def remove(self, x, y, z):
+        raise NotImplementedError
+
+    def tiles(self):
+        ''' Iterate over (x, y, z) of every stored tile '''
+        raise NotImplementedError
+
+    def tileSizes(self):
+        ''' Iterate over (x, y, z, size in bytes, time last written) of every stored tile '''
+        for x, y, z in self.tiles():
+            data = self.read(x, y, z)
+            if data is not None: yield x, y, z, len(data), 0.0
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.flush()
+
+    #--------------------------------------------
+    def has(self, x, y, z):
+        packed = x << 32 | y
+
+        with self.indexLock:
+            present = self.index.get(z)
+            if present is None:
+                present = self.index[z] = set()
+                threading.Thread(target = self.loadIndex, args = (z,), name = f'Tile index scan {z}', daemon = True).start()
+            elif z in self.indexReady:
+                return packed in present
+
+        if self.exists(x, y, z):
+            self.indexAdd(x, y, z)
+            return True
+
+        return False
+
+    #--------------------------------------------
+    def loadIndex(self, z):
+        try:
+            found = {x << 32 | y for x, y in self.scanZoom(z)}
+        except Exception as e:
+            logger.exception(e)
+            found = set()
+
+        with self.indexLock:
+            # Tiles removed while the scan ran may still have been found by it
+            self.index[z].update(found - self.indexRemoved.pop(z, set()))
+            self.indexReady.add(z)
+
+        logger.debug(f'Indexed {len(found)} tiles at zoom {z}')
+
+    #--------------------------------------------
+    def indexAdd(self, x, y, z):
+        with self.indexLock:
+            present = self.index.get(z)
+            if present is not None: present.add(x << 32 | y)
+            if z in self.indexRemoved: self.indexRemoved[z].discard(x << 32 | y)
+
+    def indexDiscard(self, x, y, z):
+        with self.indexLock:
+            present = self.index.get(z)
+            if present is not None:
+                present.discard(x << 32 | y)
+                if z not in self.indexReady: self.indexRemoved.setdefault(z, set()).add(x << 32 | y)
+
+    def invalidate(self, x, y, z):
+        ''' Forget a tile, e.g. because it could not be decoded '''
+        self.remove(x, y, z)
+
+    #--------------------------------------------
+    def noteRead(self, x, y, z):
+        if self.cacheManager is not None: self.cacheManager.touched(self.cacheName, x, y, z)
+
+    def noteWrite(self, x, y, z, size):
+        if self.cacheManager is not None: self.cacheManager.written(self.cacheName, x, y, z, size)
+
+    def noteRemove(self, x, y, z):
+        if self.cacheManager is not None: self.cacheManager.removed(self.cacheName, x, y, z)
+        self.removeMeta(x, y, z)
+
+    #--------------------------------------------
+    def meta(self, x, y, z):
+        ''' (etag, last modified, expires) of a tile, or None if not known '''
+        return self.metadata.get(x, y, z) if self.metadata is not None else None
+
+    def setMeta(self, x, y, z, etag, lastModified, expires):
+        if self.metadata is not None: self.metadata.put(x, y, z, etag, lastModified, expires)
+
+    def removeMeta(self, x, y, z):
+        if self.metadata is not None: self.metadata.remove(x, y, z)
+
+
+#==============================================================================
+#
+# A store which writes behind. Writes are collected in 'pending' and handed
+# to writeBatch() on a background thread, either when 'batchSize' tiles are
+# waiting or after 'flushInterval' seconds. If the disk cannot keep up and
+# 'maxPending' tiles are waiting, write() flushes itself rather than let
+# the backlog grow without limit. onWritten, if set, is called with the
+# store and the (x, y, z) of the tiles of each batch once they have been
+# written, and onWriteFailed with those which could not be.
+#
+# A batch being written moves from 'pending' to 'writing', and is still read
+# from there until writeBatch() returns, so a tile never looks missing while
+# it is on its way to the disk. Tiles only join the presence index once
+# written; until then has() finds them queued. Metadata changes - setMeta()
+# and removals - are queued in 'pendingMeta' in the same way and committed
+# in one transaction after the tiles.
+#
+class WriteBehindTileStore(TileStore):
+
+    def __init__(self, batchSize = 64, flushInterval = 1.0, maxPending = None):
+        TileStore.__init__(self)
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.maxPending = maxPending if maxPending is not None else batchSize * 16
+
+        self.writeLock = threading.Lock()
+        self.pendingLock = threading.Lock()
+        self.pending = {}
+        self.writing = {}
+        self.pendingMeta = {}
+        self.writingMeta = {}
+        self.onWritten = None
+        self.onWriteFailed = None
+
+        self.flushEvent = threading.Event()
+        self.wakeEvent = threading.Event()
+        self.flusher = threading.Thread(target = self.flushLoop, name = f'{type(self).__name__} writer',
+                                        daemon = True)
+        self.flusher.start()
+
+    #--------------------------------------------
+    def writeBatch(self, batch):
+        ''' Write out {(x, y, z): data}. Returns the (x, y, z) of any tiles which
+            could not be written, or raises if none were. Called with writeLock held '''
+        raise NotImplementedError
+
+    #--------------------------------------------
+    def pendingData(self, x, y, z):
+        with self.pendingLock:
+            data = self.pending.get((x, y, z))
+            return data if data is not None else self.writing.get((x, y, z))
+
+    def discardPending(self, x, y, z):
+        with self.pendingLock:
+            self.pending.pop((x, y, z), None)
+            self.writing.pop((x, y, z), None)
+
+    #--------------------------------------------
+    def has(self, x, y, z):
+        return self.pendingData(x, y, z) is not None or TileStore.has(self, x, y, z)
+
+    #--------------------------------------------
+    def meta(self, x, y, z):
+        with self.pendingLock:
+            for queued in (self.pendingMeta, self.writingMeta):
+                if (x, y, z) in queued: return queued[(x, y, z)]
+
+        return TileStore.meta(self, x, y, z)
+
+    def setMeta(self, x, y, z, etag, lastModified, expires):
+        if self.metadata is None: return
+        with self.pendingLock:
+            self.pendingMeta[(x, y, z)] = (etag, lastModified, expires)
+
+    def removeMeta(self, x, y, z):
+        if self.metadata is None: return
+        with self.pendingLock:
+            self.pendingMeta[(x, y, z)] = None
+
+    #--------------------------------------------
+    def write(self, x, y, z, data):
+        with self.pendingLock:
+            self.pending[(x, y, z)] = data
+            waiting = len(self.pending)
+
+        self.noteWrite(x, y, z, len(data))
+
+        if waiting >= self.maxPending:
+            self.flush()
+        elif waiting >= self.batchSize:
+            self.wakeEvent.set()
+
+    #--------------------------------------------
+    def flush(self):
+        with self.writeLock:
+            with self.pendingLock:
+                batch, self.pending = self.pending, {}
+                metaBatch, self.pendingMeta = self.pendingMeta, {}
+                self.writing, self.writingMeta = dict(batch), dict(metaBatch)
+
+            try:
+                failed = set()
+                if batch:
+                    try:
+                        failed.update(self.writeBatch(batch) or ())
+                    except Exception as e:
+                        logger.error(f'Could not write {len(batch)} tiles: {e}')
+                        failed.update(batch)
+
+                    written = [tile for tile in batch if tile not in failed]
+                    for x, y, z in written: self.indexAdd(x, y, z)
+                    for x, y, z in failed:
+                        if self.cacheManager is not None: self.cacheManager.removed(self.cacheName, x, y, z)
+                        if self.metadata is not None: metaBatch[(x, y, z)] = None
+
+                    if written and self.onWritten: self.onWritten(self, written)
+                    if failed and self.onWriteFailed: self.onWriteFailed(self, sorted(failed))
+
+                if metaBatch: self.metadata.update(metaBatch)
+            finally:
+                with self.pendingLock:
+                    self.writing, self.writingMeta = {}, {}
+
+    #--------------------------------------------
+    def flushLoop(self):
+        while True:
+            self.wakeEvent.wait(self.flushInterval)
+            if self.flushEvent.is_set(): break
+            self.wakeEvent.clear()
+
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(e)
+
+    #--------------------------------------------
+    def close(self):
+        self.flushEvent.set()
+        self.wakeEvent.set()
+        self.flush()
+
+
+#==============================================================================
+#
+# The osmgpsmap layout: <cache dir>/<zoom>/<x>/<y>.<format>
+#
+# Each tile is written to a temporary file in its directory and renamed into
+# place, so a reader - the paint thread, or another program sharing the
+# cache - never sees a half-written tile. Directories known to exist are
+# remembered, to save a stat per tile.
+#
+class DirectoryTileStore(WriteBehindTileStore):
+
+    def __init__(self, cacheDir, imageFormat = 'png', batchSize = 64, flushInterval = 1.0):
+        WriteBehindTileStore.__init__(self, batchSize, flushInterval)
+        self.cacheDir = cacheDir
+        self.imageFormat = imageFormat
+        self.madeDirs = set()
+        if not os.path.exists(self.cacheDir): os.makedirs(self.cacheDir, exist_ok = True)
+        self.metadata = TileMetadata(os.path.join(self.cacheDir, 'tilemeta.sqlite'))
+
+    #--------------------------------------------
+    @classmethod
+    def forSource(cls, cacheTopLevel, mapSource):
+        return cls(os.path.join(cacheTopLevel, mapSource.hash), mapSource.imageFormat)
+
+    #--------------------------------------------
+    def path(self, x, y, z):
+        return os.path.join(self.cacheDir, str(z), str(x), str(y) + "." + self.imageFormat)
+
+    def key(self, x, y, z):
+        return self.path(x, y, z)
+
+    #--------------------------------------------
+    def exists(self, x, y, z):
+        return self.pendingData(x, y, z) is not None or os.path.exists(self.path(x, y, z))
+
+    #--------------------------------------------
+    def scanZoom(self, z):
+        zoomDir = os.path.join(self.cacheDir, str(z))
+        if not os.path.isdir(zoomDir): return
+
+        suffix = "." + self.imageFormat
+        for xEntry in os.scandir(zoomDir):
+            if not xEntry.is_dir() or not xEntry.name.isdigit(): continue
+
+            for yEntry in os.scandir(xEntry.path):
+                name = yEntry.name
+                if name.endswith(suffix) and name[:-len(suffix)].isdigit():
+                    yield int(xEntry.name), int(name[:-len(suffix)])
+
+    #--------------------------------------------
+    def read(self, x, y, z):
+        data = self.pendingData(x, y, z)
+
+        if data is None:
+            try:
+                with open(self.path(x, y, z), "rb") as fl:
+                    data = fl.read()
+            except FileNotFoundError:
+                return None
+
+        self.noteRead(x, y, z)
+        return data
+
+    #--------------------------------------------
+    def writeBatch(self, batch):
+        failed = []
+        for (x, y, z), data in batch.items():
+            try:
+                self.writeFile(self.path(x, y, z), data)
+            except OSError as e:
+                logger.error(f'Could not write tile {self.path(x, y, z)}: {e}')
+                failed.append((x, y, z))
+
+        logger.debug(f'Wrote {len(batch) - len(failed)} tiles to {self.cacheDir}')
+        return failed
+
+    #--------------------------------------------
+    def writeFile(self, fileName, data):
+        dirname = os.path.dirname(fileName)
+        if dirname not in self.madeDirs:
+            os.makedirs(dirname, exist_ok = True)
+            self.madeDirs.add(dirname)
+
+        try:
+            handle, tempName = tempfile.mkstemp(suffix = '.tmp', dir = dirname)
+        except FileNotFoundError:
+            # Removed behind our back
+            self.madeDirs.discard(dirname)
+            os.makedirs(dirname, exist_ok = True)
+            handle, tempName = tempfile.mkstemp(suffix = '.tmp', dir = dirname)
+
+        try:
+            with os.fdopen(handle, "wb") as fl:
+                fl.write(data)
+            os.replace(tempName, fileName)
+        except BaseException:
+            os.unlink(tempName)
+            raise
+
+    #--------------------------------------------
+    def remove(self, x, y, z):
+        self.indexDiscard(x, y, z)
+        self.noteRemove(x, y, z)
+
+        with self.writeLock:
+            self.discardPending(x, y, z)
+            try:
+                os.remove(self.path(x, y, z))
+            except FileNotFoundError:
+                pass
+
+    #--------------------------------------------
+    def tiles(self):
+        self.flush()
+        for zEntry in os.scandir(self.cacheDir):
+            if not zEntry.is_dir() or not zEntry.name.isdigit(): continue
+
+            z = int(zEntry.name)
+            for x, y in self.scanZoom(z):
+                yield x, y, z
+
+    #--------------------------------------------
+    def tileSizes(self):
+        for x, y, z in self.tiles():
+            try:
+                info = os.stat(self.path(x, y, z))
+            except FileNotFoundError:
+                continue
+            yield x, y, z, info.st_size, info.st_mtime
+
+
+#==============================================================================
+#
+# A single SQLite file in MBTiles layout. Note that MBTiles numbers rows
+# from the south (TMS), so y is flipped on the way in and out.
+#
+# Each batch is inserted in one transaction. The database runs in WAL mode
+# so the paint thread can read while the writer thread writes. Each thread
+# gets its own connection.
+#
+class MBTilesTileStore(WriteBehindTileStore):
+
+    def __init__(self, path, imageFormat = 'png', name = None, batchSize = 64, flushInterval = 1.0):
+        WriteBehindTileStore.__init__(self, batchSize, flushInterval)
+        self.path = path
+        self.imageFormat = imageFormat
+        self.local = threading.local()
+
+        dirname = os.path.dirname(os.path.abspath(path))
+        if not os.path.exists(dirname): os.makedirs(dirname, exist_ok = True)
+
+        db = self.connection()
+        with self.writeLock, db:
+            db.execute('CREATE TABLE IF NOT EXISTS metadata (name TEXT, value TEXT)')
+            db.execute('CREATE UNIQUE INDEX IF NOT EXISTS metadata_name ON metadata (name)')
+            db.execute('CREATE TABLE IF NOT EXISTS tiles '
+                       '(zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+            db.execute('CREATE UNIQUE INDEX IF NOT EXISTS tile_index ON tiles (zoom_level, tile_column, tile_row)')
+            db.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)', ('name', name or os.path.basename(path)))
+            db.execute('INSERT OR IGNORE INTO metadata VALUES (?, ?)', ('format', imageFormat))
+
+        # Tile coordinates here are slippy-map (XYZ), not TMS
+        self.metadata = TileMetadata(path)
+
+    #--------------------------------------------
+    @classmethod
+    def forSource(cls, cacheTopLevel, mapSource):
+        return cls(os.path.join(cacheTopLevel, mapSource.hash + '.mbtiles'), mapSource.imageFormat, mapSource.name)
+
+    #--------------------------------------------
+    def connection(self):
+        db = getattr(self.local, 'db', None)
+
+        if db is None:
+            db = sqlite3.connect(self.path, timeout = 30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+
+        return db
+
+    #--------------------------------------------
+    def key(self, x, y, z):
+        return f'{self.path}/{z}/{x}/{y}'
+
+    #--------------------------------------------
+    def exists(self, x, y, z):
+        if self.pendingData(x, y, z) is not None: return True
+
+        row = self.connection().execute('SELECT 1 FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                        (z, x, (1 << z) - 1 - y)).fetchone()
+        return row is not None
+
+    #--------------------------------------------
+    def scanZoom(self, z):
+        rows = self.connection().execute('SELECT tile_column, tile_row FROM tiles WHERE zoom_level=?', (z,)).fetchall()
+        return [(x, (1 << z) - 1 - row) for x, row in rows]
+
+    #--------------------------------------------
+    def read(self, x, y, z):
+        data = self.pendingData(x, y, z)
+
+        if data is None:
+            row = self.connection().execute('SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                                            (z, x, (1 << z) - 1 - y)).fetchone()
+            if row is None: return None
+            data = bytes(row[0])
+
+        self.noteRead(x, y, z)
+        return data
+
+    #--------------------------------------------
+    def remove(self, x, y, z):
+        self.indexDiscard(x, y, z)
+        self.noteRemove(x, y, z)
+        self.discardPending(x, y, z)
+
+        db = self.connection()
+        with self.writeLock, db:
+            db.execute('DELETE FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?',
+                       (z, x, (1 << z) - 1 - y))
+
+    #--------------------------------------------
+    def tiles(self):
+        self.flush()
+        rows = self.connection().execute('SELECT tile_column, tile_row, zoom_level FROM tiles')
+        for x, row, z in rows:
+            yield x, (1 << z) - 1 - row, z
+
+    #--------------------------------------------
+    def tileSizes(self):
+        self.flush()
+        rows = self.connection().execute('SELECT tile_column, tile_row, zoom_level, length(tile_data) FROM tiles')
+        for x, row, z, size in rows:
+            yield x, (1 << z) - 1 - row, z, size, 0.0
+
+    #--------------------------------------------
+    def writeBatch(self, batch):
+        db = self.connection()
+        with db:
+            db.executemany('INSERT OR REPLACE INTO tiles VALUES (?, ?, ?, ?)',
+                           [(z, x, (1 << z) - 1 - y, sqlite3.Binary(data)) for (x, y, z), data in batch.items()])
+
+        logger.debug(f'Wrote {len(batch)} tiles to {self.path}')
+
+
+#------------------------------------------------------------------------------------------
+
+def copyTiles(source, destination):
+    ''' Copy every tile from one store to another, e.g. from an osmgpsmap
+        cache directory into an MBTiles file. Returns the number of tiles copied '''
+    count = 0
+
+    for x, y, z in source.tiles():
+        data = source.read(x, y, z)
+        if data is None: continue
+        destination.write(x, y, z, data)
+        count += 1
+
+    destination.flush()
+    return count
+
+
+#------------------------------------------------------------------------------------------
+
+if __name__ == "__main__":
+    if len(sys.argv) < 4 or sys.argv[1] not in ('import', 'export'):
+        print(__doc__)
+        sys.exit(1)
+
+    imageFormat = sys.argv[4] if len(sys.argv) > 4 else 'png'
+
+    if sys.argv[1] == 'import':
+        source = DirectoryTileStore(sys.argv[2], imageFormat)
+        destination = MBTilesTileStore(sys.argv[3], imageFormat)
+    else:
+        source = MBTilesTileStore(sys.argv[2], imageFormat)
+        destination = DirectoryTileStore(sys.argv[3], imageFormat)
+
+    print(f'Copied {copyTiles(source, destination)} tiles')
+    destination.close()
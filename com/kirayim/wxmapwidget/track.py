@@ -0,0 +1,154 @@
+'''
+Compact storage for a track of timed lat/lon points.
+
+Points are kept sorted by time in growable numpy arrays. Appending in time
+order - the normal case for telemetry, repeated timestamps included - is
+amortised O(1); an out-of-order point is inserted with a binary search. Projected positions are cached per
+zoom level in world pixels (projection units times the tile size) and only
+the points added since the last projection are converted, so drawing a long
+track costs one subtraction per point rather than a projection.
+'''
+
+import numpy
+
+from tilenames import latlon2xy_many, tileSizePixels
+from tiles import LimitedSizeDict
+
+
+#==============================================================================
+class TrackStore:
+
+    def __init__(self, capacity = 1024, maxPoints = None, zoomLevelsCached = 4):
+        ''' maxPoints - if set, the oldest points are discarded beyond this many '''
+        self.time = numpy.empty(capacity, dtype = numpy.float64)
+        self.lat = numpy.empty(capacity, dtype = numpy.float64)
+        self.lon = numpy.empty(capacity, dtype = numpy.float64)
+        self.count = 0
+        self.maxPoints = maxPoints
+        
+        # Counts changes other than appending at the end, for anything derived from the points
+        self.edits = 0
+
+        # zoom -> [world x array, world y array, number of points projected]
+        self.projected = LimitedSizeDict(size_limit = zoomLevelsCached)
+
+    #--------------------------------------------
+    def __len__(self):
+        return self.count
+
+    #--------------------------------------------
+    def grow(self, needed):
+        capacity = len(self.time)
+        if needed <= capacity: return
+
+        while capacity < needed: capacity *= 2
+        for name in ('time', 'lat', 'lon'):
+            old = getattr(self, name)
+            new = numpy.empty(capacity, dtype = numpy.float64)
+            new[:self.count] = old[:self.count]
+            setattr(self, name, new)
+
+    #--------------------------------------------
+    def append(self, time, lat, lon):
+        ''' Add a point. A point no earlier than the last one is appended - GPS feeds
+            often repeat a timestamp. An earlier point at a time already stored replaces it '''
+        if hasattr(time, 'timestamp'): time = time.timestamp()
+        n = self.count
+
+        if n == 0 or time >= self.time[n - 1]:
+            self.grow(n + 1)
+            self.time[n], self.lat[n], self.lon[n] = time, lat, lon
+            self.count += 1
+
+        else:
+            i = int(numpy.searchsorted(self.time[:n], time))
+            if i < n and self.time[i] == time:
+                self.lat[i], self.lon[i] = lat, lon
+            else:
+                self.grow(n + 1)
+                for array in (self.time, self.lat, self.lon):
+                    array[i + 1:n + 1] = array[i:n]
+                self.time[i], self.lat[i], self.lon[i] = time, lat, lon
+                self.count += 1
+
+            # Projections from i onwards are now out of date
+            self.edits += 1
+            for entry in self.projected.values():
+                entry[2] = min(entry[2], i)
+
+        if self.maxPoints is not None and self.count > self.maxPoints:
+            self.discardOldest(self.count - self.maxPoints + self.maxPoints // 10)
+
+    #--------------------------------------------
+    def discardOldest(self, n):
+        n = min(n, self.count)
+        keep = self.count - n
+
+        for array in (self.time, self.lat, self.lon):
+            array[:keep] = array[n:self.count]
+
+        for entry in self.projected.values():
+            done = max(entry[2] - n, 0)
+            entry[0][:done] = entry[0][n:n + done]
+            entry[1][:done] = entry[1][n:n + done]
+            entry[2] = done
+
+        self.count = keep
+        self.edits += 1
+
+    #--------------------------------------------
+    def clear(self):
+        self.count = 0
+        self.edits += 1
+        self.projected.clear()
+
+    #--------------------------------------------
+    def window(self, startTime = None, endTime = None):
+        ''' Index range [start, stop) of the points with startTime <= time <= endTime '''
+        times = self.time[:self.count]
+        start = 0 if startTime is None else int(numpy.searchsorted(times, startTime, 'left'))
+        stop = self.count if endTime is None else int(numpy.searchsorted(times, endTime, 'right'))
+        return start, stop
+
+    #--------------------------------------------
+    def points(self, start = 0, stop = None):
+        ''' (time, lat, lon) arrays - views, not copies '''
+        stop = self.count if stop is None else stop
+        return self.time[start:stop], self.lat[start:stop], self.lon[start:stop]
+
+    #--------------------------------------------
+    def world(self, zoom, start = 0, stop = None):
+        ''' Positions in world pixels at a zoom level, projecting only what has not been projected yet '''
+        stop = self.count if stop is None else stop
+        entry = self.projected.get(zoom)
+
+        if entry is None or len(entry[0]) < self.count:
+            capacity = len(self.time)
+            wx, wy = numpy.empty(capacity), numpy.empty(capacity)
+            done = 0
+            if entry is not None:
+                done = entry[2]
+                wx[:done], wy[:done] = entry[0][:done], entry[1][:done]
+            entry = [wx, wy, done]
+
+        self.projected[zoom] = entry
+        wx, wy, done = entry
+
+        if done < self.count:
+            x, y = latlon2xy_many(self.lat[done:self.count], self.lon[done:self.count], zoom)
+            wx[done:self.count] = x * tileSizePixels()
+            wy[done:self.count] = y * tileSizePixels()
+            entry[2] = self.count
+
+        return wx[start:stop], wy[start:stop]
+
+    #--------------------------------------------
+    def screen(self, projection, start = 0, stop = None, indices = None):
+        ''' Display positions for the projection's current view, as int32 arrays. 
+            If indices are given, only for those points '''
+        wx, wy = self.world(projection.zoom, start, stop)
+        if indices is not None: wx, wy = wx[indices - start], wy[indices - start]
+        scale = projection.scale / tileSizePixels()
+        x = (wx * scale - projection.px1 * projection.scale).astype(numpy.int32)
+        y = (wy * scale - projection.py1 * projection.scale).astype(numpy.int32)
+        return x, y
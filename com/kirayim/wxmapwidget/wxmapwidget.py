@@ -5,21 +5,37 @@ Created on Jun 27, 2020
 @author: shalomc
 '''
 
+import io
+import itertools
 import math
 import sys
 import os
+import logging
+import weakref
 
 scriptPath = os.path.dirname(os.path.abspath(__file__))
 sys.path.insert(0, scriptPath)
 
 from projection import Projection
-from tiles import Tiles, LimitedSizeDict
+from tiles import Tiles
+from bitmapcache import BitmapCache
+from backbuffer import TileBackBuffer
+from renderscheduler import RenderScheduler
+from tilefallback import TileFallback
+from prefetch import Prefetcher
+from track import TrackStore
+from simplify import SimplificationPyramid
+from spatialindex import TileGridIndex
+from layersurface import LayerSurface
 
 import wx
+import numpy
 import tilenames
 
 wx.InitAllImageHandlers()
 
+logger = logging.getLogger('wxmapwidget')
+
 
 def drawArrowhead(dc, fromX, fromY, toX, toY, color = wx.BLACK, filled=True, width=3):
     ang = math.atan2(toX - fromX, fromY - toY);
@@ -63,11 +79,44 @@ def drawProjArrow(dc, x, y, toX, toY):
     dc.DrawLine(x, y, toX, toY)
     drawArrowhead(dc, x, y, toX, toY, filled = False)
     
+#------------------------------------------------------------------------------------------
+
+def drawPolylineCulled(dc, xs, ys, w, h):
+    ''' Draw a polyline given as screen coordinate arrays, skipping segments
+        whose bounding box is off the w x h screen '''
+    if len(xs) < 2: return
+    
+    visible = (numpy.minimum(xs[:-1], xs[1:]) <= w) & (numpy.maximum(xs[:-1], xs[1:]) >= 0) & \
+              (numpy.minimum(ys[:-1], ys[1:]) <= h) & (numpy.maximum(ys[:-1], ys[1:]) >= 0)
+    if not visible.any(): return
+    
+    # Runs of consecutive visible segments, each drawn as one polyline
+    edges = numpy.diff(numpy.concatenate(([0], visible.view(numpy.int8), [0])))
+    for start, stop in zip(numpy.flatnonzero(edges == 1), numpy.flatnonzero(edges == -1)):
+        dc.DrawLines(list(zip(xs[start:stop + 1].tolist(), ys[start:stop + 1].tolist())))
+    
 
 #=====================================================================
 class SlippyLayer:
+    # Set True to have the layer drawn into a cached transparent surface, which is
+    # moved rather than redrawn when panning, and only redrawn after invalidate()
+    # or a zoom or size change. For layers drawn in map rather than screen coordinates
+    cached = False
+    revision = 0
+    
     def do_draw(self, gpsmap, dc):
         pass
+    
+    def invalidate(self):
+        ''' The layer's content has changed - redraw its cached surface '''
+        self.revision += 1
+        for gpsmap in getattr(self, 'maps', ()):
+            gpsmap.scheduleRefresh()
+    
+    def mouse_rect(self, gpsmap):
+        ''' Rectangle to repaint when only the mouse position has changed, 
+            or None if the layer does not depend on the mouse '''
+        return None
 
 
 class DroneSymbol(SlippyLayer):
@@ -75,14 +124,15 @@ class DroneSymbol(SlippyLayer):
     def __init__(self):
         self.heading = self.lat = self.lon = 0
         self.projLat = self.projLon = self.projHeight = None
-        self.path = {}
+        self.path = TrackStore()
+        self.pathDetail = SimplificationPyramid(self.path)
         self.corners = []
 
     def set_position(self, time, lat, lon):
         self.lat, self.lon = lat, lon
         
         if lat != 0 and lon != 0:
-            self.path[time] = (lat, lon)
+            self.path.append(time, lat, lon)
         
     def set_heading(self, heading):
         self.heading = heading
@@ -95,16 +145,17 @@ class DroneSymbol(SlippyLayer):
             projX, projY = gpsmap.ll2xy(self.projLat, self.projLon)
             drawProjArrow(dc, x, y, projX, projY)
             
+        if len(self.path) < 2: return
+        
         dc.SetPen(wx.Pen(wx.BLACK, 2));
-        lastX = lastY = None
-        for time in sorted(self.path):
-            point = self.path[time]
-            x, y = gpsmap.ll2xy(point[0], point[1])
-            if lastX is None:
-                lastX, lastY = x, y
-            else:
-                dc.DrawLine(lastX, lastY, x, y)
-                lastX, lastY = x, y
+        xs, ys = self.path.screen(gpsmap, indices = self.pathDetail.indices(gpsmap.zoom))
+        
+        # Consecutive points on the same pixel add nothing
+        moved = numpy.ones(len(xs), dtype = bool)
+        moved[1:] = (xs[1:] != xs[:-1]) | (ys[1:] != ys[:-1])
+        xs, ys = xs[moved], ys[moved]
+        
+        drawPolylineCulled(dc, xs, ys, gpsmap.w, gpsmap.h)
         
     def setProjCorners(self, corners):
         self.corners = corners
@@ -116,6 +167,19 @@ class DroneSymbol(SlippyLayer):
 #------------------------------------------------------------------------------------------
 
 class PosMarker(SlippyLayer):
+    def __init__(self):
+        self.rect = None
+        
+    def mouse_rect(self, gpsmap):
+        size = gpsmap.GetSize()
+        if self.rect is None:
+            return wx.Rect(0, size.GetHeight() - 50, size.GetWidth(), 50)
+        
+        # Leave room for the text getting wider
+        rect = wx.Rect(self.rect)
+        rect.SetLeft(rect.GetLeft() - 30)
+        return rect
+        
     def do_draw(self, gpsmap, dc):
         size = gpsmap.GetSize()
         lat, lon = gpsmap.xy2ll(gpsmap.mousePosition.x, gpsmap.mousePosition.y)
@@ -131,6 +195,8 @@ class PosMarker(SlippyLayer):
         
         dc.SetTextForeground(wx.BLACK)
         dc.DrawText(position, startX - 1, startY - 1)
+        
+        self.rect = wx.Rect(startX - 1, startY - 1, w + 2, h + 2)
     
 #=====================================================================
 #
@@ -196,22 +262,163 @@ class ScaleMarkLayer(SlippyLayer):
                 
     
     
+#=====================================================================
+#
+# Debug overlay - paint, decode and download times, queue depth and hit
+# rates from the map's stats(), in the top left corner
+#
+class MetricsOverlay(SlippyLayer):
+    
+    def lines(self, stats):
+        histograms = stats['histograms']
+        
+        def timing(name):
+            h = histograms.get(name)
+            return f"{h['p50']:.1f}/{h['p99']:.1f} ms" if h else '-'
+        
+        def rate(value):
+            return '-' if value is None else f'{value * 100:.0f}%'
+        
+        downloads = [name for name in histograms if name.startswith('download.ms.')]
+        downloaded = sum(h['count'] for name, h in histograms.items() if name.startswith('download.bytes.'))
+        nbytes = sum(h['total'] for name, h in histograms.items() if name.startswith('download.bytes.'))
+        
+        lines = [f"paint p50/p99 {timing('paint.total')}  tiles {timing('paint.tiles')}",
+                 *(f"  {name[len('paint.layer.'):]} {timing(name)}" for name in histograms if name.startswith('paint.layer.')),
+                 f"decode {timing('decode')}",
+                 *(f"download {name[len('download.ms.'):]} {timing(name)}" for name in downloads),
+                 f"downloaded {downloaded} tiles {nbytes / 1e6:.1f} MB",
+                 f"queue {stats['gauges'].get('queue.tiers')}  pending {stats['gauges'].get('pending')}",
+                 f"hit rate: disk {rate(stats['diskHitRate'])}  bitmaps {rate(stats.get('bitmapCache', {}).get('hitRate'))}",
+                 f"failing tiles {stats['failures']['blockedTiles']}"]
+        return lines
+        
+    def do_draw(self, gpsmap, dc):
+        lines = self.lines(gpsmap.stats())
+        
+        dc.SetFont(wx.Font(wx.FontInfo(8).Family(wx.FONTFAMILY_TELETYPE)))
+        lineHeight = dc.GetCharHeight()
+        width = max(dc.GetTextExtent(line).GetWidth() for line in lines)
+        
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.SetBrush(wx.Brush(wx.Colour(0, 0, 0, 160)))
+        dc.DrawRectangle(4, 4, width + 8, lineHeight * len(lines) + 8)
+        
+        dc.SetTextForeground(wx.WHITE)
+        for i, line in enumerate(lines):
+            dc.DrawText(line, 8, 8 + i * lineHeight)
+
+
+#=====================================================================
+#
+# Base for layers with many features. Features are kept in a spatial 
+# index, and only those inside the current view are drawn. Long
+# polylines are split into chunks which are indexed separately.
+# Override draw_feature to change how features look.
+#
+class GeometryFeature:
+    __slots__ = ('lats', 'lons', 'data')
+    
+    def __init__(self, lats, lons, data = None):
+        self.lats = numpy.asarray(lats, dtype = numpy.float64)
+        self.lons = numpy.asarray(lons, dtype = numpy.float64)
+        self.data = data
+        
+    def bounds(self):
+        return self.lats.min(), self.lons.min(), self.lats.max(), self.lons.max()   # S,W,N,E
+
+
+class GeometryLayer(SlippyLayer):
+    chunkSize = 256
+    cached = True
+    
+    def __init__(self, indexZoom = 12):
+        self.index = TileGridIndex(indexZoom)
+        self.features = {}
+        self.ids = itertools.count()
+        
+    def add_point(self, lat, lon, data = None):
+        ''' Returns an id for remove() '''
+        return self.add_feature(GeometryFeature([lat], [lon], data))
+    
+    def add_polyline(self, lats, lons, data = None):
+        ''' Returns a list of ids, one per chunk '''
+        lats, lons = numpy.asarray(lats, dtype = numpy.float64), numpy.asarray(lons, dtype = numpy.float64)
+        
+        # Chunks share their end points so the line stays joined up
+        return [self.add_feature(GeometryFeature(lats[start:start + self.chunkSize + 1], 
+                                                 lons[start:start + self.chunkSize + 1], data))
+                for start in range(0, max(len(lats) - 1, 1), self.chunkSize)]
+    
+    def add_feature(self, feature):
+        featureId = next(self.ids)
+        self.features[featureId] = feature
+        self.index.insert(featureId, *feature.bounds())
+        self.invalidate()
+        return featureId
+        
+    def remove(self, ids):
+        if isinstance(ids, int): ids = [ids]
+        for featureId in ids:
+            self.index.remove(featureId)
+            self.features.pop(featureId, None)
+        self.invalidate()
+            
+    def visible_features(self, gpsmap):
+        return [self.features[featureId] for featureId in self.index.query(gpsmap.S, gpsmap.W, gpsmap.N, gpsmap.E)]
+            
+    def do_draw(self, gpsmap, dc):
+        for feature in self.visible_features(gpsmap):
+            self.draw_feature(gpsmap, dc, feature)
+            
+    def draw_feature(self, gpsmap, dc, feature):
+        xs, ys = gpsmap.ll2xyi_array(feature.lats, feature.lons)
+        dc.SetPen(wx.Pen(wx.BLUE, 2))
+        
+        if len(xs) == 1:
+            dc.SetBrush(wx.BLUE_BRUSH)
+            dc.DrawCircle(int(xs[0]), int(ys[0]), 3)
+        else:
+            dc.DrawLines(list(zip(xs.tolist(), ys.tolist())))
+    
 #--------------------------------------------------------------------------------
 
 class WxMapWidget(wx.Panel, Projection, Tiles):
 
-    cachedTileBitmaps = LimitedSizeDict(size_limit = 32)
-
-    def __init__(self, parent, lat = 32.10932741542229, lon = 34.89818882620658, zoom = 15):
+    # Shared by all map widgets
+    cachedTileBitmaps = BitmapCache()
+    
+    # How many viewports' worth of decoded tiles the cache should at least hold
+    bitmapCacheViewports = 3
+
+    def __init__(self, parent, lat = 32.10932741542229, lon = 34.89818882620658, zoom = 15, fps = 30, 
+                 cacheManager = None, tileService = None, cacheTopLevel = None):
+        ''' Maps showing the same area should share a tileService, e.g. TileService.shared(),
+            so each tile is downloaded and decoded once for all of them. Tiles are cached 
+            under 'cacheTopLevel', by default ~/.cache/osmgpsmap '''
         super().__init__(parent)
+        self.renderScheduler = RenderScheduler(self, fps)
         Projection.__init__(self)
-        Tiles.__init__(self, self.tileRetrieved)
+        self.backBuffer = TileBackBuffer(self.drawTile)
+        Tiles.__init__(self, self.tileRetrieved, cacheManager = cacheManager, service = tileService,
+                       cacheTopLevel = cacheTopLevel)
+        self.tileDecoder = self.tileService.decoder(self.decodeTileImage)
+        self.tileFallback = TileFallback(self.cachedTileBitmaps, self.fileName, self.requestDecode)
+        self.prefetcher = Prefetcher(self)
+        size = self.GetSize()
+        self.mousePosition = wx.Point(size.GetWidth() // 2, size.GetHeight() // 2)
         self.recentre(lat, lon, zoom)
         self.drag = False
         self.dragStartCoords = (0, 0)
         self.layers = []
+        self.layerSurfaces = {}
+        
+        # Layer -> the metric its paint time goes to: paint.layer.<class name>, with a
+        # number after the first layer of a class
+        self.layerNames = {}
         self.Bind(wx.EVT_SIZE, self.sizeChanged)
         self.Bind(wx.EVT_PAINT, self.updatePanel)
+        self.Bind(wx.EVT_WINDOW_DESTROY, self.destroyed)
         self.Bind(wx.EVT_MOUSEWHEEL, self.scroll_event)
         
         self.Bind(wx.EVT_LEFT_DOWN, self.click)
@@ -219,19 +426,38 @@ class WxMapWidget(wx.Panel, Projection, Tiles):
         self.Bind(wx.EVT_MOTION, self.mousemove)
         
         self.Bind(wx.EVT_MOUSEWHEEL, self.scroll_event)
-        size = self.GetSize()
-        self.mousePosition = wx.Point(size.GetWidth() // 2, size.GetHeight() // 2)
         
         self.SetBackgroundStyle(wx.BG_STYLE_PAINT)
         
         
+    def findEdges(self):
+        Projection.findEdges(self)
+        
+        if not self.needsEdgeFind:
+            self.setViewport(self.zoom, self.px1, self.py1, self.px2, self.py2)
+            self.prefetcher.update(self, (self.mousePosition.x, self.mousePosition.y))
+            
+    #------------------------------------------------------------------------------------------
+    
     def sizeChanged(self, evt):
         size = evt.GetSize();
         self.setView(0, 0, size.GetWidth(), size.GetHeight())
         self.findEdges()
+        
+        tileSize = tilenames.tileSizePixels()
+        tilesAcross = size.GetWidth() // tileSize + 2
+        tilesDown = size.GetHeight() // tileSize + 2
+        self.cachedTileBitmaps.ensureBudget(self.bitmapCacheViewports * tilesAcross * tilesDown * tileSize * tileSize * 4)
 
     #------------------------------------------------------------------------------------------
-    
+
+    def destroyed(self, evt):
+        # Children's destroy events come here too
+        if evt.GetEventObject() is self: self.close()
+        evt.Skip()
+
+    #------------------------------------------------------------------------------------------
+
     def scroll_event(self, evt):
         rotation = evt.GetWheelRotation()
         
@@ -240,7 +466,7 @@ class WxMapWidget(wx.Panel, Projection, Tiles):
         elif rotation < 0:
             self.implementNewZoom(self.zoom  - 1)
             
-        self.Refresh()
+        self.scheduleRefresh()
 
 
     #--------------------------------------------        
@@ -258,81 +484,189 @@ class WxMapWidget(wx.Panel, Projection, Tiles):
         pos = evt.GetPosition()
         self.mousePosition = pos
         if evt.Dragging():
+            self.prefetcher.panned(pos.x - self.dragStartCoords[0], pos.y - self.dragStartCoords[1])
             self.nudge(pos.x - self.dragStartCoords[0], pos.y - self.dragStartCoords[1])
             self.dragStartCoords = (pos.x, pos.y)
+            self.scheduleRefresh()
+            return
             
-        self.Refresh()
+        for layer in self.layers:
+            rect = layer.mouse_rect(self)
+            if rect is not None: self.scheduleRefresh(rect)
 
     #------------------------------------------------------------------------------------------
     
-    def tileRetrieved(self, _filename):
-        self.Refresh()
+    def scheduleRefresh(self, rect = None):
+        ''' Repaint rect (or everything) at the next frame. May be called from any thread '''
+        self.renderScheduler.invalidate(rect)
+        
+    def tileRect(self, x, y):
+        left, top = self.pxpy2xyi(x, y)
+        return wx.Rect(left, top, tilenames.tileSizePixels(), tilenames.tileSizePixels())
 
     #------------------------------------------------------------------------------------------
     
-    def updatePanel(self, _evt):
-        dc = wx.BufferedPaintDC(self)
+    def tileRetrieved(self, key, x, y, z, data = None):
+        ''' Called on a download thread. Decodes the downloaded bytes as they are, 
+            without waiting for them to reach the disk '''
+        self.tileDecoder.request(key, self.tileStore, x, y, z, data, self.tileDecoded)
+
+    #------------------------------------------------------------------------------------------
+    
+    @staticmethod
+    def decodeTileImage(data):
+        ''' Runs on a decoder thread - wx.Image, unlike wx.Bitmap, may be made off the UI thread '''
+        image = wx.Image(io.BytesIO(data), wx.BITMAP_TYPE_ANY)
+        return image if image.IsOk() else None
+        
+    def tileDecoded(self, key, image, x, y, z):
+        ''' Called on a decoder thread - a good place to look up when the tile expires '''
+        if image is not None and self.revalidate: self.loadExpiry(x, y, z, key)
+        wx.CallAfter(self.installDecodedTile, key, image, x, y, z)
+        
+    def installDecodedTile(self, key, image, x, y, z):
+        if not self: return   # Widget destroyed meanwhile
         
+        if image is None:
+            # Throw the tile away. It is downloaded again when it is next drawn, 
+            # unless it has failed too often lately
+            # Only once, though every map sharing the tile is told
+            if self.tileStore.has(x, y, z):
+                logger.error(f'Could not decode tile {key}')
+                self.failures.failed(key, self.mapSource.name, 'undecodable')
+                self.tileStore.invalidate(x, y, z)
+            return
+        
+        self.cachedTileBitmaps.put(key, wx.Bitmap(image))
+        
+        # It may replace a stand-in, or an older version of the tile, already in the back buffer
+        self.backBuffer.redrawTile(x, y, z)
+        
+        if z == self.zoom: 
+            self.scheduleRefresh(self.tileRect(x, y))
+        else:
+            # Probably wanted as a stand-in for tiles at this zoom
+            self.scheduleRefresh()
+            
+    def setMapSource(self, mapSource):
+        Tiles.setMapSource(self, mapSource)
+        self.backBuffer.invalidate()
+        self.scheduleRefresh()
+        
+    def clearTileCache(self):
+        ''' Forget every decoded tile bitmap, e.g. after the tiles on disk were replaced '''
+        self.cachedTileBitmaps.clear()
+        self.backBuffer.invalidate()
+        self.scheduleRefresh()
+            
+    def requestDecode(self, x, y, z):
+        if not self.tileStore.has(x, y, z): return False
+        self.tileDecoder.request(self.fileName(x, y, z), self.tileStore, x, y, z, callback = self.tileDecoded)
+        return True
+
+    #------------------------------------------------------------------------------------------
+    
+    def drawTile(self, dc, x, y, z, left, top):
+        ''' Draw one tile at (left, top), or a placeholder if it is not ready. False for a placeholder '''
+        key = self.fileName(x, y, z)
+        bitmap, provisional = self.cachedTileBitmaps.lookup(key)
+        
+        if bitmap and not provisional:
+            dc.DrawBitmap(bitmap, left, top, True)
+            self.prefetcher.displayed(key)
+            self.revalidateIfStale(x, y, z)
+            return True
+        
+        if not self.inRing(x, y, z):
+            # In the back buffer's margin, off screen and past the download ring, where the queue
+            # would drop the download straight away. Placeholders are retried every paint, so it
+            # is looked up once it comes into the ring, before it comes on screen
+            if bitmap: dc.DrawBitmap(bitmap, left, top, True)
+            return False
+        
+        # Placeholders are retried every paint - only look the tile up again once its decode is done
+        if not self.tileDecoder.isPending(key) and self.getTile(x, y, z):
+            # Decoded off the UI thread - placeholder until it is ready
+            self.tileDecoder.request(key, self.tileStore, x, y, z, callback = self.tileDecoded)
+            
+        if not bitmap:
+            # Stand in for it with what we have of the zoom levels above and below
+            bitmap = self.tileFallback.synthesise(x, y, z)
+            if bitmap: self.cachedTileBitmaps.put(key, bitmap, provisional = True)
+            
+        if bitmap:
+            dc.DrawBitmap(bitmap, left, top, True)
+            return False
+            
         dc.SetBrush(wx.GREEN_BRUSH)
         dc.SetPen(wx.BLACK_PEN)
+        dc.DrawRectangle(left, top, tilenames.tileSizePixels(), tilenames.tileSizePixels())
+        return False
         
-        for x in range(int(math.floor(self.px1)), int(math.ceil(self.px2))):
-            for y in range(int(math.floor(self.py1)), int(math.ceil(self.py2))):
-                tileFileName = self.getTile(x, y, self.zoom)
-                
-                x1,y1 = self.pxpy2xyi(x,y)
-                
-                if not tileFileName: 
-                    dc.DrawRectangle(x1, y1, tilenames.tileSizePixels(), tilenames.tileSizePixels())
-                    continue
-                
-                bitmap = self.cachedTileBitmaps.get(tileFileName)
-                
-                if not bitmap:
-                    try:
-                        bitmap = wx.Bitmap(tileFileName, wx.BITMAP_TYPE_ANY)
-                    except Exception as e:
-                        print(e)
-                        dc.DrawRectangle(x1, y1, tilenames.tileSizePixels(), tilenames.tileSizePixels())
-                        self.queueDownloadTile(x, y, self.zoom, True)
-                        continue
-                    
-                if bitmap.IsOk():
-                    self.cachedTileBitmaps.update({tileFileName: bitmap})
-                    
-                    # Convert those edges to screen coordinates
-                    dc.DrawBitmap(bitmap, int(x1), int(y1), True)
-                else:
-                    self.cachedTileBitmaps.remove({tileFileName: bitmap})
-                    dc.DrawRectangle(x1, y1, tilenames.tileSizePixels(), tilenames.tileSizePixels())
+    #------------------------------------------------------------------------------------------
+    
+    def updatePanel(self, _evt):
+        with self.metrics.timing('paint.total'):
+            dc = wx.BufferedPaintDC(self)
+            with self.metrics.timing('paint.tiles'):
+                self.backBuffer.draw(dc, self)
+    
+            for layer in self.layers:
+                with self.metrics.timing(self.layerNames[layer]):
+                    if layer.cached:
+                        surface = self.layerSurfaces.get(layer)
+                        if surface is None: surface = self.layerSurfaces[layer] = LayerSurface()
+                        surface.draw(dc, self, layer)
+                    else:
+                        layer.do_draw(self, dc)
 
-        for layer in self.layers:
-            layer.do_draw(self, dc)
+    #--------------------------------------------
+    def stats(self):
+        ''' Snapshot of the map's measurements: paint times per layer, decode and 
+            download times, queue depth, hit rates and so on, as a dict '''
+        stats = Tiles.stats(self)
+        stats['bitmapCache'] = self.cachedTileBitmaps.stats()
+        stats['prefetch'] = self.prefetcher.stats()
+        stats['frames'] = self.renderScheduler.frames
+        stats['refreshRequests'] = self.renderScheduler.requests
+        return stats
 
     #------------------------------------------------------------------------------------------
     
     def set_center_and_zoom(self, lat, lon, zoom):
         self.recentre(lat, lon, zoom)
-        self.Refresh()
+        self.scheduleRefresh()
 
     def set_center(self, lat, lon):
         self.recentre(lat, lon, self.zoom)
-        self.Refresh()
+        self.scheduleRefresh()
 
     def set_zoom(self, zoom):
         self.implementNewZoom(zoom)
-        self.Refresh()
+        self.scheduleRefresh()
 
     #--------------------------------------------
     def layer_add(self, layer):
         if not isinstance(layer, SlippyLayer): raise Exception('Not a slippy layer')
         self.layers.append(layer)
-        self.Refresh()
+        if layer not in self.layerNames:
+            base = f'paint.layer.{type(layer).__name__}'
+            name, number = base, 1
+            while name in self.layerNames.values():
+                number += 1
+                name = f'{base}.{number}'
+            self.layerNames[layer] = name
+        if 'maps' not in layer.__dict__: layer.maps = weakref.WeakSet()
+        layer.maps.add(self)
+        self.scheduleRefresh()
         
     #--------------------------------------------        
     def layer_remove(self, layer):
         if layer in self.layers: self.layers.remove(layer)
-        self.Refresh()
+        self.layerSurfaces.pop(layer, None)
+        self.layerNames.pop(layer, None)
+        if 'maps' in layer.__dict__: layer.maps.discard(self)
+        self.scheduleRefresh()
           
     #--------------------------------------------
     def latlon_to_screen(self, lat, lon):
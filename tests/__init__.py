@@ -0,0 +1,12 @@
+'''
+Unit tests for the map widget. Those which need wx are skipped without it.
+
+The modules import each other by bare name, the way wxmapwidget.py does,
+so the package directory goes on the path here.
+'''
+
+import os
+import sys
+
+packagePath = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'com', 'kirayim', 'wxmapwidget')
+if packagePath not in sys.path: sys.path.insert(0, packagePath)
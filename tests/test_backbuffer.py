@@ -0,0 +1,122 @@
+'''
+TileBackBuffer - which tiles are drawn as the view pans - and the download
+ring the map draws tiles for.
+'''
+
+import shutil
+import tempfile
+import unittest
+
+from tiles import Tiles, TileJob, TileQueue
+
+try:
+    import wx
+    from backbuffer import TileBackBuffer
+except ImportError:
+    wx = None
+
+TILE = 256
+
+
+#==============================================================================
+class InRingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheTopLevel = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.tiles = Tiles(cacheTopLevel = self.cacheTopLevel, downloaders = 0)
+
+    def tearDown(self):
+        self.tiles.close()
+        shutil.rmtree(self.cacheTopLevel, ignore_errors = True)
+
+    def testSameTilesAsTheQueueKeeps(self):
+        self.assertTrue(self.tiles.inRing(0, 0, 3))
+
+        viewport = (10, 100.3, 200.6, 103.2, 202.9)
+        self.tiles.setViewport(*viewport)
+        queueViewport = viewport + (self.tiles.prefetchRing, None)
+
+        for x in range(95, 110):
+            for y in range(195, 210):
+                job = TileJob('', None, '', x, y, 10)
+                self.assertEqual(self.tiles.inRing(x, y, 10), self.tiles.queue.rankIn(job, queueViewport) is not None)
+
+        self.assertFalse(self.tiles.inRing(101, 201, 11))
+
+
+#==============================================================================
+class View:
+    ''' The parts of a Projection the back buffer uses, in tile units '''
+
+    def __init__(self, px1, py1, w = 512, h = 256, zoom = 10):
+        self.px1, self.py1, self.w, self.h, self.zoom = px1, py1, w, h, zoom
+        self.scale = TILE
+
+
+@unittest.skipIf(wx is None, 'wxPython is not installed')
+class TileBackBufferTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = wx.App(False)
+
+    def setUp(self):
+        self.drawn = []
+        self.missing = set()
+        self.buffer = TileBackBuffer(self.drawTile, margin = TILE)
+        self.target = wx.Bitmap(512, 256)
+        self.dc = wx.MemoryDC(self.target)
+
+    def tearDown(self):
+        self.dc.SelectObject(wx.NullBitmap)
+
+    def drawTile(self, dc, x, y, z, left, top):
+        self.drawn.append((x, y, z, left, top))
+        return (x, y) not in self.missing
+
+    def draw(self, view):
+        self.drawn = []
+        self.buffer.draw(self.dc, view)
+        return {(x, y) for x, y, _z, _left, _top in self.drawn}
+
+    #--------------------------------------------
+    def testComposesTheViewAndItsMargin(self):
+        tiles = self.draw(View(10, 20))
+        self.assertEqual(tiles, {(x, y) for x in range(9, 13) for y in range(19, 22)})
+        self.assertEqual(len(self.drawn), len(tiles))
+        self.assertIn((10, 20, 10, TILE, TILE), self.drawn)
+
+    def testPanningWithinTheMarginDrawsNothing(self):
+        self.draw(View(10, 20))
+        self.assertEqual(self.draw(View(10 + 100 / TILE, 20 - 50 / TILE)), set())
+
+    def testPanningPastTheMarginDrawsOnlyWhatIsExposed(self):
+        self.draw(View(10, 20))
+        tiles = self.draw(View(10 + 513 / TILE, 20))
+        self.assertEqual(tiles, {(x, y) for x in range(13, 16) for y in range(19, 22)})
+
+    def testPlaceholdersAreRetriedUntilDrawn(self):
+        self.missing.add((10, 20))
+        self.draw(View(10, 20))
+        self.assertEqual(self.draw(View(10, 20)), {(10, 20)})
+
+        self.missing.clear()
+        self.assertEqual(self.draw(View(10, 20)), {(10, 20)})
+        self.assertEqual(self.draw(View(10, 20)), set())
+
+    def testRedrawTileAndInvalidate(self):
+        self.draw(View(10, 20))
+        self.buffer.redrawTile(10, 20, 10)
+        self.buffer.redrawTile(50, 50, 10)
+        self.assertEqual(self.draw(View(10, 20)), {(10, 20)})
+
+        self.buffer.invalidate()
+        self.assertEqual(len(self.draw(View(10, 20))), 12)
+
+    def testZoomRecomposes(self):
+        self.draw(View(10, 20))
+        self.assertEqual(len(self.draw(View(20, 40, zoom = 11))), 12)
+
+
+if __name__ == '__main__':
+    unittest.main()
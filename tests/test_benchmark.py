@@ -0,0 +1,70 @@
+'''
+The benchmark harness - the synthetic cache, measurement, baseline
+comparison and skipping the wx benchmarks where wx cannot run.
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import benchmark
+from tiles import MapSource
+from tilestore import DirectoryTileStore
+
+
+#==============================================================================
+class BenchmarkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheTopLevel = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheTopLevel, ignore_errors = True)
+
+    #--------------------------------------------
+    def testCacheIsAtIntegerTileNumbers(self):
+        source = MapSource.mapSources['OSM_GPS_MAP_SOURCE_OPENSTREETMAP']
+        self.assertEqual(benchmark.buildCache(self.cacheTopLevel, source, radius = 2), 25)
+
+        store = DirectoryTileStore.forSource(self.cacheTopLevel, source)
+        try:
+            tiles = list(store.tiles())
+        finally:
+            store.close()
+        self.assertEqual(len(tiles), 25)
+        self.assertTrue(all(isinstance(x, int) and isinstance(y, int) for x, y, _z in tiles))
+
+    def testMeasure(self):
+        with mock.patch.object(benchmark, 'buildCache', return_value = 0):
+            bench = benchmark.Benchmark(quick = True)
+        try:
+            with mock.patch('builtins.print'):
+                bench.measure('sum', lambda: sum(range(1000)), 1000)
+                bench.measureFrames('frames', lambda _state, i: sum(range(i)), 20)
+        finally:
+            bench.close()
+
+        self.assertGreater(bench.results['sum']['opsPerSecond'], 0)
+        self.assertLessEqual(bench.results['frames']['p50ms'], bench.results['frames']['p99ms'])
+
+    def testCompare(self):
+        baseline = {'results': {'fast': {'opsPerSecond': 100.0}, 'slow': {'opsPerSecond': 100.0},
+                                'gone': {'opsPerSecond': 1.0}}}
+        results = {'results': {'fast': {'opsPerSecond': 95.0}, 'slow': {'opsPerSecond': 80.0},
+                               'new': {'opsPerSecond': 1.0}}}
+        with mock.patch('builtins.print'):
+            self.assertEqual(benchmark.compare(results, baseline, 0.1), [('slow', 0.8)])
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'displays are only looked for on Linux')
+    def testNoDisplaySkipsTheWxBenchmarks(self):
+        environ = {name: value for name, value in os.environ.items() if name not in ('DISPLAY', 'WAYLAND_DISPLAY')}
+        with mock.patch.dict(os.environ, environ, clear = True), mock.patch('builtins.print') as printed:
+            self.assertIsNone(benchmark.startApp('widget paint'))
+        self.assertIn('skipping the widget paint benchmark', printed.call_args[0][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+'''
+BitmapCache - the byte-budgeted LRU of decoded tile bitmaps.
+'''
+
+import unittest
+
+from bitmapcache import BitmapCache
+
+
+#==============================================================================
+class BitmapCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        # Sizes are the "bitmaps" themselves
+        self.cache = BitmapCache(maxBytes = 10, sizeOf = lambda bitmap: bitmap)
+
+    #--------------------------------------------
+    def testEvictsLeastRecentlyUsedPastTheBudget(self):
+        self.cache.put('a', 4)
+        self.cache.put('b', 4)
+        self.cache.get('a')
+        self.cache.put('c', 4)
+
+        self.assertIn('a', self.cache)
+        self.assertNotIn('b', self.cache)
+        self.assertEqual(self.cache.stats()['bytes'], 8)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def testKeepsTheNewestEntryOverBudget(self):
+        self.cache.put('a', 4)
+        self.cache.put('huge', 20)
+        self.assertEqual(len(self.cache), 1)
+        self.assertIn('huge', self.cache)
+
+    def testReplacingAnEntryAdjustsTheBytes(self):
+        self.cache.put('a', 4)
+        self.cache.put('a', 6)
+        self.assertEqual(self.cache.stats()['bytes'], 6)
+        self.cache.discard('a')
+        self.assertEqual(self.cache.stats()['bytes'], 0)
+
+    #--------------------------------------------
+    def testProvisionalNeverReplacesReal(self):
+        self.cache.put('a', 4)
+        self.cache.put('a', 2, provisional = True)
+        self.assertEqual(self.cache.lookup('a'), (4, False))
+
+        self.cache.put('b', 2, provisional = True)
+        self.assertEqual(self.cache.lookup('b'), (2, True))
+        self.cache.put('b', 3)
+        self.assertEqual(self.cache.lookup('b'), (3, False))
+
+    #--------------------------------------------
+    def testBudget(self):
+        for key in 'abcd':
+            self.cache.put(key, 2)
+        self.cache.setBudget(4)
+        self.assertEqual(len(self.cache), 2)
+
+        self.cache.ensureBudget(2)
+        self.assertEqual(self.cache.maxBytes, 4)
+        self.cache.ensureBudget(8)
+        self.assertEqual(self.cache.maxBytes, 8)
+
+    #--------------------------------------------
+    def testHitRate(self):
+        self.assertIsNone(self.cache.stats()['hitRate'])
+
+        self.cache.put('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.stats()['hitRate'], 0.5)
+
+        self.assertIsNone(self.cache.peek('b'))
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
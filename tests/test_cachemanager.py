@@ -0,0 +1,79 @@
+'''
+CacheManager quotas and LRU eviction.
+'''
+
+import time
+import shutil
+import tempfile
+import unittest
+
+from cachemanager import CacheManager
+from tilestore import MBTilesTileStore
+
+TILE = b'\x00' * 1024
+SOURCE = 'TEST_SOURCE'
+
+
+#==============================================================================
+class CacheManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheTopLevel = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.store = MBTilesTileStore(f'{self.cacheTopLevel}/test.mbtiles')
+        self.tiles = [(x, y, 10) for x in range(20) for y in range(15)]
+        for x, y, z in self.tiles:
+            self.store.write(x, y, z, TILE)
+        self.store.flush()
+
+    def tearDown(self):
+        self.manager.close()
+        self.store.close()
+        shutil.rmtree(self.cacheTopLevel, ignore_errors = True)
+
+    #--------------------------------------------
+    def manage(self, **kwargs):
+        ''' Attach the store, as imported from elsewhere - every tile last used at time 0 '''
+        self.manager = CacheManager(self.cacheTopLevel, flushInterval = 3600, **kwargs)
+        self.manager.attach(self.store, SOURCE)
+
+        deadline = time.monotonic() + 10
+        while self.manager.totalBytes() < len(self.tiles) * len(TILE) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(self.manager.totalBytes(), len(self.tiles) * len(TILE))
+
+    #--------------------------------------------
+    def testEvictsPastProtectedTilesSharingOneUseTime(self):
+        self.manage(globalQuota = 100 * 1024, evictBatch = 10)
+        protected = set(sorted(self.tiles, key = lambda t: (t[2], t[0], t[1]))[:20])
+        self.manager.protect(self, SOURCE, 0, 0, 0, -1, -1, protected)
+
+        self.assertGreater(self.manager.evict(), 0)
+        self.assertLessEqual(self.manager.totalBytes(), 90 * 1024)
+        self.assertTrue(all(self.store.exists(*tile) for tile in protected))
+
+    def testEvictsLeastRecentlyUsedFirst(self):
+        self.manage(globalQuota = 100 * 1024)
+        recent = self.tiles[-50:]
+        for tile in recent:
+            self.store.read(*tile)
+        self.manager.flush()
+
+        self.manager.evict()
+        self.assertTrue(all(self.store.exists(*tile) for tile in recent))
+        self.assertEqual(self.manager.stats()['sources'][SOURCE]['tiles'], 90)
+
+    def testStopsWhenEverythingLeftIsProtected(self):
+        self.manage(globalQuota = 100 * 1024, evictBatch = 10)
+        self.manager.protect(self, SOURCE, 10, 0, 0, 19, 14)
+
+        self.assertEqual(self.manager.evict(), 0)
+        self.assertEqual(self.manager.totalBytes(), len(self.tiles) * len(TILE))
+
+    def testSourceQuota(self):
+        self.manage(sourceQuotas = {SOURCE: 50 * 1024})
+        self.manager.evict(SOURCE)
+        self.assertLessEqual(self.manager.totalBytes(SOURCE), 45 * 1024)
+
+
+if __name__ == '__main__':
+    unittest.main()
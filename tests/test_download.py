@@ -0,0 +1,143 @@
+'''
+Tile downloads - MapSource URLs, the HostPool and TileDownloader threads.
+'''
+
+import queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from tiles import MapSource, HostPool, TileDownloader, TileJob
+from tilestore import DirectoryTileStore
+
+
+#==============================================================================
+class MapSourceTest(unittest.TestCase):
+
+    def testMirrorsAreUsedInTurn(self):
+        source = MapSource.mapSources['OSM_GPS_MAP_SOURCE_GOOGLE_STREET']
+        hosts = [source.url(1, 2, 3).split('/')[2] for _i in range(source.mirrors * 2)]
+        self.assertEqual(len(set(hosts)), source.mirrors)
+        self.assertEqual(hosts[:source.mirrors], hosts[source.mirrors:])
+
+    def testURL(self):
+        source = MapSource.mapSources['OSM_GPS_MAP_SOURCE_OPENSTREETMAP']
+        self.assertEqual(source.url(5, 7, 12), 'http://tile.openstreetmap.org/12/5/7.png')
+
+
+#==============================================================================
+class HostPoolTest(unittest.TestCase):
+
+    def testOneSessionPerThread(self):
+        pool = HostPool()
+        sessions = []
+        thread = threading.Thread(target = lambda: sessions.append(pool.session()))
+        thread.start()
+        thread.join()
+
+        self.assertIs(pool.session(), pool.session())
+        self.assertIsNot(pool.session(), sessions[0])
+
+    def testOneLimitPerHost(self):
+        pool = HostPool(maxPerHost = 2)
+        self.assertIs(pool.hostLimit('http://a.example/1/2/3.png'), pool.hostLimit('http://a.example/4/5/6.png'))
+        self.assertIsNot(pool.hostLimit('http://a.example/1/2/3.png'), pool.hostLimit('http://b.example/1/2/3.png'))
+
+
+#==============================================================================
+class ServingHostPool:
+    ''' Answers every request itself with 'status', and records the URLs asked for '''
+
+    class Response:
+        headers = {}
+
+        def __init__(self, status, content):
+            self.status_code = status
+            self.ok = status < 400
+            self.content = content
+
+    def __init__(self, status = 200):
+        self.lock = threading.Lock()
+        self.status = status
+        self.requested = []
+
+    def get(self, url, headers = None):
+        with self.lock:
+            self.requested.append(url)
+        return self.Response(self.status, b'tile ' + url.encode())
+
+
+#==============================================================================
+class TileDownloaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.store = DirectoryTileStore(self.cacheDir)
+        self.hostPool = ServingHostPool()
+        self.queue = queue.Queue()
+        self.retrieved = []
+        self.source = MapSource.mapSources['OSM_GPS_MAP_SOURCE_OPENSTREETMAP']
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.cacheDir, ignore_errors = True)
+
+    def download(self, tiles, downloaders = 3, override = False):
+        for i in range(downloaders):
+            TileDownloader(self.queue, lambda *args: self.retrieved.append(args), self.hostPool)
+
+        for x, y, z in tiles:
+            self.queue.put(TileJob(self.source.url(x, y, z), self.store, self.store.key(x, y, z), x, y, z, override))
+        self.queue.join()
+
+    #--------------------------------------------
+    def testDownloadsEachTileOnce(self):
+        tiles = [(x, y, 8) for x in range(4) for y in range(5)]
+        self.download(tiles)
+
+        self.assertEqual(sorted(key for key, *_rest in self.retrieved), sorted(self.store.key(*tile) for tile in tiles))
+        for key, x, y, z, data in self.retrieved:
+            self.assertEqual(data, b'tile ' + self.source.url(x, y, z).encode())
+        self.assertEqual(sorted(self.hostPool.requested), sorted(self.source.url(*tile) for tile in tiles))
+        self.assertEqual(self.store.read(1, 2, 8), b'tile ' + self.source.url(1, 2, 8).encode())
+
+    def testStoredTileIsNotFetchedAgain(self):
+        self.store.write(1, 1, 8, b'stored')
+        self.download([(1, 1, 8)])
+        self.assertEqual(self.hostPool.requested, [])
+        self.assertEqual(self.retrieved, [(self.store.key(1, 1, 8), 1, 1, 8, None)])
+        self.assertEqual(self.store.read(1, 1, 8), b'stored')
+
+    def testStoredTilesAreLookedUpInTheIndex(self):
+        tiles = [(x, 1, 8) for x in range(4)]
+        for x, y, z in tiles: self.store.write(x, y, z, b'stored')
+        self.store.flush()
+        self.store.has(0, 0, 8)
+        deadline = time.monotonic() + 5
+        while 8 not in self.store.indexReady and time.monotonic() < deadline:
+            time.sleep(0.001)
+
+        asked = []
+        self.store.exists = lambda *tile: asked.append(tile)
+        self.download(tiles)
+        self.assertEqual(asked, [])
+        self.assertEqual(self.hostPool.requested, [])
+        self.assertEqual(len(self.retrieved), 4)
+
+    def testOverrideFetchesAgain(self):
+        self.store.write(1, 1, 8, b'stored')
+        self.download([(1, 1, 8)], override = True)
+        self.assertEqual(len(self.hostPool.requested), 1)
+        self.assertTrue(self.store.read(1, 1, 8).startswith(b'tile '))
+
+    def testFailuresAreNotStored(self):
+        self.hostPool.status = 503
+        self.download([(1, 1, 8)])
+        self.assertEqual(self.retrieved, [])
+        self.assertIsNone(self.store.read(1, 1, 8))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,204 @@
+'''
+FailureTracker - the negative cache of failed tiles and the circuit breaker
+for failing sources.
+'''
+
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+from failures import FailureTracker
+from tiles import TileDownloader, TileJob, TileQueue
+from tilestore import DirectoryTileStore
+
+SOURCE = 'TEST_SOURCE'
+
+
+#==============================================================================
+class FailureTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('failures.time.monotonic', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.failures = FailureTracker(retryTTL = 30.0, notFoundTTL = 3600.0, maxTTL = 1800.0,
+                                       threshold = 3, backoff = 10.0, maxBackoff = 40.0)
+
+    def later(self, seconds):
+        self.now += seconds
+        self.failures.expire()
+
+    #--------------------------------------------
+    def testNotFoundIsBlockedForItsOwnTTL(self):
+        self.failures.failed('tile', SOURCE, 404)
+        self.later(3000)
+        self.assertTrue(self.failures.isBlocked('tile'))
+        self.later(601)
+        self.assertFalse(self.failures.isBlocked('tile'))
+
+    def testRetryTTLDoublesUpToMaxTTL(self):
+        for _failure in range(10):
+            self.failures.failed('tile', None, 503)
+        self.later(1799)
+        self.assertTrue(self.failures.isBlocked('tile'))
+        self.later(2)
+        self.assertFalse(self.failures.isBlocked('tile'))
+
+    def testFailureCountIsKeptAfterTheRetry(self):
+        self.failures.failed('tile', None, 503)
+        self.later(31)
+        self.failures.failed('tile', None, 503)
+        self.later(59)
+        self.assertTrue(self.failures.isBlocked('tile'))
+
+    def testForgottenOnceUnblockedForItsTTL(self):
+        self.failures.failed('tile', None, 503)
+        self.later(61)
+        self.assertEqual(self.failures.stats()['failedTiles'], 0)
+
+    def testSuccessForgetsTheTile(self):
+        self.failures.failed('tile', SOURCE, 404)
+        self.failures.succeeded('tile', SOURCE)
+        self.assertFalse(self.failures.isBlocked('tile'))
+
+    #--------------------------------------------
+    def testCircuitOpensAfterThresholdAndProbes(self):
+        for i in range(3):
+            self.assertTrue(self.failures.allow(SOURCE))
+            self.failures.failed(f'tile{i}', SOURCE, 500)
+        self.assertFalse(self.failures.allow(SOURCE))
+
+        self.later(11)
+        self.assertTrue(self.failures.allow(SOURCE, 'probe'))
+        self.assertFalse(self.failures.allow(SOURCE, 'other'), 'only one probe at a time')
+
+        self.failures.succeeded('probe', SOURCE)
+        self.assertTrue(self.failures.allow(SOURCE))
+
+    def testFailedProbeDoublesTheBackoff(self):
+        for i in range(3):
+            self.failures.failed(f'tile{i}', SOURCE, 500)
+        self.later(11)
+        self.assertTrue(self.failures.allow(SOURCE, 'probe'))
+        self.failures.failed('probe', SOURCE, 500)
+
+        self.later(15)
+        self.assertFalse(self.failures.allow(SOURCE))
+        self.later(6)
+        self.assertTrue(self.failures.allow(SOURCE))
+
+    def testNotFoundResetsTheCount(self):
+        self.failures.failed('tile0', SOURCE, 500)
+        self.failures.failed('tile1', SOURCE, 500)
+        self.failures.failed('tile2', SOURCE, 404)
+        self.failures.failed('tile3', SOURCE, 500)
+        self.assertTrue(self.failures.allow(SOURCE))
+
+    def testRetryAfterOpensTheCircuit(self):
+        self.failures.failed('tile', SOURCE, 429, retryAfter = 120)
+        self.later(100)
+        self.assertFalse(self.failures.allow(SOURCE))
+        self.later(21)
+        self.assertTrue(self.failures.allow(SOURCE))
+
+    def testDroppedProbeAllowsAnother(self):
+        for i in range(3):
+            self.failures.failed(f'tile{i}', SOURCE, None)
+        self.later(11)
+        self.assertTrue(self.failures.allow(SOURCE, 'probe'))
+
+        # Some other queued tile of the source
+        self.failures.dropped(SOURCE, 'tile9')
+        self.assertFalse(self.failures.allow(SOURCE, 'other'))
+
+        self.failures.dropped(SOURCE, 'probe')
+        self.assertTrue(self.failures.allow(SOURCE, 'other'))
+
+    def testOnlyTheProbeEndsTheProbe(self):
+        for i in range(3):
+            self.failures.failed(f'tile{i}', SOURCE, 500)
+        self.later(11)
+        self.assertTrue(self.failures.allow(SOURCE, 'probe'))
+
+        # A request made before the circuit opened fails late
+        self.failures.failed('late', SOURCE, 500)
+        self.assertFalse(self.failures.allow(SOURCE, 'other'))
+
+        self.failures.failed('probe', SOURCE, 500)
+        self.later(19)
+        self.assertFalse(self.failures.allow(SOURCE, 'other'))
+        self.later(2)
+        self.assertTrue(self.failures.allow(SOURCE, 'other'))
+
+    def testIsOpenDoesNotStartAProbe(self):
+        self.assertFalse(self.failures.isOpen(SOURCE))
+        for i in range(3):
+            self.failures.failed(f'tile{i}', SOURCE, 500)
+        self.assertTrue(self.failures.isOpen(SOURCE))
+
+        self.later(11)
+        self.assertFalse(self.failures.isOpen(SOURCE))
+        self.assertFalse(self.failures.isOpen(SOURCE))
+        self.assertTrue(self.failures.allow(SOURCE, 'probe'))
+        self.assertTrue(self.failures.isOpen(SOURCE))
+
+
+#==============================================================================
+#
+# Answers every request with 503, counting them
+#
+class FailingHostPool:
+
+    class Response:
+        status_code = 503
+        ok = False
+        headers = {}
+        content = b''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def get(self, url, headers = None):
+        with self.lock:
+            self.requests += 1
+        return self.Response()
+
+
+#==============================================================================
+class CircuitBreakerDownloadTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cacheDir = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.store = DirectoryTileStore(self.cacheDir)
+        self.queue = TileQueue()
+        self.hostPool = FailingHostPool()
+        self.failures = FailureTracker(threshold = 5)
+        self.failed = []
+
+    def tearDown(self):
+        self.queue.close()
+        self.store.close()
+        shutil.rmtree(self.cacheDir, ignore_errors = True)
+
+    def testQueuedJobsAreNotSentOnceTheCircuitOpens(self):
+        downloaders = 3
+        for i in range(downloaders):
+            TileDownloader(self.queue, hostPool = self.hostPool, failures = self.failures, failed = self.failed.append)
+
+        for x in range(64):
+            self.queue.put(TileJob(f'http://tiles.example/8/{x}/0.png', self.store, self.store.key(x, 0, 8),
+                                   x, 0, 8, source = SOURCE))
+        self.queue.join()
+
+        # Only the requests already on their way when it opened
+        self.assertLessEqual(self.hostPool.requests, 5 + downloaders - 1)
+        self.assertEqual(len(self.failed), 64)
+        self.assertTrue(self.failures.isOpen(SOURCE))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+'''
+LayerSurface - cached layers drawn once and moved with the map - and the
+widened view they are drawn with.
+'''
+
+import unittest
+
+from projection import Projection
+
+try:
+    import wx
+    from layersurface import LayerSurface
+except ImportError:
+    wx = None
+
+
+def newProjection(width = 400, height = 300):
+    projection = Projection()
+    projection.setView(0, 0, width, height)
+    projection.recentre(51.5, -0.1, 12)
+    return projection
+
+
+#==============================================================================
+class ExpandedViewTest(unittest.TestCase):
+
+    def testWidenedAndRestored(self):
+        projection = newProjection()
+        before = dict(vars(projection))
+
+        with projection.expandedView(100) as view:
+            self.assertEqual((view.w, view.h), (600, 500))
+            self.assertAlmostEqual(view.px1, before['px1'] - 100 / projection.scale)
+            self.assertAlmostEqual(view.py2, before['py2'] + 100 / projection.scale)
+            self.assertAlmostEqual(view.pdx, 600 / projection.scale)
+            self.assertGreater(view.N, before['N'])
+            self.assertLess(view.W, before['W'])
+
+        self.assertEqual(vars(projection), before)
+
+    def testRestoredAfterAnError(self):
+        projection = newProjection()
+        with self.assertRaises(KeyError):
+            with projection.expandedView(100):
+                raise KeyError()
+        self.assertEqual(projection.w, 400)
+
+
+#==============================================================================
+class Layer:
+    ''' Records the view it is drawn with '''
+    revision = 0
+
+    def __init__(self):
+        self.drawn = []
+
+    def do_draw(self, gpsmap, dc):
+        self.drawn.append((gpsmap.w, gpsmap.h))
+
+
+@unittest.skipIf(wx is None, 'wxPython is not installed')
+class LayerSurfaceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = wx.App.Get() or wx.App(False)
+
+    def setUp(self):
+        self.projection = newProjection()
+        self.surface = LayerSurface(margin = 100)
+        self.layer = Layer()
+        self.bitmap = wx.Bitmap(400, 300)
+        self.dc = wx.MemoryDC(self.bitmap)
+
+    def tearDown(self):
+        self.dc.SelectObject(wx.NullBitmap)
+
+    def draw(self):
+        self.surface.draw(self.dc, self.projection, self.layer)
+
+    def pan(self, dx, dy):
+        ''' Move the view dx, dy pixels '''
+        projection = self.projection
+        projection.px1 += dx / projection.scale
+        projection.px2 += dx / projection.scale
+        projection.py1 += dy / projection.scale
+        projection.py2 += dy / projection.scale
+
+    #--------------------------------------------
+    def testDrawnWithTheWiderView(self):
+        self.draw()
+        self.assertEqual(self.layer.drawn, [(600, 500)])
+        self.assertEqual((self.surface.bitmap.GetWidth(), self.surface.bitmap.GetHeight()), (600, 500))
+        self.assertEqual(self.projection.w, 400)
+
+    def testMovedWhilePanningWithinTheMargin(self):
+        self.draw()
+        self.pan(60, -40)
+        self.draw()
+        self.pan(30, 90)
+        self.draw()
+        self.assertEqual(self.surface.renders, 1)
+
+    def testRedrawnPastTheMargin(self):
+        self.draw()
+        self.pan(250, 0)
+        self.draw()
+        self.assertEqual(self.surface.renders, 2)
+
+        self.pan(0, -150)
+        self.draw()
+        self.assertEqual(self.surface.renders, 3)
+
+    def testRedrawnWhenTheLayerChanges(self):
+        self.draw()
+        self.layer.revision += 1
+        self.draw()
+        self.draw()
+        self.assertEqual(self.surface.renders, 2)
+
+    def testRedrawnOnZoomAndResize(self):
+        self.draw()
+        self.projection.setZoom(13)
+        self.draw()
+        self.assertEqual(self.surface.renders, 2)
+
+        self.projection.setView(0, 0, 500, 300)
+        self.projection.findEdges()
+        self.draw()
+        self.assertEqual(self.surface.renders, 3)
+        self.assertEqual(self.layer.drawn[-1], (700, 500))
+
+
+if __name__ == '__main__':
+    unittest.main()
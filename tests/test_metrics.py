@@ -0,0 +1,92 @@
+'''
+Metrics - counters, histograms, gauges and hooks.
+'''
+
+import time
+import unittest
+
+from metrics import Histogram, Metrics, bucketEdges
+
+
+#==============================================================================
+class HistogramTest(unittest.TestCase):
+
+    def testEdges(self):
+        self.assertEqual(bucketEdges(1, 100), [1, 2, 5, 10, 20, 50, 100, 200, 500])
+
+    def testEmpty(self):
+        summary = Histogram().summary()
+        self.assertEqual(summary['count'], 0)
+        self.assertIsNone(summary['mean'])
+        self.assertIsNone(summary['p50'])
+
+    def testPercentilesComeFromTheBuckets(self):
+        histogram = Histogram(bucketEdges(1, 100))
+        for value in [1.5] * 50 + [7] * 40 + [300] * 9 + [5000]:
+            histogram.add(value)
+
+        self.assertEqual(histogram.percentile(0.5), 2)
+        self.assertEqual(histogram.percentile(0.9), 10)
+        self.assertEqual(histogram.percentile(0.99), 500)
+        # Beyond the last edge, the largest value seen
+        self.assertEqual(histogram.percentile(1.0), 5000)
+
+        summary = histogram.summary()
+        self.assertEqual((summary['count'], summary['min'], summary['max']), (100, 1.5, 5000))
+        self.assertAlmostEqual(summary['mean'], (75 + 280 + 2700 + 5000) / 100)
+
+    def testPercentileIsNoMoreThanTheMaximum(self):
+        histogram = Histogram()
+        histogram.add(3)
+        self.assertEqual(histogram.percentile(0.5), 3)
+
+
+#==============================================================================
+class MetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+
+    def testCountersAndRatio(self):
+        self.assertIsNone(self.metrics.ratio('cache.hit', 'cache.miss'))
+        self.metrics.count('cache.hit', 3)
+        self.metrics.count('cache.miss')
+        self.assertEqual(self.metrics.ratio('cache.hit', 'cache.miss'), 0.75)
+        self.assertEqual(self.metrics.snapshot()['counters'], {'cache.hit': 3, 'cache.miss': 1})
+
+    def testTimingAndHooks(self):
+        seen = []
+        self.metrics.addHook(lambda name, value: seen.append(name))
+        self.metrics.addHook(lambda name, value: 1 / 0)
+
+        with self.metrics.timing('paint'):
+            time.sleep(0.01)
+        self.metrics.observeSize('download.bytes', 20000)
+
+        histograms = self.metrics.snapshot()['histograms']
+        self.assertGreaterEqual(histograms['paint']['min'], 10)
+        self.assertEqual(histograms['download.bytes']['p50'], 20000)
+        self.assertEqual(seen, ['paint', 'download.bytes'])
+
+    def testGauges(self):
+        depth = [4]
+        self.metrics.gauge('queue.depth', lambda: depth[0])
+        self.metrics.gauge('broken', lambda: 1 / 0)
+
+        self.assertEqual(self.metrics.snapshot()['gauges'], {'queue.depth': 4, 'broken': None})
+        depth[0] = 7
+        self.assertEqual(self.metrics.snapshot()['gauges']['queue.depth'], 7)
+
+    def testReset(self):
+        self.metrics.count('a')
+        self.metrics.observe('b', 1)
+        self.metrics.gauge('c', lambda: 1)
+        self.metrics.reset()
+
+        snapshot = self.metrics.snapshot()
+        self.assertEqual((snapshot['counters'], snapshot['histograms']), ({}, {}))
+        self.assertEqual(snapshot['gauges'], {'c': 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,123 @@
+'''
+OffscreenRenderer - maps and layers drawn without a window, from the cache.
+Needs wxPython and a display.
+'''
+
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    import wx
+    from offscreen import OffscreenRenderer, ensureApp
+except ImportError:
+    wx = None
+
+LONDON = (51.5, -0.1)
+
+
+def tilePNG(colour):
+    image = wx.Image(256, 256)
+    image.SetRGB(wx.Rect(0, 0, 256, 256), colour.Red(), colour.Green(), colour.Blue())
+    stream = io.BytesIO()
+    image.SaveFile(stream, wx.BITMAP_TYPE_PNG)
+    return stream.getvalue()
+
+
+def colourAt(bitmap, x, y):
+    image = bitmap.ConvertToImage()
+    return image.GetRed(x, y), image.GetGreen(x, y), image.GetBlue(x, y)
+
+
+#==============================================================================
+class Marker:
+    ''' A layer drawing a blue square in the middle of the map '''
+
+    def do_draw(self, gpsmap, dc):
+        self.size = gpsmap.GetSize()
+        dc.SetBrush(wx.BLUE_BRUSH)
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.DrawRectangle(self.size.GetWidth() // 2 - 5, self.size.GetHeight() // 2 - 5, 10, 10)
+
+
+#==============================================================================
+@unittest.skipIf(wx is None, 'wxPython is not installed')
+class OffscreenRendererTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = ensureApp()
+
+    def setUp(self):
+        self.cacheTopLevel = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.renderer = OffscreenRenderer(downloaders = 0, download = False, cacheTopLevel = self.cacheTopLevel)
+
+    def tearDown(self):
+        self.renderer.map.close()
+        shutil.rmtree(self.cacheTopLevel, ignore_errors = True)
+
+    def storeVisible(self, colour, width = 256, height = 256):
+        gpsmap = self.renderer.map
+        gpsmap.setup(LONDON[0], LONDON[1], 12, width, height)
+        png = tilePNG(colour)
+        for x, y, _screenX in gpsmap.visibleTiles():
+            gpsmap.tileStore.write(x, y, gpsmap.zoom, png)
+
+    #--------------------------------------------
+    def testVisibleTilesWrapRoundTheWorld(self):
+        gpsmap = self.renderer.map
+        gpsmap.setup(0, 0, 1, 800, 600)
+        visible = sorted(gpsmap.visibleTiles(), key = lambda tile: (tile[2], tile[1]))
+
+        self.assertEqual([screenX for _x, _y, screenX in visible], [-1, -1, 0, 0, 1, 1, 2, 2])
+        self.assertEqual([x for x, _y, _screenX in visible], [1, 1, 0, 0, 1, 1, 0, 0])
+        self.assertTrue(all(0 <= y < 2 for _x, y, _screenX in visible))
+
+    def testDrawsStoredTiles(self):
+        self.storeVisible(wx.RED)
+        bitmap = self.renderer.render(LONDON[0], LONDON[1], 12, 256, 256)
+
+        self.assertEqual((bitmap.GetWidth(), bitmap.GetHeight()), (256, 256))
+        self.assertEqual(colourAt(bitmap, 128, 128), (255, 0, 0))
+
+    def testMissingTilesShowTheBackground(self):
+        bitmap = self.renderer.render(LONDON[0], LONDON[1], 12, 256, 256)
+        background = OffscreenRenderer.background
+        self.assertEqual(colourAt(bitmap, 128, 128), (background.Red(), background.Green(), background.Blue()))
+
+    def testLayersAreDrawnOnTop(self):
+        self.storeVisible(wx.RED, 320, 200)
+        marker = Marker()
+        bitmap = self.renderer.render(LONDON[0], LONDON[1], 12, 320, 200, layers = [marker])
+
+        self.assertEqual(marker.size, wx.Size(320, 200))
+        self.assertEqual(colourAt(bitmap, 160, 100), (0, 0, 255))
+        self.assertEqual(colourAt(bitmap, 10, 10), (255, 0, 0))
+
+    def testRGBA(self):
+        self.storeVisible(wx.RED, 64, 32)
+        rgba = self.renderer.renderRGBA(LONDON[0], LONDON[1], 12, 64, 32)
+        self.assertEqual(rgba.shape, (32, 64, 4))
+        self.assertEqual(rgba[16, 32].tolist(), [255, 0, 0, 255])
+
+    def testToFile(self):
+        self.storeVisible(wx.RED)
+        path = os.path.join(self.cacheTopLevel, 'map.png')
+        self.assertEqual(self.renderer.renderToFile(path, LONDON[0], LONDON[1], 12, 256, 256), path)
+        with open(path, 'rb') as fl:
+            self.assertEqual(fl.read(8), b'\x89PNG\r\n\x1a\n')
+
+    def testWaitCountsMissingTiles(self):
+        gpsmap = self.renderer.map
+        gpsmap.setup(LONDON[0], LONDON[1], 12, 256, 256)
+        visible = list(gpsmap.visibleTiles())
+        self.assertEqual(gpsmap.waitForTiles(0), len(visible))
+
+        self.storeVisible(wx.RED)
+        self.assertEqual(gpsmap.waitForTiles(0), 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
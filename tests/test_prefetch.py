@@ -0,0 +1,97 @@
+'''
+Prefetcher - which tiles it asks for, and how it holds off.
+'''
+
+import unittest
+
+from projection import Projection
+from prefetch import Prefetcher
+from tiles import TileQueue, TileJob
+
+
+#==============================================================================
+#
+# Records the prefetches the Prefetcher asks for, in place of Tiles
+#
+class RecordingTiles:
+
+    def __init__(self):
+        self.queue = TileQueue()
+        self.tileDownloaders = [None] * 4
+        self.prefetched = []
+        self.retained = None
+
+    def fileName(self, x, y, z):
+        return f'{z}/{x}/{y}'
+
+    def retainPrefetch(self, keys):
+        self.retained = set(keys)
+
+    def prefetchTile(self, x, y, z, order = 0):
+        self.prefetched.append((x, y, z, order))
+        return True
+
+
+#==============================================================================
+class PrefetcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tiles = RecordingTiles()
+        self.prefetcher = Prefetcher(self.tiles, ring = 1, maxQueued = 1000)
+        self.projection = Projection()
+        self.projection.setView(0, 0, 512, 512)
+        self.projection.recentre(32.1, 34.9, 12)
+
+    def onScreen(self, x, y, z):
+        p = self.projection
+        return z == p.zoom and int(p.px1) <= x < p.px2 and int(p.py1) <= y < p.py2
+
+    #--------------------------------------------
+    def testRingAndZoomLevels(self):
+        wanted = self.prefetcher.wanted(self.projection, cursor = (256, 256))
+        orders = {order for _x, _y, _z, order in wanted}
+        self.assertEqual(orders, {Prefetcher.RING, Prefetcher.ZOOM_OUT, Prefetcher.ZOOM_IN})
+
+        for x, y, z, order in wanted:
+            self.assertFalse(self.onScreen(x, y, z))
+            self.assertEqual(z, {Prefetcher.RING: 12, Prefetcher.ZOOM_OUT: 11, Prefetcher.ZOOM_IN: 13}[order])
+
+    def testLooksAheadOfTheDrag(self):
+        for _event in range(10):
+            self.prefetcher.panned(-40, 0)
+        wanted = self.prefetcher.wanted(self.projection)
+        ahead = [x for x, _y, _z, order in wanted if order == Prefetcher.MOTION]
+
+        # Dragging the content left moves the view right
+        self.assertTrue(ahead)
+        self.assertTrue(all(x > self.projection.px2 for x in ahead))
+
+    def testQueuesNearestFirst(self):
+        self.prefetcher.update(self.projection, cursor = (256, 256))
+        orders = [order for _x, _y, _z, order in self.tiles.prefetched]
+        self.assertEqual(orders, sorted(orders))
+        self.assertEqual(len(self.tiles.retained), len(self.tiles.prefetched))
+
+    def testHoldsOffWhileTheScreenIsLoading(self):
+        for x in range(4):
+            self.tiles.queue.put(TileJob('url', None, f'job{x}', x, 0, 0))
+        self.prefetcher.update(self.projection)
+        self.assertEqual(self.tiles.prefetched, [])
+        self.assertEqual(self.prefetcher.stats()['skippedBusy'], 1)
+
+    #--------------------------------------------
+    def testHitRate(self):
+        self.assertIsNone(self.prefetcher.stats()['hitRate'])
+
+        self.prefetcher.update(self.projection)
+        x, y, z, _order = self.tiles.prefetched[0]
+        self.prefetcher.displayed(self.tiles.fileName(x, y, z))
+        self.prefetcher.displayed(self.tiles.fileName(x, y, z))
+
+        stats = self.prefetcher.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['hitRate'], 1 / len(self.tiles.prefetched))
+
+
+if __name__ == '__main__':
+    unittest.main()
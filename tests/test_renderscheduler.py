@@ -0,0 +1,97 @@
+'''
+RenderScheduler - repaint requests coalesced into one paint per frame.
+Needs wxPython and a display.
+'''
+
+import time
+import unittest
+
+try:
+    import wx
+    from renderscheduler import RenderScheduler
+except ImportError:
+    wx = None
+
+
+#==============================================================================
+class Window:
+    ''' Records the refreshes asked of it '''
+
+    def __init__(self):
+        self.refreshed = []
+        self.destroyed = False
+
+    def __bool__(self):
+        return not self.destroyed
+
+    def Refresh(self):
+        self.refreshed.append(None)
+
+    def RefreshRect(self, rect):
+        self.refreshed.append(wx.Rect(rect))
+
+
+#==============================================================================
+@unittest.skipIf(wx is None, 'wxPython is not installed')
+class RenderSchedulerTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = wx.App.Get() or wx.App(False)
+
+    def setUp(self):
+        self.window = Window()
+        self.scheduler = RenderScheduler(self.window, fps = 30)
+
+    def midFrame(self):
+        ''' As if a frame had just been painted, so requests wait for the next '''
+        self.scheduler.lastFrame = time.monotonic()
+
+    #--------------------------------------------
+    def testFirstRequestPaintsStraightAway(self):
+        self.scheduler.invalidate(wx.Rect(1, 2, 3, 4))
+        self.assertEqual(self.window.refreshed, [wx.Rect(1, 2, 3, 4)])
+        self.assertEqual(self.scheduler.frames, 1)
+        self.assertFalse(self.scheduler.scheduled)
+
+    def testRequestsWithinAFrameAreMerged(self):
+        self.midFrame()
+        self.scheduler.invalidate(wx.Rect(0, 0, 10, 10))
+        self.scheduler.invalidate(wx.Rect(20, 20, 10, 10))
+        self.assertEqual(self.window.refreshed, [])
+        self.assertTrue(self.scheduler.scheduled)
+
+        self.scheduler.flush()
+        self.assertEqual(self.window.refreshed, [wx.Rect(0, 0, 30, 30)])
+        self.assertEqual((self.scheduler.requests, self.scheduler.frames), (2, 1))
+
+    def testWholeWindowWins(self):
+        self.midFrame()
+        self.scheduler.invalidate(wx.Rect(0, 0, 10, 10))
+        self.scheduler.invalidate()
+        self.scheduler.invalidate(wx.Rect(20, 20, 10, 10))
+        self.scheduler.flush()
+        self.assertEqual(self.window.refreshed, [None])
+
+    def testNothingLeftAfterAFrame(self):
+        self.midFrame()
+        self.scheduler.invalidate()
+        self.scheduler.flush()
+        self.scheduler.flush()
+        self.assertEqual(self.window.refreshed, [None])
+
+    def testDestroyedWindowIsNotPainted(self):
+        self.midFrame()
+        self.scheduler.invalidate()
+        self.window.destroyed = True
+        self.scheduler.flush()
+        self.assertEqual(self.window.refreshed, [])
+        self.assertFalse(self.scheduler.scheduled)
+
+    def testFrameRate(self):
+        self.scheduler.setFPS(50)
+        self.assertAlmostEqual(self.scheduler.interval, 0.02)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+'''
+Revalidation of stale tiles with conditional requests.
+'''
+
+import collections
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import tiles
+from tiles import Tiles
+
+TILES = [(x, y, 10) for x in range(3) for y in range(3)]
+
+
+#==============================================================================
+class RevalidatingHostPool:
+    ''' Serves every tile with an ETag and max-age=0, and answers 304 when the ETag matches '''
+
+    class Response:
+
+        def __init__(self, status, content = b''):
+            self.status_code = status
+            self.ok = status < 400
+            self.content = content
+            self.headers = {'ETag': '"v1"', 'Cache-Control': 'max-age=0'}
+
+    def __init__(self, maxPerHost = 2):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.statuses = collections.Counter()
+
+    def get(self, url, headers = None):
+        status = 304 if (headers or {}).get('If-None-Match') == '"v1"' else 200
+        with self.lock:
+            self.requests += 1
+            self.statuses[status] += 1
+        return self.Response(status, b'tile ' + url.encode())
+
+
+#==============================================================================
+class RevalidationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.home = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.hostPool = RevalidatingHostPool()
+        with mock.patch.dict(os.environ, HOME = self.home), \
+             mock.patch.object(tiles, 'HostPool', lambda maxPerHost: self.hostPool):
+            self.tiles = Tiles()
+        self.tiles.setViewport(10, 0, 0, 3, 3)
+
+    def tearDown(self):
+        self.tiles.tileStore.close()
+        shutil.rmtree(self.home, ignore_errors = True)
+
+    #--------------------------------------------
+    def paint(self, frames):
+        for _frame in range(frames):
+            for x, y, z in TILES:
+                self.tiles.getTile(x, y, z)
+        self.tiles.queue.join()
+
+    def expire(self, x, y, z):
+        self.tiles.expiryTimes[self.tiles.fileName(x, y, z)] = time.time() - 1
+
+    def download(self):
+        self.paint(1)
+        self.assertTrue(all(self.tiles.getTile(*tile) for tile in TILES))
+        self.hostPool.reset()
+
+    #--------------------------------------------
+    def testUncacheableTilesAreNotRevalidatedEveryPaint(self):
+        self.download()
+        self.paint(60)
+        self.assertEqual(self.hostPool.requests, 0)
+
+    def testDueTilesAreRevalidatedOnce(self):
+        self.download()
+        for tile in TILES: self.expire(*tile)
+        self.paint(30)
+
+        self.assertEqual(self.hostPool.requests, len(TILES))
+        self.assertEqual(self.hostPool.statuses, {304: len(TILES)})
+        self.assertFalse(self.tiles.isStale(0, 0, 10))
+
+    def testRevalidationIsNotRequeuedWhileQueued(self):
+        self.download()
+        self.expire(0, 0, 10)
+
+        self.assertTrue(self.tiles.revalidateIfStale(0, 0, 10))
+        self.assertFalse(self.tiles.revalidateIfStale(0, 0, 10))
+        self.paint(0)
+        self.assertEqual(self.hostPool.statuses, {304: 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
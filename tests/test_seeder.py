@@ -0,0 +1,128 @@
+'''
+Seeder - region enumeration and resumable bulk downloads.
+'''
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from seeder import Seeder, SeedJournal, enumerateTiles
+
+
+#==============================================================================
+class EnumerateTilesTest(unittest.TestCase):
+
+    def testBoundingBox(self):
+        tiles = list(enumerateTiles([0, 1, 2], bbox = (-80.0, -170.0, 80.0, 170.0)))
+        self.assertEqual(len(tiles), 1 + 4 + 16)
+        self.assertEqual(tiles[0], (0, 0, 0))
+        self.assertEqual(len(set(tiles)), len(tiles))
+
+    def testPolygonIsWithinItsBoundingBox(self):
+        triangle = [(31.0, 34.0), (33.0, 34.0), (31.0, 36.0)]
+        inPolygon = list(enumerateTiles([8, 9], polygon = triangle))
+        inBox = list(enumerateTiles([8, 9], bbox = (31.0, 34.0, 33.0, 36.0)))
+
+        self.assertTrue(set(inPolygon) < set(inBox))
+        # The corners of the triangle are always covered
+        self.assertTrue(all(tile in inPolygon for tile in enumerateTiles([9], bbox = (31.0, 34.0, 31.0, 34.0))))
+        self.assertEqual(inPolygon, list(enumerateTiles([8, 9], polygon = triangle)))
+
+
+#==============================================================================
+class ServingHostPool:
+    ''' Answers every request itself, 404 while 'notFound' is set, and records the URLs asked for '''
+
+    class Response:
+        headers = {}
+
+        def __init__(self, status, content):
+            self.status_code = status
+            self.ok = status < 400
+            self.content = content
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.notFound = False
+        self.requested = []
+
+    def get(self, url, headers = None):
+        with self.lock:
+            self.requested.append(url)
+        return self.Response(404, b'') if self.notFound else self.Response(200, b'tile ' + url.encode())
+
+
+#==============================================================================
+class SeederTest(unittest.TestCase):
+
+    bbox = (32.0, 34.8, 32.2, 35.0)
+    zooms = [10, 11, 12]
+
+    def setUp(self):
+        self.hostPool = ServingHostPool()
+        self.cacheDir = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.journal = os.path.join(self.cacheDir, 'test.seed')
+        self.total = sum(1 for _tile in enumerateTiles(self.zooms, self.bbox))
+
+    def tearDown(self):
+        shutil.rmtree(self.cacheDir, ignore_errors = True)
+
+    def seed(self, **args):
+        seeder = Seeder(cacheTopLevel = self.cacheDir, rate = 0, batchSize = 4, **args)
+        seeder.hostPool = self.hostPool
+        try:
+            return seeder.seed(self.zooms, bbox = self.bbox, journalPath = self.journal)
+        finally:
+            seeder.store.close()
+
+    #--------------------------------------------
+    def testSeedsEveryTile(self):
+        stats = self.seed()
+        self.assertEqual(stats['total'], self.total)
+        self.assertEqual((stats['done'], stats['downloaded'], stats['failed']), (self.total, self.total, 0))
+        self.assertEqual(len(self.hostPool.requested), self.total)
+        self.assertEqual(len(set(self.hostPool.requested)), self.total)
+
+    def testResumeSkipsFinishedBatches(self):
+        first = self.seed()
+        self.hostPool.requested = []
+
+        stats = self.seed()
+        self.assertEqual(self.hostPool.requested, [])
+        self.assertEqual((stats['downloaded'], stats['cached']), (0, 0))
+        self.assertEqual((stats['done'], stats['bytes']), (self.total, first['bytes']))
+
+    def testFailedBatchesAreRetried(self):
+        self.hostPool.notFound = True
+        stats = self.seed()
+        self.assertEqual(stats['failed'], self.total)
+
+        self.hostPool.notFound = False
+        stats = self.seed()
+        self.assertEqual((stats['downloaded'], stats['failed']), (self.total, 0))
+
+    def testCachedTilesAreNotDownloaded(self):
+        self.seed()
+        os.remove(self.journal)
+        self.hostPool.requested = []
+
+        stats = self.seed()
+        self.assertEqual(stats['cached'], self.total)
+        self.assertEqual(self.hostPool.requested, [])
+
+        # Cached tiles come back before their batch is all queued - it must still be journalled whole
+        db = sqlite3.connect(self.journal)
+        self.assertEqual(db.execute('SELECT COUNT(*), SUM(tiles) FROM batches').fetchone(), ((self.total + 3) // 4, self.total))
+        db.close()
+
+    def testJournalOfAnotherSeed(self):
+        SeedJournal(self.journal, {'zooms': [1]}).close()
+        with self.assertRaises(ValueError):
+            self.seed()
+
+
+if __name__ == '__main__':
+    unittest.main()
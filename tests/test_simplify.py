@@ -0,0 +1,93 @@
+'''
+Douglas-Peucker simplification and the per-zoom SimplificationPyramid.
+'''
+
+import unittest
+
+import numpy
+
+from simplify import douglasPeucker, SimplificationPyramid
+from track import TrackStore
+
+
+#==============================================================================
+class DouglasPeuckerTest(unittest.TestCase):
+
+    def testShortLinesAreKept(self):
+        self.assertEqual(list(douglasPeucker(numpy.array([0.0, 1.0]), numpy.array([0.0, 1.0]), 1.0)), [0, 1])
+
+    def testStraightLineKeepsItsEnds(self):
+        x = numpy.arange(10, dtype = numpy.float64)
+        self.assertEqual(list(douglasPeucker(x, x * 2, 0.5)), [0, 9])
+
+    def testCornersAreKept(self):
+        x = numpy.array([0.0, 1.0, 2.0, 3.0, 4.0, 5.0, 6.0])
+        y = numpy.array([0.0, 0.1, 0.0, 3.0, 6.0, 6.1, 6.0])
+        self.assertEqual(list(douglasPeucker(x, y, 0.5)), [0, 2, 4, 6])
+        self.assertEqual(list(douglasPeucker(x, y, 0.01)), [0, 1, 2, 4, 5, 6])
+
+    def testClosedLoop(self):
+        x = numpy.array([0.0, 5.0, 0.0])
+        y = numpy.array([0.0, 0.0, 0.0])
+        self.assertEqual(list(douglasPeucker(x, y, 1.0)), [0, 1, 2])
+
+
+#==============================================================================
+class SimplificationPyramidTest(unittest.TestCase):
+
+    def setUp(self):
+        self.track = TrackStore(capacity = 4)
+        self.pyramid = SimplificationPyramid(self.track)
+
+    def addLine(self, start, count, lat = 32.0, lon = 34.0, step = 0.001):
+        for i in range(count):
+            self.track.append(start + i, lat, lon + i * step)
+
+    #--------------------------------------------
+    def testEmpty(self):
+        self.assertEqual(len(self.pyramid.indices(10)), 0)
+        self.assertEqual(self.pyramid.reduction(10), 1.0)
+
+    def testStraightTrackCollapses(self):
+        self.addLine(0, 100)
+        self.assertEqual(list(self.pyramid.indices(12)), [0, 99])
+        self.assertAlmostEqual(self.pyramid.reduction(12), 0.02)
+
+    def testIncrementalMatchesFromScratch(self):
+        self.addLine(0, 50)
+        self.pyramid.indices(14)
+        # Turn north
+        for i in range(50):
+            self.track.append(50 + i, 32.0 + (i + 1) * 0.001, 34.049)
+
+        incremental = self.pyramid.indices(14)
+        fresh = SimplificationPyramid(self.track).indices(14)
+        self.assertEqual(list(incremental), list(fresh))
+        self.assertIn(49, incremental)
+        self.assertEqual(incremental[-1], 99)
+
+    def testRepeatedTimestampsDoNotRebuild(self):
+        self.addLine(0, 20)
+        self.pyramid.indices(12)
+        levels = self.pyramid.levels
+
+        self.track.append(19, 32.0, 34.02)
+        self.track.append(19, 32.0, 34.021)
+        self.pyramid.indices(12)
+        self.assertIs(self.pyramid.levels, levels)
+        self.assertIn(12, levels)
+        self.assertEqual(levels[12]['upTo'], 22)
+
+    def testOutOfOrderPointRebuilds(self):
+        self.addLine(0, 20)
+        self.pyramid.indices(12)
+        self.pyramid.indices(13)
+
+        self.track.append(5.5, 33.0, 34.0)
+        indices = self.pyramid.indices(12)
+        self.assertEqual(list(self.pyramid.levels), [12])
+        self.assertIn(6, indices)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+'''
+TileGridIndex - bounding box lookups on the tile grid.
+'''
+
+import unittest
+
+from spatialindex import TileGridIndex
+
+
+#==============================================================================
+class TileGridIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.index = TileGridIndex(zoom = 10, maxCells = 16)
+        self.index.insert('haifa', 32.7, 34.9, 32.9, 35.1)
+        self.index.insert('eilat', 29.5, 34.9, 29.6, 35.0)
+        self.index.insert('london', 51.4, -0.3, 51.6, 0.1)
+
+    #--------------------------------------------
+    def testQuery(self):
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.index.query(32.0, 34.0, 33.0, 36.0), ['haifa'])
+        self.assertEqual(sorted(self.index.query(29.0, 34.0, 33.0, 36.0)), ['eilat', 'haifa'])
+        self.assertEqual(self.index.query(40.0, 10.0, 41.0, 11.0), [])
+
+    def testSameCellButNoOverlap(self):
+        # Same tile as Haifa at zoom 10, but the boxes do not meet
+        self.assertEqual(self.index.query(32.7, 35.11, 32.75, 35.12), [])
+
+    def testLargeFeatures(self):
+        self.index.insert('route', 29.0, -1.0, 52.0, 35.0)
+        self.assertIn('route', self.index.large)
+        self.assertEqual(sorted(self.index.query(51.5, -0.2, 51.5, -0.2)), ['london', 'route'])
+        self.assertEqual(self.index.query(60.0, 10.0, 61.0, 11.0), [])
+        self.assertEqual(sorted(self.index.query(40.0, 0.0, 40.5, 0.5)), ['route'])
+
+    def testWholeWorldQuery(self):
+        self.assertEqual(sorted(self.index.query(-90.0, -180.0, 90.0, 180.0)), ['eilat', 'haifa', 'london'])
+
+    def testRemoveAndReinsert(self):
+        self.index.remove('haifa')
+        self.index.remove('nowhere')
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.query(32.0, 34.0, 33.0, 36.0), [])
+
+        self.index.insert('eilat', 32.8, 35.0, 32.8, 35.0)
+        self.assertEqual(self.index.query(29.0, 34.0, 30.0, 36.0), [])
+        self.assertEqual(self.index.query(32.0, 34.0, 33.0, 36.0), ['eilat'])
+        self.assertFalse(any('haifa' in cell for cell in self.index.cells.values()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+'''
+TileDecoder - tile decoding on worker threads.
+'''
+
+import threading
+import unittest
+
+from tiledecoder import TileDecoder
+
+
+#==============================================================================
+class MemoryStore:
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+
+    def read(self, x, y, z):
+        return self.tiles.get((x, y, z))
+
+
+#==============================================================================
+class TileDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.decoded = []
+        self.done = threading.Semaphore(0)
+        self.decoder = TileDecoder(self.decode, self.record, workers = 1)
+
+    def tearDown(self):
+        self.release.set()
+        self.decoder.close()
+
+    def decode(self, data):
+        self.release.wait(5)
+        if data == b'bad': raise ValueError('undecodable')
+        return data.upper()
+
+    def record(self, key, image, x, y, z):
+        self.decoded.append((key, image))
+        self.done.release()
+
+    def wait(self, n):
+        for _i in range(n):
+            self.assertTrue(self.done.acquire(timeout = 5))
+
+    #--------------------------------------------
+    def testDecodesGivenDataOrReadsTheStore(self):
+        store = MemoryStore({(1, 2, 3): b'stored'})
+        self.release.set()
+        self.decoder.request('a', store, 1, 2, 3)
+        self.decoder.request('b', store, 0, 0, 0, data = b'given')
+        self.wait(2)
+        self.assertEqual(sorted(self.decoded), [('a', b'STORED'), ('b', b'GIVEN')])
+
+    def testEachTileIsDecodedOnceForEveryCallback(self):
+        store = MemoryStore({})
+        other = []
+        self.assertTrue(self.decoder.request('a', store, 0, 0, 0, data = b'x'))
+        self.assertFalse(self.decoder.request('a', store, 0, 0, 0, data = b'x'))
+        self.assertFalse(self.decoder.request('a', store, 0, 0, 0, data = b'x',
+                                              callback = lambda *args: (other.append(args), self.done.release())))
+        self.assertTrue(self.decoder.isPending('a'))
+
+        self.release.set()
+        self.wait(2)
+        self.assertEqual(self.decoded, [('a', b'X')])
+        self.assertEqual(other, [('a', b'X', 0, 0, 0)])
+        self.assertFalse(self.decoder.isPending('a'))
+
+    def testFailuresGiveNone(self):
+        self.release.set()
+        self.decoder.request('bad', MemoryStore({}), 0, 0, 0, data = b'bad')
+        self.decoder.request('missing', MemoryStore({}), 0, 0, 0)
+        self.wait(2)
+        self.assertEqual(sorted(self.decoded), [('bad', None), ('missing', None)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+'''
+TileFallback - stand-in tiles from decoded ancestors and children.
+Needs wxPython and a display.
+'''
+
+import unittest
+
+try:
+    import wx
+    from tilefallback import TileFallback
+except ImportError:
+    wx = None
+
+TILE = 256
+
+
+#==============================================================================
+class Cache(dict):
+    ''' The BitmapCache lookup TileFallback uses '''
+
+    def peek(self, key):
+        return self.get(key)
+
+
+def solid(colour, corner = None, cornerColour = None):
+    ''' A tile of one colour, optionally with one quadrant (dx, dy) of another '''
+    bitmap = wx.Bitmap(TILE, TILE)
+    dc = wx.MemoryDC(bitmap)
+    dc.SetBackground(wx.Brush(colour))
+    dc.Clear()
+    if corner is not None:
+        dc.SetBrush(wx.Brush(cornerColour))
+        dc.SetPen(wx.TRANSPARENT_PEN)
+        dc.DrawRectangle(corner[0] * TILE // 2, corner[1] * TILE // 2, TILE // 2, TILE // 2)
+    dc.SelectObject(wx.NullBitmap)
+    return bitmap
+
+
+def colourAt(bitmap, x, y):
+    image = bitmap.ConvertToImage()
+    return image.GetRed(x, y), image.GetGreen(x, y), image.GetBlue(x, y)
+
+
+#==============================================================================
+@unittest.skipIf(wx is None, 'wxPython is not installed')
+class TileFallbackTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = wx.App.Get() or wx.App(False)
+
+    def setUp(self):
+        self.cache = Cache()
+        self.asked = []
+        self.fallback = TileFallback(self.cache, lambda x, y, z: (x, y, z),
+                                     lambda x, y, z: self.asked.append((x, y, z)), maxLevels = 3)
+
+    #--------------------------------------------
+    def testParentIsCroppedAndScaledUp(self):
+        # Tile 10, 13 is the bottom left quarter of 5, 6
+        self.cache[(5, 6, 10)] = solid(wx.RED, (0, 1), wx.BLUE)
+        bitmap = self.fallback.synthesise(10, 13, 11)
+
+        self.assertEqual((bitmap.GetWidth(), bitmap.GetHeight()), (TILE, TILE))
+        self.assertEqual(colourAt(bitmap, TILE // 2, TILE // 2), (0, 0, 255))
+        self.assertEqual(self.asked, [])
+
+    def testMissingAncestorsAreAskedFor(self):
+        self.cache[(2, 3, 9)] = solid(wx.BLUE)
+        bitmap = self.fallback.synthesise(10, 13, 11)
+
+        self.assertEqual(colourAt(bitmap, TILE // 2, TILE // 2), (0, 0, 255))
+        self.assertEqual(self.asked, [(5, 6, 10)])
+
+    def testNoFurtherThanMaxLevels(self):
+        self.cache[(0, 0, 7)] = solid(wx.BLUE)
+        self.assertIsNone(self.fallback.synthesise(16, 16, 11))
+        self.assertEqual(self.asked, [(8, 8, 10), (4, 4, 9), (2, 2, 8)])
+
+    def testNoAncestorsAtZoomZero(self):
+        self.assertIsNone(self.fallback.synthesise(0, 0, 0))
+        self.assertEqual(self.asked, [])
+
+    def testChildrenAreScaledDown(self):
+        # Only the top right child is in memory; the rest is filled in
+        self.cache[(21, 26, 12)] = solid(wx.RED)
+        bitmap = self.fallback.synthesise(10, 13, 11)
+
+        self.assertEqual(colourAt(bitmap, TILE * 3 // 4, TILE // 4), (255, 0, 0))
+        self.assertEqual(colourAt(bitmap, TILE // 4, TILE * 3 // 4), colourAt(solid(wx.GREEN), 0, 0))
+
+    def testAncestorIsPreferredToChildren(self):
+        self.cache[(5, 6, 10)] = solid(wx.BLUE)
+        self.cache[(20, 26, 12)] = solid(wx.RED)
+        bitmap = self.fallback.synthesise(10, 13, 11)
+        self.assertEqual(colourAt(bitmap, TILE // 4, TILE // 4), (0, 0, 255))
+
+
+if __name__ == '__main__':
+    unittest.main()
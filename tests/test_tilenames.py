@@ -0,0 +1,76 @@
+'''
+Array versions of the tile numbering and projection conversions, against
+the scalar ones.
+'''
+
+import unittest
+
+import numpy
+
+from projection import Projection
+from tilenames import latlon2xy, latlon2xy_many, tileXY, tileXY_many, xy2latlon, xy2latlon_many
+
+
+#==============================================================================
+class ManyTest(unittest.TestCase):
+
+    lats = [-85.0, -33.9, 0.0, 32.1, 51.5, 85.0]
+    lons = [-179.9, 151.2, 0.0, 34.9, -0.1, 179.9]
+
+    #--------------------------------------------
+    def testLatLonToXY(self):
+        for z in (0, 5, 17):
+            xs, ys = latlon2xy_many(self.lats, self.lons, z)
+            for lat, lon, x, y in zip(self.lats, self.lons, xs, ys):
+                sx, sy = latlon2xy(lat, lon, z)
+                self.assertAlmostEqual(x, sx, places = 6)
+                self.assertAlmostEqual(y, sy, places = 6)
+
+    def testTileNumbers(self):
+        xs, ys = tileXY_many(self.lats, self.lons, 12)
+        self.assertEqual(xs.dtype, numpy.int64)
+        self.assertEqual(list(zip(xs, ys)), [tileXY(lat, lon, 12) for lat, lon in zip(self.lats, self.lons)])
+
+    def testXYToLatLon(self):
+        xs, ys = [0.0, 1.5, 2047.9, 4095.0], [0.0, 2048.0, 1000.25, 4095.0]
+        lats, lons = xy2latlon_many(xs, ys, 12)
+        for x, y, lat, lon in zip(xs, ys, lats, lons):
+            slat, slon = xy2latlon(x, y, 12)
+            self.assertAlmostEqual(lat, slat, places = 9)
+            self.assertAlmostEqual(lon, slon, places = 9)
+
+    def testRoundTrip(self):
+        lats, lons = xy2latlon_many(*latlon2xy_many(self.lats, self.lons, 10), 10)
+        numpy.testing.assert_allclose(lats, self.lats, atol = 1e-9)
+        numpy.testing.assert_allclose(lons, self.lons, atol = 1e-9)
+
+
+#==============================================================================
+class ProjectionArrayTest(unittest.TestCase):
+
+    def setUp(self):
+        self.projection = Projection()
+        self.projection.setView(0, 0, 800, 600)
+        self.projection.recentre(32.1, 34.9, 12)
+
+    def testMatchesScalar(self):
+        lats = numpy.array([32.0, 32.1, 32.15, 32.2])
+        lons = numpy.array([34.8, 34.9, 34.95, 35.0])
+
+        xs, ys = self.projection.ll2xy_array(lats, lons)
+        ixs, iys = self.projection.ll2xyi_array(lats, lons)
+        self.assertEqual(ixs.dtype, numpy.int32)
+
+        for i, (lat, lon) in enumerate(zip(lats, lons)):
+            x, y = self.projection.ll2xy(lat, lon)
+            self.assertAlmostEqual(xs[i], x, places = 6)
+            self.assertAlmostEqual(ys[i], y, places = 6)
+            self.assertEqual((ixs[i], iys[i]), self.projection.ll2xyi(lat, lon))
+
+        blats, blons = self.projection.xy2ll_array(xs, ys)
+        numpy.testing.assert_allclose(blats, lats, atol = 1e-9)
+        numpy.testing.assert_allclose(blons, lons, atol = 1e-9)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+'''
+TileQueue - download jobs ranked by the viewport, and dropped once unwanted.
+'''
+
+import threading
+import unittest
+
+from tiles import TileQueue, TileJob
+
+
+def job(x, y, z = 10, **kwargs):
+    return TileJob(f'http://example/{z}/{x}/{y}.png', None, f'{z}/{x}/{y}', x, y, z, **kwargs)
+
+
+#==============================================================================
+class TileQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dropped = []
+        self.queue = TileQueue(self.dropped.append)
+
+    def drain(self):
+        jobs = []
+        while self.queue.qsize():
+            jobs.append(self.queue.get())
+            self.queue.task_done()
+        return [(j.x, j.y, j.z) for j in jobs]
+
+    #--------------------------------------------
+    def testFirstInFirstOutWithoutAViewport(self):
+        for x in range(3): self.queue.put(job(x, 0))
+        self.queue.put(job(9, 9, prefetch = True))
+        self.assertEqual(self.drain(), [(0, 0, 10), (1, 0, 10), (2, 0, 10), (9, 9, 10)])
+
+    def testOnScreenNearestTheCentreFirst(self):
+        self.queue.setViewport(10, 0, 0, 4, 4, ring = 1)
+        for x, y in ((0, 0), (2, 2), (4, 1), (1, 1), (3, 3)):
+            self.queue.put(job(x, y))
+        self.queue.put(job(6, 6, prefetch = True))
+
+        order = self.drain()
+        self.assertEqual(set(order[:2]), {(1, 1, 10), (2, 2, 10)})
+        self.assertEqual(set(order[2:4]), {(0, 0, 10), (3, 3, 10)})
+        self.assertEqual(order[4:], [(4, 1, 10), (6, 6, 10)])
+        self.assertEqual(self.dropped, [])
+
+    def testPrefetchInItsOwnOrder(self):
+        self.queue.setViewport(10, 0, 0, 4, 4)
+        self.queue.put(job(20, 20, prefetch = True, order = 2))
+        self.queue.put(job(21, 20, prefetch = True, order = 0))
+        self.queue.put(job(22, 20, revalidate = True, z = 10))
+        self.queue.put(job(1, 1, revalidate = True))
+        self.assertEqual(self.drain(), [(1, 1, 10), (21, 20, 10), (20, 20, 10)])
+        self.assertEqual([(j.x, j.y) for j in self.dropped], [(22, 20)])
+
+    #--------------------------------------------
+    def testMovingTheViewportDropsWhatLeftIt(self):
+        self.queue.setViewport(10, 0, 0, 4, 4)
+        for x in range(4): self.queue.put(job(x, 0))
+        self.queue.put(job(0, 0, z = 11))
+
+        self.queue.setViewport(10, 2, 0, 6, 4, ring = 0)
+        self.assertEqual(sorted((j.x, j.z) for j in self.dropped), [(0, 10), (0, 11), (1, 10)])
+        self.assertEqual(self.drain(), [(3, 0, 10), (2, 0, 10)])
+
+    def testSharedQueueRanksByTheViewportWantingAJobMost(self):
+        self.queue.setViewport(10, 0, 0, 4, 4, owner = 'a', source = 'OSM')
+        self.queue.setViewport(10, 10, 10, 14, 14, owner = 'b', source = 'OSM')
+        self.queue.put(job(12, 12, source = 'OSM'))
+        self.queue.put(job(2, 2, source = 'OTHER'))
+        self.assertEqual(self.drain(), [(12, 12, 10)])
+
+        self.queue.put(job(2, 2, source = 'OSM'))
+        self.queue.removeViewport('a')
+        self.assertEqual(self.drain(), [])
+
+    def testRetainPrefetch(self):
+        self.queue.setViewport(10, 0, 0, 4, 4)
+        self.queue.put(job(20, 20, prefetch = True))
+        self.queue.put(job(21, 20, prefetch = True))
+        self.queue.put(job(1, 1, prefetch = True))
+        self.queue.retainPrefetch({'10/21/20'})
+        self.assertEqual(sorted(self.drain()), [(1, 1, 10), (21, 20, 10)])
+
+    #--------------------------------------------
+    def testDroppedJobsCountAsFinished(self):
+        self.queue.setViewport(10, 0, 0, 4, 4)
+        self.queue.put(job(1, 1))
+        self.queue.put(job(50, 50))
+        self.queue.setViewport(10, 100, 100, 104, 104, ring = 0)
+
+        joined = threading.Thread(target = self.queue.join)
+        joined.start()
+        joined.join(2)
+        self.assertFalse(joined.is_alive())
+        self.assertEqual(self.queue.counts(), [0, 0, 0])
+
+    def testCloseWakesTheDownloaders(self):
+        self.queue.put(job(1, 1))
+        results = []
+        waiting = threading.Thread(target = lambda: results.extend([self.queue.get(), self.queue.get()]))
+        self.queue.close()
+        waiting.start()
+        waiting.join(2)
+        self.assertEqual(results, [None, None])
+        self.assertEqual(len(self.dropped), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
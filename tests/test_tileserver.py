@@ -0,0 +1,75 @@
+'''
+The local TileServer - routes built from MapSource URL templates, and the
+HTTP behaviour the download pipeline relies on.
+'''
+
+import unittest
+from urllib.parse import urlsplit
+
+from tiles import MapSource, HostPool
+from tileserver import TileServer, tileRoute
+
+
+#==============================================================================
+class TileRouteTest(unittest.TestCase):
+
+    def testEveryXYZSourceTemplate(self):
+        sources = [source for source in MapSource.mapSources.values()
+                   if all(f'%({name})d' in source.URLTemplate for name in ('x', 'y', 'zoom'))]
+        self.assertIn('OSM_GPS_MAP_SOURCE_GOOGLE_STREET', [source.name for source in sources])
+        self.assertIn('OSM_GPS_MAP_SOURCE_MAPS_FOR_FREE', [source.name for source in sources])
+
+        for source in sources:
+            parts = urlsplit(source.url(5, 7, 12))
+            match = tileRoute(source.URLTemplate).fullmatch(parts.path + ('?' + parts.query if parts.query else ''))
+            self.assertIsNotNone(match, source.name)
+            self.assertEqual((int(match['x']), int(match['y']), int(match['zoom'])), (5, 7, 12), source.name)
+
+    def testRepeatedPlaceholderMustAgree(self):
+        route = tileRoute(MapSource.mapSources['OSM_GPS_MAP_SOURCE_MAPS_FOR_FREE'].URLTemplate)
+        self.assertIsNotNone(route.fullmatch('/layer/relief/z12/row7/12_5-7.jpg'))
+        self.assertIsNone(route.fullmatch('/layer/relief/z12/row7/11_5-7.jpg'))
+
+    def testQuadkeyTemplateIsRefused(self):
+        with self.assertRaises(ValueError):
+            tileRoute(MapSource.mapSources['OSM_GPS_MAP_SOURCE_VIRTUAL_EARTH_STREET'].URLTemplate)
+
+
+#==============================================================================
+class TileServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.hostPool = HostPool()
+
+    def testServesAQueryStringTemplate(self):
+        template = MapSource.mapSources['OSM_GPS_MAP_SOURCE_GOOGLE_STREET'].URLTemplate
+        with TileServer(template = template) as server:
+            source = server.mapSource()
+            response = self.hostPool.get(source.url(3, 4, 5))
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.content.startswith(b'\x89PNG'))
+            self.assertEqual(self.hostPool.get(source.url(3, 4, 5) + '&extra=1').status_code, 404)
+            self.assertEqual(server.stats()['tiles'], 1)
+
+    def testConditionalRequests(self):
+        with TileServer(maxAge = 60) as server:
+            url = server.mapSource().url(1, 2, 3)
+            response = self.hostPool.get(url)
+            self.assertEqual(response.headers['Cache-Control'], 'max-age=60')
+
+            etag = response.headers['ETag']
+            self.assertEqual(self.hostPool.get(url, headers = {'If-None-Match': etag}).status_code, 304)
+
+            server.version += 1
+            self.assertEqual(self.hostPool.get(url, headers = {'If-None-Match': etag}).status_code, 200)
+
+    def testErrors(self):
+        with TileServer(errorRate = 1.0) as server:
+            self.assertEqual(self.hostPool.get(server.mapSource().url(1, 2, 3)).status_code, 503)
+
+        with TileServer(notFoundRate = 1.0) as server:
+            self.assertEqual(self.hostPool.get(server.mapSource().url(1, 2, 3)).status_code, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,207 @@
+'''
+TileService - downloads and stores shared between maps, and between
+processes through TileClaims - against the local TileServer.
+'''
+
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from tiles import Tiles, TileService
+from tileclaims import TileClaims
+from tileserver import TileServer
+
+TILES = [(x, y, 10) for x in range(3) for y in range(3)]
+
+
+#==============================================================================
+class Map:
+    ''' A Tiles on a service, recording the tiles it is told about '''
+
+    def __init__(self, service, cacheTopLevel, mapSource):
+        self.arrived = []
+        self.condition = threading.Condition()
+        self.tiles = Tiles(self.on_tile, service = service, cacheTopLevel = cacheTopLevel, mapSource = mapSource)
+        self.tiles.setViewport(10, 0, 0, 3, 3)
+
+    def on_tile(self, key, x, y, z, data):
+        with self.condition:
+            self.arrived.append((x, y, z))
+            self.condition.notify_all()
+
+    def waitFor(self, count, timeout = 10):
+        with self.condition:
+            return self.condition.wait_for(lambda: len(self.arrived) >= count, timeout)
+
+
+#==============================================================================
+class TileServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = TileServer(latency = 0.2).start()
+        self.cacheTopLevel = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.service = TileService(downloaders = 3)
+
+    def tearDown(self):
+        self.service.shutdown()
+        self.server.stop()
+        shutil.rmtree(self.cacheTopLevel, ignore_errors = True)
+
+    def openMap(self, service = None, cacheTopLevel = None):
+        return Map(service or self.service, cacheTopLevel or self.cacheTopLevel, self.server.mapSource())
+
+    def waitUntil(self, condition, timeout = 10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline: return False
+            time.sleep(0.01)
+        return True
+
+    #--------------------------------------------
+    def testMapsShareDownloads(self):
+        first, second = self.openMap(), self.openMap()
+        for tile in TILES:
+            self.assertIsNone(first.tiles.getTile(*tile))
+            self.assertIsNone(second.tiles.getTile(*tile))
+            # Asking again does not subscribe twice
+            second.tiles.getTile(*tile)
+
+        self.assertTrue(first.waitFor(len(TILES)))
+        self.assertTrue(second.waitFor(len(TILES)))
+        self.assertEqual(sorted(first.arrived), sorted(TILES))
+        self.assertEqual(sorted(second.arrived), sorted(TILES))
+        self.assertEqual(self.server.stats()['requests'], len(TILES))
+        self.assertEqual(self.service.stats()['pending'], 0)
+
+        first.tiles.close()
+        second.tiles.close()
+
+    def testClosedMapIsNotTold(self):
+        first, second = self.openMap(), self.openMap()
+        for tile in TILES:
+            first.tiles.getTile(*tile)
+            second.tiles.getTile(*tile)
+        second.tiles.close()
+
+        self.assertTrue(first.waitFor(len(TILES)))
+        self.assertEqual(second.arrived, [])
+        self.assertEqual(self.service.stats()['subscribed'], 0)
+        first.tiles.close()
+
+    def testStoresAreSharedAndClosedByTheLastUser(self):
+        first, second = self.openMap(), self.openMap()
+        store = first.tiles.tileStore
+        self.assertIs(second.tiles.tileStore, store)
+        self.assertEqual(self.service.stats()['stores'], 1)
+
+        first.tiles.getTile(0, 0, 10)
+        first.tiles.close()
+        second.tiles.close()
+
+        # The pending download still holds the store
+        self.assertEqual(self.service.stats()['stores'], 1)
+        self.assertFalse(store.flushEvent.is_set())
+
+        self.assertTrue(self.waitUntil(lambda: self.service.stats()['stores'] == 0))
+        self.assertTrue(store.flushEvent.is_set())
+        # Closed on the download thread, which may still be writing the tile out
+        self.assertTrue(self.waitUntil(lambda: os.path.exists(store.path(0, 0, 10))))
+
+    def testEachMapHasItsOwnPaintAndCacheMetrics(self):
+        first, second = self.openMap(), self.openMap()
+        first.tiles.searchCache(0, 0, 10)
+        with first.tiles.metrics.timing('paint.total'): pass
+        self.service.metrics.count('download.failed.TEST')
+
+        stats = second.tiles.stats()
+        self.assertNotIn('cache.miss', stats['counters'])
+        self.assertNotIn('paint.total', stats['histograms'])
+        self.assertIsNone(stats['diskHitRate'])
+        self.assertEqual(stats['counters']['download.failed.TEST'], 1)
+        self.assertIn('queue.depth', stats['gauges'])
+
+        stats = first.tiles.stats()
+        self.assertEqual(stats['counters']['cache.miss'], 1)
+        self.assertEqual(stats['histograms']['paint.total']['count'], 1)
+        self.assertEqual(stats['counters']['download.failed.TEST'], 1)
+
+        first.tiles.close()
+        second.tiles.close()
+
+    def testShutdownDropsQueuedDownloads(self):
+        tiles = self.openMap().tiles
+        for x in range(20):
+            tiles.getTile(x, 0, 10)
+
+        self.service.shutdown()
+        self.assertTrue(self.waitUntil(lambda: self.service.stats()['pending'] == 0))
+        self.assertLess(self.server.stats()['requests'], 20)
+        tiles.close()
+
+    def testClaimsAcrossServices(self):
+        claimsDir = os.path.join(self.cacheTopLevel, 'claims')
+        services = [TileService(downloaders = 2, claims = True, claimsDir = claimsDir, claimPoll = 0.05)
+                    for _i in range(2)]
+        try:
+            maps = [self.openMap(service) for service in services]
+            for tile in TILES:
+                for each in maps: each.tiles.getTile(*tile)
+
+            for each in maps:
+                self.assertTrue(each.waitFor(len(TILES)))
+                self.assertEqual(sorted(each.arrived), sorted(TILES))
+            self.assertEqual(self.server.stats()['tiles'], len(TILES))
+            self.assertEqual(self.server.stats()['duplicates'], 0)
+
+            for each in maps: each.tiles.close()
+            self.assertEqual(os.listdir(claimsDir), [])
+        finally:
+            for service in services: service.shutdown()
+
+
+#==============================================================================
+class TileClaimsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.claimsDir = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.claims = TileClaims(self.claimsDir, timeout = 60)
+        self.other = TileClaims(self.claimsDir, timeout = 60)
+
+    def tearDown(self):
+        shutil.rmtree(self.claimsDir, ignore_errors = True)
+
+    #--------------------------------------------
+    def testOneClaimant(self):
+        self.assertFalse(self.claims.isClaimed('a'))
+        self.assertTrue(self.claims.claim('a'))
+        self.assertFalse(self.other.claim('a'))
+        self.assertTrue(self.other.isClaimed('a'))
+
+        # Only the holder can release it
+        self.other.release('a')
+        self.assertTrue(self.other.isClaimed('a'))
+        self.claims.release('a')
+        self.assertFalse(self.other.isClaimed('a'))
+        self.assertTrue(self.other.claim('a'))
+
+    def testStaleClaimIsBroken(self):
+        self.assertTrue(self.claims.claim('a'))
+        old = time.time() - 120
+        os.utime(self.claims.path('a'), (old, old))
+
+        self.assertFalse(self.other.isClaimed('a'))
+        self.assertTrue(self.other.claim('a'))
+        self.assertTrue(self.claims.isClaimed('a'))
+
+    def testReleaseAll(self):
+        for key in 'abc':
+            self.claims.claim(key)
+        self.claims.releaseAll()
+        self.assertEqual(os.listdir(self.claimsDir), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,286 @@
+'''
+Tile stores - the osmgpsmap directory layout and MBTiles.
+'''
+
+import os
+import time
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+
+from tilestore import DirectoryTileStore, MBTilesTileStore, copyTiles
+
+
+#==============================================================================
+#
+# The same tests for every store type
+#
+class StoreTests:
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.store = self.makeStore()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tempDir, ignore_errors = True)
+
+    #--------------------------------------------
+    def testWriteReadRemove(self):
+        self.store.write(3, 4, 5, b'tile')
+        self.assertEqual(self.store.read(3, 4, 5), b'tile')
+        self.store.flush()
+        self.assertEqual(self.store.read(3, 4, 5), b'tile')
+        self.assertTrue(self.store.has(3, 4, 5))
+
+        self.store.remove(3, 4, 5)
+        self.assertIsNone(self.store.read(3, 4, 5))
+        self.assertFalse(self.store.has(3, 4, 5))
+
+    def testTilesAndSizes(self):
+        tiles = {(1, 2, 3): b'a', (4, 5, 6): b'bb', (0, 0, 0): b'ccc'}
+        for (x, y, z), data in tiles.items():
+            self.store.write(x, y, z, data)
+
+        self.assertEqual(set(self.store.tiles()), set(tiles))
+        self.assertEqual({(x, y, z): size for x, y, z, size, _used in self.store.tileSizes()},
+                         {tile: len(data) for tile, data in tiles.items()})
+
+    def testKeysAreDistinct(self):
+        keys = {self.store.key(x, y, z) for x in range(3) for y in range(3) for z in range(3)}
+        self.assertEqual(len(keys), 27)
+
+    def testSurvivesReopening(self):
+        self.store.write(7, 8, 9, b'kept')
+        self.store.close()
+        self.store = self.makeStore()
+        self.assertEqual(self.store.read(7, 8, 9), b'kept')
+
+    #--------------------------------------------
+    def waitForIndex(self, z):
+        self.store.has(0, 0, z)
+        deadline = time.monotonic() + 5
+        while z not in self.store.indexReady and time.monotonic() < deadline:
+            time.sleep(0.001)
+        self.assertIn(z, self.store.indexReady)
+
+    def testHasAnswersFromTheIndex(self):
+        self.store.write(1, 2, 12, b'tile')
+        self.store.flush()
+        self.waitForIndex(12)
+        self.assertTrue(self.store.has(1, 2, 12))
+        self.assertFalse(self.store.has(2, 2, 12))
+
+        # Written by someone else - not known until the tile is looked for on disk
+        other = self.makeStore()
+        try:
+            other.write(2, 2, 12, b'tile')
+            other.flush()
+        finally:
+            other.close()
+        self.assertFalse(self.store.has(2, 2, 12))
+        self.store.indexAdd(2, 2, 12)
+        self.assertTrue(self.store.has(2, 2, 12))
+
+    def testIndexFollowsWritesAndRemovals(self):
+        self.waitForIndex(12)
+        self.store.write(3, 3, 12, b'tile')
+        self.assertTrue(self.store.has(3, 3, 12))
+        self.store.remove(3, 3, 12)
+        self.assertFalse(self.store.has(3, 3, 12))
+
+    def testRemovalDuringTheScanIsKept(self):
+        self.store.write(6, 6, 14, b'tile')
+        self.store.flush()
+        scanZoom = self.store.scanZoom
+
+        def scanThenRemove(z):
+            found = list(scanZoom(z))
+            self.store.remove(6, 6, 14)
+            return found
+
+        self.store.scanZoom = scanThenRemove
+        self.waitForIndex(14)
+        self.assertFalse(self.store.has(6, 6, 14))
+
+    def watchWrites(self):
+        written, failed = [], []
+        self.store.onWritten = lambda store, tiles: written.append(sorted(tiles))
+        self.store.onWriteFailed = lambda store, tiles: failed.append(sorted(tiles))
+        return written, failed
+
+    def testHasBeforeTheIndexIsReady(self):
+        self.store.write(4, 4, 13, b'tile')
+        self.assertTrue(self.store.has(4, 4, 13))
+        self.assertFalse(self.store.has(5, 4, 13))
+
+    #--------------------------------------------
+    def testCopyTiles(self):
+        for x in range(5):
+            self.store.write(x, 1, 4, bytes([x]))
+
+        other = MBTilesTileStore(os.path.join(self.tempDir, 'copy.mbtiles')) \
+            if isinstance(self.store, DirectoryTileStore) else DirectoryTileStore(os.path.join(self.tempDir, 'copy'))
+        try:
+            self.assertEqual(copyTiles(self.store, other), 5)
+            self.assertEqual(other.read(3, 1, 4), bytes([3]))
+        finally:
+            other.close()
+
+
+#==============================================================================
+class DirectoryTileStoreTest(StoreTests, unittest.TestCase):
+
+    def makeStore(self):
+        return DirectoryTileStore(os.path.join(self.tempDir, 'cache'))
+
+    def testOsmGpsMapLayout(self):
+        self.store.write(3, 4, 5, b'tile')
+        self.store.flush()
+        with open(os.path.join(self.tempDir, 'cache', '5', '3', '4.png'), 'rb') as fl:
+            self.assertEqual(fl.read(), b'tile')
+
+    def testFailedWritesAreNotIndexed(self):
+        # A file where the zoom level's directory should be
+        with open(os.path.join(self.tempDir, 'cache', '5'), 'wb'):
+            pass
+        self.waitForIndex(6)
+        written, failed = self.watchWrites()
+
+        self.store.write(3, 4, 5, b'lost')
+        self.store.write(3, 4, 6, b'kept')
+        self.store.flush()
+        self.assertFalse(self.store.has(3, 4, 5))
+        self.assertTrue(self.store.has(3, 4, 6))
+        self.assertEqual(written, [[(3, 4, 6)]])
+        self.assertEqual(failed, [[(3, 4, 5)]])
+
+
+#==============================================================================
+class MBTilesTileStoreTest(StoreTests, unittest.TestCase):
+
+    def makeStore(self):
+        return MBTilesTileStore(os.path.join(self.tempDir, 'tiles.mbtiles'))
+
+    def testRowsAreTMS(self):
+        self.store.write(3, 4, 5, b'tile')
+        self.store.flush()
+        db = sqlite3.connect(os.path.join(self.tempDir, 'tiles.mbtiles'))
+        try:
+            rows = db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles').fetchall()
+        finally:
+            db.close()
+        self.assertEqual(rows, [(5, 3, 31 - 4)])
+
+    def testFailedBatchIsNotIndexed(self):
+        db = sqlite3.connect(os.path.join(self.tempDir, 'tiles.mbtiles'))
+        try:
+            db.execute("CREATE TRIGGER full BEFORE INSERT ON tiles BEGIN SELECT RAISE(ABORT, 'disk full'); END")
+            db.commit()
+        finally:
+            db.close()
+        self.waitForIndex(5)
+        written, failed = self.watchWrites()
+
+        self.store.write(3, 4, 5, b'lost')
+        self.store.setMeta(3, 4, 5, 'etag', None, 1000.0)
+        self.assertTrue(self.store.has(3, 4, 5))
+        self.store.flush()
+
+        self.assertFalse(self.store.has(3, 4, 5))
+        self.assertIsNone(self.store.read(3, 4, 5))
+        self.assertIsNone(self.store.meta(3, 4, 5))
+        self.assertEqual(written, [])
+        self.assertEqual(failed, [[(3, 4, 5)]])
+
+
+#==============================================================================
+#
+# A directory store whose writes can be held up, to look at a batch on its way to the disk
+#
+class GatedTileStore(DirectoryTileStore):
+
+    def __init__(self, cacheDir):
+        DirectoryTileStore.__init__(self, cacheDir, flushInterval = 3600)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.entered = threading.Event()
+
+    def writeBatch(self, batch):
+        self.entered.set()
+        self.gate.wait(5)
+        return DirectoryTileStore.writeBatch(self, batch)
+
+
+#==============================================================================
+class WriteBehindTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.store = GatedTileStore(os.path.join(self.tempDir, 'cache'))
+        self.written = []
+        self.store.onWritten = lambda store, tiles: self.written.append(sorted(tiles))
+
+    def tearDown(self):
+        self.store.gate.set()
+        self.store.close()
+        shutil.rmtree(self.tempDir, ignore_errors = True)
+
+    #--------------------------------------------
+    def testQueuedUntilFlushed(self):
+        self.store.write(1, 2, 3, b'queued')
+        self.store.setMeta(1, 2, 3, 'etag', None, 1000.0)
+
+        self.assertFalse(os.path.exists(self.store.path(1, 2, 3)))
+        self.assertEqual(self.store.read(1, 2, 3), b'queued')
+        self.assertTrue(self.store.has(1, 2, 3))
+        self.assertEqual(self.store.meta(1, 2, 3), ('etag', None, 1000.0))
+        self.assertIsNone(self.store.metadata.get(1, 2, 3))
+
+        self.store.flush()
+        self.assertTrue(os.path.exists(self.store.path(1, 2, 3)))
+        self.assertEqual(self.store.metadata.get(1, 2, 3), ('etag', None, 1000.0))
+        self.assertEqual(self.written, [[(1, 2, 3)]])
+
+    def testReadableWhileBeingWritten(self):
+        self.store.gate.clear()
+        self.store.write(1, 2, 3, b'on its way')
+        self.store.setMeta(1, 2, 3, 'etag', None, 1000.0)
+        flusher = threading.Thread(target = self.store.flush)
+        flusher.start()
+        self.assertTrue(self.store.entered.wait(5))
+
+        self.assertEqual(self.store.pending, {})
+        self.assertEqual(self.store.read(1, 2, 3), b'on its way')
+        self.assertEqual(self.store.meta(1, 2, 3), ('etag', None, 1000.0))
+        self.assertTrue(self.store.has(1, 2, 3))
+
+        self.store.gate.set()
+        flusher.join()
+        self.assertEqual(self.store.writing, {})
+        self.assertEqual(self.store.read(1, 2, 3), b'on its way')
+
+    def testQueuedRemoval(self):
+        self.store.write(1, 2, 3, b'tile')
+        self.store.setMeta(1, 2, 3, 'etag', None, 1000.0)
+        self.store.flush()
+
+        self.store.removeMeta(1, 2, 3)
+        self.assertIsNone(self.store.meta(1, 2, 3))
+        self.store.flush()
+        self.assertIsNone(self.store.metadata.get(1, 2, 3))
+
+    def testBacklogFlushesItself(self):
+        self.store.maxPending = 3
+        for x in range(3):
+            self.store.write(x, 0, 4, b'tile')
+
+        self.assertEqual(self.store.pending, {})
+        self.assertEqual(self.written, [[(0, 0, 4), (1, 0, 4), (2, 0, 4)]])
+        self.assertTrue(all(os.path.exists(self.store.path(x, 0, 4)) for x in range(3)))
+
+
+if __name__ == '__main__':
+    unittest.main()
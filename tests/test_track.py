@@ -0,0 +1,89 @@
+'''
+TrackStore - growable, time-ordered track storage with cached projections.
+'''
+
+import unittest
+
+import numpy
+
+from track import TrackStore
+from tilenames import latlon2xy, tileSizePixels
+
+
+#==============================================================================
+class TrackStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.track = TrackStore(capacity = 4)
+
+    def fill(self, n, start = 0):
+        for i in range(start, start + n):
+            self.track.append(float(i), 32.0 + i * 1e-4, 34.0 + i * 1e-4)
+
+    #--------------------------------------------
+    def testAppendGrows(self):
+        self.fill(100)
+        self.assertEqual(len(self.track), 100)
+        times, lats, _lons = self.track.points()
+        self.assertTrue(numpy.array_equal(times, numpy.arange(100.0)))
+        self.assertAlmostEqual(lats[99], 32.0 + 99e-4)
+        self.assertEqual(self.track.edits, 0)
+
+    def testRepeatedTimestampIsAnAppend(self):
+        self.fill(10)
+        self.track.append(9.0, 33.0, 35.0)
+        self.assertEqual(len(self.track), 11)
+        self.assertEqual(self.track.edits, 0)
+        self.assertEqual(self.track.window(9.0, 9.0), (9, 11))
+
+    def testOutOfOrderPointIsInserted(self):
+        self.fill(5)
+        self.fill(5, start = 10)
+        self.track.append(7.0, 0.0, 0.0)
+        times, _lats, _lons = self.track.points()
+        self.assertEqual(list(times), [0, 1, 2, 3, 4, 7, 10, 11, 12, 13, 14])
+        self.assertEqual(self.track.edits, 1)
+
+    def testEarlierPointAtAStoredTimeReplacesIt(self):
+        self.fill(5)
+        self.track.append(2.0, 1.0, 2.0)
+        self.assertEqual(len(self.track), 5)
+        _times, lats, lons = self.track.points()
+        self.assertEqual((lats[2], lons[2]), (1.0, 2.0))
+
+    def testMaxPoints(self):
+        track = TrackStore(maxPoints = 100)
+        for i in range(101):
+            track.append(float(i), 0.0, 0.0)
+        self.assertEqual(len(track), 90)
+        self.assertEqual(track.points()[0][0], 11.0)
+
+    #--------------------------------------------
+    def testWorldIsProjectedIncrementally(self):
+        self.fill(10)
+        self.track.world(12)
+        self.fill(10, start = 10)
+        wx, wy = self.track.world(12)
+
+        for i in (0, 19):
+            x, y = latlon2xy(32.0 + i * 1e-4, 34.0 + i * 1e-4, 12)
+            self.assertAlmostEqual(wx[i], x * tileSizePixels(), places = 6)
+            self.assertAlmostEqual(wy[i], y * tileSizePixels(), places = 6)
+
+    def testInsertReprojectsFromTheInsertion(self):
+        self.fill(10)
+        self.track.world(12)
+        self.track.append(4.5, 10.0, 10.0)
+        wx, _wy = self.track.world(12)
+        x, _y = latlon2xy(10.0, 10.0, 12)
+        self.assertAlmostEqual(wx[5], x * tileSizePixels(), places = 6)
+
+    def testDiscardKeepsProjections(self):
+        self.fill(10)
+        before = self.track.world(12)[0].copy()
+        self.track.discardOldest(3)
+        self.assertTrue(numpy.allclose(self.track.world(12)[0], before[3:]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+'''
+WxMapWidget - per-map measurements and layers. Needs wxPython and a display.
+'''
+
+import shutil
+import tempfile
+import unittest
+
+from tiles import TileService
+
+try:
+    import wx
+    from wxmapwidget import WxMapWidget, PosMarker, ScaleMarkLayer
+except ImportError:
+    wx = None
+
+
+#==============================================================================
+@unittest.skipIf(wx is None, 'wxPython is not installed')
+class WxMapWidgetTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.app = wx.App.Get() or wx.App(False)
+
+    def setUp(self):
+        self.cacheTopLevel = tempfile.mkdtemp(prefix = 'wxmapwidget-test-')
+        self.service = TileService(downloaders = 0)
+        self.frame = wx.Frame(None, size = (400, 300))
+
+    def tearDown(self):
+        self.frame.Destroy()
+        self.service.shutdown()
+        shutil.rmtree(self.cacheTopLevel, ignore_errors = True)
+
+    def newMap(self):
+        return WxMapWidget(self.frame, tileService = self.service, cacheTopLevel = self.cacheTopLevel)
+
+    #--------------------------------------------
+    def testLayersOfOneClassAreTimedApart(self):
+        widget = self.newMap()
+        first, second, scale = PosMarker(), PosMarker(), ScaleMarkLayer()
+        for layer in (first, second, scale):
+            widget.layer_add(layer)
+
+        self.assertEqual([widget.layerNames[layer] for layer in (first, second, scale)],
+                         ['paint.layer.PosMarker', 'paint.layer.PosMarker.2', 'paint.layer.ScaleMarkLayer'])
+
+        widget.layer_remove(first)
+        widget.layer_add(PosMarker())
+        self.assertEqual(sorted(widget.layerNames.values()),
+                         ['paint.layer.PosMarker', 'paint.layer.PosMarker.2', 'paint.layer.ScaleMarkLayer'])
+
+    def testPaintTimesAreEachMapsOwn(self):
+        first, second = self.newMap(), self.newMap()
+        with first.metrics.timing('paint.total'): pass
+
+        self.assertIn('paint.total', first.stats()['histograms'])
+        self.assertNotIn('paint.total', second.stats()['histograms'])
+        self.assertIs(first.tileService.metrics, second.tileService.metrics)
+
+
+if __name__ == '__main__':
+    unittest.main()